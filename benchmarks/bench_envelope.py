@@ -0,0 +1,91 @@
+'''
+Size and decode-time of sqs message body: raw slack event (current) vs slim envelope
+Run from repo root: python benchmarks/bench_envelope.py
+'''
+import os
+import sys
+import json
+import glob
+import timeit
+import logging
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'lambda_msg_receiver'))
+sys.path.insert(0, os.path.join(ROOT, 'lambda_msg_handler'))
+
+from envelope import to_envelope, encode_body, dumps  # noqa: E402
+from msg_handlers.sqs_related.utils import decode_body  # noqa: E402
+from msg_handlers.slack_related.utils import extract_event_details  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+SAMPLE_DIR = os.path.join(
+    ROOT, 'lambda_msg_handler', 'msg_handlers', 'slack_related', 'sample_event')
+N = 2000
+
+
+def load_samples():
+    samples = {}
+    for path in sorted(glob.glob(os.path.join(SAMPLE_DIR, '*.json'))):
+        with open(path) as f:
+            samples[os.path.basename(path)] = json.load(f)
+
+    # long message with rich text blocks, close to slack 40,000 char limit
+    large = json.loads(json.dumps(samples[min(samples)]))
+    large['event']['text'] = 'lorem ipsum dolor sit amet ' * 1400
+    large['event']['blocks'] = [{
+        'type': 'rich_text',
+        'block_id': 'x',
+        'elements': [{
+            'type': 'rich_text_section',
+            'elements': [{'type': 'text', 'text': 'lorem ipsum dolor sit amet '}] * 1400,
+        }],
+    }]
+    samples['synthetic-large'] = large
+    return samples
+
+
+def current_path(sqs_msg):
+    # handler before envelope: json.loads, indent=2 dump in lambda_function + extract_event_details
+    body = json.loads(sqs_msg['body'])
+    json.dumps(body, indent=2)
+    json.dumps(body['event'], indent=2)
+    return extract_event_details(body)
+
+
+def envelope_path(sqs_msg):
+    return extract_event_details(decode_body(sqs_msg))
+
+
+def to_sqs_msg(body, content_encoding=None):
+    attrs = {}
+    if content_encoding:
+        attrs['content_encoding'] = {'stringValue': content_encoding}
+    return {'body': body, 'messageAttributes': attrs}
+
+
+def main():
+    print(f"{'event':<36}{'raw B':>9}{'env B':>9}{'env+z B':>9}"
+          f"{'raw us':>9}{'env us':>9}{'env+z us':>10}")
+    for name, slack_event in load_samples().items():
+        raw = json.dumps(slack_event)
+        env = dumps(to_envelope(slack_event))
+        env_z, encoding = encode_body(env, compress=True)
+
+        msgs = {
+            'raw': (current_path, to_sqs_msg(raw)),
+            'env': (envelope_path, to_sqs_msg(env)),
+            'env_z': (envelope_path, to_sqs_msg(env_z, encoding)),
+        }
+        expected = slack_event['event'].get('text', '')
+        assert all(f(m)['text'] == expected for f, m in msgs.values())
+        us = {
+            k: timeit.timeit(lambda: f(m), number=N) / N * 1e6
+            for k, (f, m) in msgs.items()
+        }
+        print(f"{name:<36}{len(raw):>9}{len(env):>9}{len(env_z):>9}"
+              f"{us['raw']:>9.1f}{us['env']:>9.1f}{us['env_z']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+'''
+Thread history in DDB ddb_chat_completion: one item per message (items, current)
+vs one compressed document per thread (packed, thread_doc.py)
+Per thread length: capacity units, round trips and latency of reading the history
+(fetch before the LLM call) and of writing one answered message
+
+Run from repo root: python benchmarks/bench_thread_layout.py
+  default: in-memory table, capacity units by DDB sizing rules, latency = handler CPU
+           + round trips x --rtt-ms
+  --table <name>: against a real table with the ddb_chat_completion key schema,
+           consumed capacity as reported by DDB, latency measured (writes test threads)
+'''
+import os
+import sys
+import math
+import time
+import random
+import argparse
+import logging
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'lambda_msg_handler'))
+
+from msg_handlers.ddb_related.utils import BatchWriter  # noqa: E402
+from msg_handlers.ddb_related.chat_history import (  # noqa: E402
+    fetch_thread_messages, save_thread_message, save_tool_turns, queue_thread_message,
+    to_message_record, to_tool_turn_records)
+from msg_handlers.ddb_related.thread_doc import (  # noqa: E402
+    append_doc_messages, fetch_doc_messages, load_thread_doc)
+
+logging.disable(logging.CRITICAL)
+
+# handler defaults
+TOKEN_BUDGET = 8000
+TOOL_TURN_RETENTION = 3
+TOOL_OUTPUT_TOKENS = 500
+DOC_MAX_TOKENS = TOKEN_BUDGET * 4
+
+THREAD_TURNS = [1, 5, 20, 50, 100]
+REPEAT = 20
+
+
+class MemoryTable:
+    '''
+    In-memory stand-in of the DDB client calls used by both layouts, charging capacity units
+    like DDB: reads per 4KB (half for eventually consistent), writes per 1KB, transactions twice
+    '''
+
+    def __init__(self):
+        self.items = {}
+        self.reset()
+
+    def reset(self):
+        self.calls, self.rcu, self.wcu = 0, 0.0, 0.0
+
+    @staticmethod
+    def _key(item):
+        return item['slack_channel_id_thread_ts']['S'], item['slack_event_ts']['S']
+
+    def _read(self, size, consistent=False):
+        return max(1, math.ceil(size / 4096)) * (1.0 if consistent else 0.5)
+
+    def query(self, ExpressionAttributeValues, Limit, ScanIndexForward=True,
+              ExclusiveStartKey=None, **kwargs):
+        self.calls += 1
+        pk = ExpressionAttributeValues[':slack_channel_id_thread_ts']['S']
+        after = ExpressionAttributeValues[':after_ts']['S']
+        keys = sorted((k for k in self.items if k[0] == pk and k[1] > after),
+                      reverse=not ScanIndexForward)
+        if ExclusiveStartKey:
+            start = self._key(ExclusiveStartKey)
+            keys = keys[keys.index(start) + 1:]
+        page = [self.items[k] for k in keys[:Limit]]
+        self.rcu += self._read(sum(get_item_size(i) for i in page))
+        resp = {'Items': page}
+        if len(keys) > Limit:
+            resp['LastEvaluatedKey'] = {a: page[-1][a] for a in ('slack_channel_id_thread_ts', 'slack_event_ts')}
+        return resp
+
+    def get_item(self, Key, ConsistentRead=False, **kwargs):
+        self.calls += 1
+        item = self.items.get(self._key(Key))
+        self.rcu += self._read(get_item_size(item) if item else 0, ConsistentRead)
+        return {'Item': item} if item else {}
+
+    def batch_get_item(self, RequestItems):
+        self.calls += 1
+        (table, request), = RequestItems.items()
+        found = [self.items[self._key(k)] for k in request['Keys'] if self._key(k) in self.items]
+        self.rcu += sum(self._read(get_item_size(i), request.get('ConsistentRead')) for i in found)
+        return {'Responses': {table: found}}
+
+    def _write(self, item, factor=1):
+        self.wcu += max(1, math.ceil(get_item_size(item) / 1024)) * factor
+        self.items[self._key(item)] = item
+
+    def put_item(self, Item, **kwargs):
+        self.calls += 1
+        self._write(Item)
+        return {}
+
+    def update_item(self, Key, ExpressionAttributeValues, **kwargs):
+        # SET role, content, tokens of save_thread_message
+        self.calls += 1
+        item = dict(self.items.get(self._key(Key), Key))
+        item.update({k[1:]: v for k, v in ExpressionAttributeValues.items()})
+        self._write(item)
+        return {}
+
+    def batch_write_item(self, RequestItems):
+        self.calls += 1
+        for requests in RequestItems.values():
+            for r in requests:
+                self._write(r['PutRequest']['Item'])
+        return {}
+
+    def transact_write_items(self, TransactItems):
+        self.calls += 1
+        for t in TransactItems:
+            if 'Put' in t:
+                self._write(t['Put']['Item'], factor=2)
+            else:
+                self.wcu += 2
+                self.items.pop(self._key(t['Delete']['Key']), None)
+        return {}
+
+
+def get_item_size(item: dict) -> int:
+    '''
+    DDB item size: attribute names + values (numbers approximated as digits / 2 + 1)
+    '''
+    size = 0
+    for name, value in item.items():
+        size += len(name.encode('utf-8'))
+        if 'S' in value:
+            size += len(value['S'].encode('utf-8'))
+        elif 'B' in value:
+            size += len(value['B'])
+        elif 'N' in value:
+            size += len(value['N']) // 2 + 1
+    return size
+
+
+class CapacityMeter:
+    '''
+    Consumed capacity and calls of a real DDB client, via botocore events
+    '''
+
+    def __init__(self, ddb_client):
+        self.reset()
+        events = ddb_client.meta.events
+        events.register('provide-client-params.dynamodb.*', self.add_return_capacity)
+        events.register('after-call.dynamodb.*', self.add_consumed)
+
+    def reset(self):
+        self.calls, self.rcu, self.wcu = 0, 0.0, 0.0
+
+    @staticmethod
+    def add_return_capacity(params, **kwargs):
+        params['ReturnConsumedCapacity'] = 'TOTAL'
+
+    def add_consumed(self, parsed, model, **kwargs):
+        self.calls += 1
+        consumed = parsed.get('ConsumedCapacity') or []
+        for c in consumed if isinstance(consumed, list) else [consumed]:
+            units = c.get('CapacityUnits', 0)
+            if model.name in ('Query', 'GetItem', 'BatchGetItem'):
+                self.rcu += units
+            else:
+                self.wcu += units
+
+
+# Synthetic conversation, fixed seed: words of a small vocabulary compress close to prose
+_rand = random.Random(0)
+VOCAB = [''.join(_rand.choice('etaoinshrdlucmfwyp') for _ in range(_rand.randint(2, 9)))
+         for _ in range(800)]
+
+
+def text(chars: int) -> str:
+    words, n = [], 0
+    while n < chars:
+        words.append(_rand.choice(VOCAB))
+        n += len(words[-1]) + 1
+    return ' '.join(words)
+
+
+def make_turn(n: int):
+    '''
+    n-th exchange of a thread: question, answer, tool call + result on every third one
+    '''
+    event_ts = f'{1700000000 + n * 10}.000100'
+    reply_ts = f'{1700000000 + n * 10 + 5}.000100'
+    turns = []
+    if n % 3 == 2:
+        call = {'id': f'call_{n}', 'type': 'function',
+                'function': {'name': 'find_birthday', 'arguments': '{"name": "%s"}' % text(12)}}
+        turns = [
+            {'role': 'assistant', 'content': None, 'tool_calls': [call]},
+            {'role': 'tool', 'tool_call_id': f'call_{n}', 'name': 'find_birthday', 'content': text(3000)},
+        ]
+    return event_ts, text(300), turns, reply_ts, text(1500)
+
+
+def write_items(ddb, table, ch, ts, turn, writer):
+    event_ts, question, turns, reply_ts, answer = turn
+    save_thread_message(ddb, table, ch, ts, event_ts, 'user', question)
+    save_tool_turns(ddb, table, ch, ts, event_ts, turns, TOOL_OUTPUT_TOKENS)
+    queue_thread_message(writer, ddb, table, ch, ts, reply_ts, 'assistant', answer)
+    writer.flush()
+
+
+def write_packed(ddb, table, ch, ts, turn, writer):
+    event_ts, question, turns, reply_ts, answer = turn
+    records = [to_message_record(event_ts, 'user', question)] + to_tool_turn_records(
+        event_ts, turns, TOOL_OUTPUT_TOKENS) + [to_message_record(reply_ts, 'assistant', answer)]
+    append_doc_messages(ddb, table, ch, ts, records, DOC_MAX_TOKENS)
+
+
+def read_items(ddb, table, ch, ts):
+    return fetch_thread_messages(ddb, table, ch, ts, TOKEN_BUDGET, '0', TOOL_TURN_RETENTION)
+
+
+def read_packed(ddb, table, ch, ts):
+    return fetch_doc_messages(ddb, table, ch, ts, TOKEN_BUDGET, TOOL_TURN_RETENTION)
+
+
+LAYOUTS = {
+    'items': (write_items, read_items),
+    'packed': (write_packed, read_packed),
+}
+
+
+def measure(ddb, meter, fn, rtt_ms, repeat):
+    '''
+    Per call: capacity units, round trips, latency p50 (ms)
+    '''
+    latencies = []
+    for _ in range(repeat):
+        meter.reset()
+        start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - start) * 1000 + meter.calls * rtt_ms)
+    return meter.rcu + meter.wcu, meter.calls, statistics.median(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--table', help='real DDB table (ddb_chat_completion key schema)')
+    parser.add_argument('--rtt-ms', type=float, default=6.0,
+                        help='latency added per DDB call in memory mode (default 6)')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    args = parser.parse_args()
+
+    if args.table:
+        import boto3
+        ddb = boto3.client('dynamodb')
+        meter, table, rtt_ms = CapacityMeter(ddb), args.table, 0.0
+    else:
+        ddb = meter = MemoryTable()
+        table, rtt_ms = 'memory', args.rtt_ms
+
+    run_id = f'bench-{int(time.time())}'
+    print(f"{'turns':>6}{'layout':>8}{'read CU':>9}{'calls':>6}{'ms':>8}"
+          f"{'write CU':>10}{'calls':>6}{'ms':>8}{'history':>9}")
+    for n_turns in THREAD_TURNS:
+        thread = [make_turn(n) for n in range(n_turns)]
+        for layout, (write, read) in LAYOUTS.items():
+            ch, ts = f'{run_id}-{layout}', str(n_turns)
+            writer = BatchWriter()
+            for turn in thread[:-1]:
+                write(ddb, table, ch, ts, turn, writer)
+
+            read_cu, read_calls, read_ms = measure(
+                ddb, meter, lambda: read(ddb, table, ch, ts), rtt_ms, args.repeat)
+            history = read(ddb, table, ch, ts)
+
+            # last exchange written once, after its history was read (as in the handler)
+            def write_last():
+                write(ddb, table, ch, ts, thread[-1], writer)
+            read(ddb, table, ch, ts)
+            write_cu, write_calls, write_ms = measure(ddb, meter, write_last, rtt_ms, 1)
+
+            print(f'{n_turns:>6}{layout:>8}{read_cu:>9.1f}{read_calls:>6}{read_ms:>8.2f}'
+                  f'{write_cu:>10.1f}{write_calls:>6}{write_ms:>8.2f}{len(history):>9}')
+
+    if not args.table:
+        doc = load_thread_doc(ddb, table, f'{run_id}-packed', str(THREAD_TURNS[-1]))
+        print(f"\npacked doc of {THREAD_TURNS[-1]} turns: v{doc['version']}, "
+              f"{len(doc['doc']['messages'])} messages kept (rolling {DOC_MAX_TOKENS} tokens)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+resource "aws_dynamodb_table" "asst_config" {
+  /*
+  Stores the resolved OpenAI Assistant for each assistant name
+  in order to skip assistant list / update calls on every message
+
+  contains key field: asst_name
+  and non-key field: asst_id, asst_json, config_hash
+  config_hash is over (instructions, model, tools), assistant is only updated when it changes
+  */
+
+  billing_mode = "PAY_PER_REQUEST"
+  name         = local.msg_handler.ddb_asst_config
+  hash_key     = "asst_name"
+
+  attribute {
+    name = "asst_name"
+    type = "S"
+  }
+}
@@ -5,6 +5,8 @@ resource "aws_dynamodb_table" "asst_thread" {
   
   contains key field: slack_channel_id, slack_thread_ts
   and non-key field: asst_thread_id
+  or last_response_id (responses api handler, previous_response_id of the next message)
+  and thread lease (one active assistant run per thread): lease_owner, lease_expire_at, pending_msgs
 
   TBD: consider again the choice of key, and data type for thread ts be N?
   */
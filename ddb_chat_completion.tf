@@ -6,7 +6,14 @@ resource "aws_dynamodb_table" "chat_completion" {
   Not needed for assistant api
   
   contains key field: slack_channel_id_thread_ts, slack_event_ts
-  and non-key field : role, content
+  and non-key field : role, content, tokens
+
+  slack_event_ts is also
+  - #summary: rolling summary of older turns (summary, summarized_until)
+  - <slack_event_ts>#t<nn>: tool calls (tool_calls) / tool results (tool_call_id, name)
+    made to answer the message, expire_at (TTL)
+  - #doc: packed layout (chat_history_layout = packed), the whole thread history as one
+    zlib-compressed json (doc), version, chunks; larger documents continue in #doc#<version>#<nn>
   */
 
   billing_mode = "PAY_PER_REQUEST"
@@ -23,4 +30,9 @@ resource "aws_dynamodb_table" "chat_completion" {
     name = "slack_event_ts"
     type = "S"
   }
+
+  ttl {
+    attribute_name = "expire_at"
+    enabled        = true
+  }
 }
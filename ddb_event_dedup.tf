@@ -0,0 +1,24 @@
+resource "aws_dynamodb_table" "event_dedup" {
+  /*
+  Stores Slack events already received / handled, in order to drop duplicate deliveries
+  (Slack event api retries, SQS at-least-once delivery)
+
+  contains key field: event_key, i.e. recv#<id> by receiver, handle#<id> by handler
+  id is client_msg_id of slack message if exist, else event_id
+  and non-key field: event_status (handler only), expire_at (TTL)
+  */
+
+  billing_mode = "PAY_PER_REQUEST"
+  name         = local.msg_receiver.ddb_event_dedup
+  hash_key     = "event_key"
+
+  attribute {
+    name = "event_key"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expire_at"
+    enabled        = true
+  }
+}
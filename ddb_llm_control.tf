@@ -0,0 +1,24 @@
+resource "aws_dynamodb_table" "llm_control" {
+  /*
+  Small control records shared by concurrent message handlers when calling LLM providers
+
+  contains key field: control_key
+  - balancer#<deployment name>: one map per azure openai deployment with its last seen
+    remaining requests / tokens and 429 cooldown
+  - ratelimit#<model>#<minute>: requests, tokens charged in the minute window, expire_at (TTL)
+  */
+
+  billing_mode = "PAY_PER_REQUEST"
+  name         = local.msg_handler.ddb_llm_control
+  hash_key     = "control_key"
+
+  attribute {
+    name = "control_key"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expire_at"
+    enabled        = true
+  }
+}
@@ -39,8 +39,12 @@ data "aws_iam_policy_document" "lmbd_role_policy_msg_handler" {
     actions = [
       "dynamodb:DescribeTable",
       "dynamodb:GetItem",
+      "dynamodb:PutItem",
       "dynamodb:UpdateItem",
       "dynamodb:Query",
+      "dynamodb:BatchWriteItem",
+      "dynamodb:BatchGetItem",
+      "dynamodb:DeleteItem",
     ]
     resources = [
       aws_dynamodb_table.asst_thread.arn,
@@ -48,6 +52,53 @@ data "aws_iam_policy_document" "lmbd_role_policy_msg_handler" {
     ]
   }
 
+  statement {
+    sid    = "AllowReadWriteAsstConfigDDB"
+    effect = "Allow"
+    actions = [
+      "dynamodb:GetItem",
+      "dynamodb:PutItem",
+    ]
+    resources = [
+      aws_dynamodb_table.asst_config.arn
+    ]
+  }
+
+  statement {
+    sid    = "AllowReadWriteLlmControlDDB"
+    effect = "Allow"
+    actions = [
+      "dynamodb:GetItem",
+      "dynamodb:UpdateItem",
+    ]
+    resources = [
+      aws_dynamodb_table.llm_control.arn
+    ]
+  }
+
+  statement {
+    sid    = "AllowReadWriteEventDedupDDB"
+    effect = "Allow"
+    actions = [
+      "dynamodb:PutItem",
+      "dynamodb:UpdateItem",
+      "dynamodb:DeleteItem",
+    ]
+    resources = [
+      aws_dynamodb_table.event_dedup.arn
+    ]
+  }
+
+  statement {
+    sid       = "AllowReadClaimCheckS3"
+    effect    = "Allow"
+    actions   = ["s3:GetObject"]
+    resources = [
+      "${aws_s3_bucket.claim_check.arn}/events/*",
+      "${aws_s3_bucket.claim_check.arn}/raw/*",
+    ]
+  }
+
   statement {
     sid    = "AllowAssumeCrossAccountRole"
     effect = "Allow"
@@ -128,8 +179,21 @@ resource "aws_lambda_function" "msg_handler" {
     variables = {
       sqs_url                     = aws_sqs_queue.msg_receiver.url
       slack_oauth_token           = local.slack_oauth_token
+      slack_stream_reply          = tostring(var.slack_stream_reply)
       ddb_asst_thread             = local.msg_handler.ddb_asst_thread
       ddb_chat_completion         = local.msg_handler.ddb_chat_completion
+      ddb_asst_config             = local.msg_handler.ddb_asst_config
+      ddb_event_dedup             = local.msg_receiver.ddb_event_dedup
+      ddb_llm_control             = local.msg_handler.ddb_llm_control
+      asst_thread_lease_sec       = local.msg_handler.lambda_timeout
+      chat_history_token_budget   = var.chat_history_token_budget
+      chat_summary_threshold      = var.chat_summary_threshold
+      chat_history_layout         = var.chat_history_layout
+      response_cache_channels     = var.response_cache_channels
+      llm_router                  = var.llm_router
+      provider_pool_order         = var.provider_pool_order
+      llm_rpm_limit               = var.llm_rate_limits.rpm
+      llm_tpm_limit               = var.llm_rate_limits.tpm
       openai_api_key              = var.openai_handler_vars.api_key
       openai_gpt_model            = var.openai_handler_vars.model
       openai_asst_instructions    = var.openai_handler_vars.asst_instructions
@@ -139,6 +203,7 @@ resource "aws_lambda_function" "msg_handler" {
       az_openai_deployment_name   = var.az_openai_handler_vars.deployment_name
       az_openai_asst_instructions = var.az_openai_handler_vars.asst_instructions
       az_data_source              = jsonencode(var.az_openai_handler_vars.az_data_source)
+      az_openai_deployments       = jsonencode(var.az_openai_deployments)
       llm_tools_vars              = jsonencode(var.llm_tools_vars)
     }
   }
@@ -155,6 +220,16 @@ resource "aws_lambda_event_source_mapping" "msg_handler" {
   event_source_arn = aws_sqs_queue.msg_receiver.arn
   function_name    = aws_lambda_function.msg_handler.arn
   enabled          = true
+
+  # Handler returns batchItemFailures, successes are deleted in bulk, only failures redelivered
+  function_response_types            = ["ReportBatchItemFailures"]
+  batch_size                         = var.msg_handler_sqs_batch.batch_size
+  # Batching window is not supported on FIFO queue
+  maximum_batching_window_in_seconds = var.sqs_fifo ? null : var.msg_handler_sqs_batch.batching_window_seconds
+
+  scaling_config {
+    maximum_concurrency = var.msg_handler_sqs_batch.maximum_concurrency
+  }
 }
 
 # Allow SQS to invoke lambda
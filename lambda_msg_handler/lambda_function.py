@@ -7,7 +7,14 @@ from slack_sdk import WebClient
 # from msg_handlers.sample_handler import handler
 # from msg_handlers.tag_user_handler import handler
 # from msg_handlers.az_openai_handler import handler_via_chat_completion as handler
+# from msg_handlers.openai_handler import handler_via_chat_completion as handler
+# from msg_handlers.openai_handler import handler_via_responses as handler
 from msg_handlers.openai_handler import handler_via_assistant as handler
+from msg_handlers.sqs_related.utils import (
+    delete_messages, get_max_concurrency, get_thread_key, process_concurrently,
+    load_slack_event, decode_body)
+from msg_handlers.ddb_related.utils import (
+    get_dedup_key, claim_event, complete_event, release_event, write_behind)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -19,27 +26,87 @@ slack = WebClient(token=slack_oauth_token)
 sqs = boto3.client('sqs')
 sqs_url = os.environ['sqs_url']
 
+# Claim check, oversized slack events are fetched from S3
+s3 = boto3.client('s3')
+
+# Event source mapping configured with ReportBatchItemFailures
+sqs_report_batch_item_failures = os.environ.get(
+    'sqs_report_batch_item_failures', 'true').lower() == 'true'
+
+# Records of different slack threads are handled concurrently
+max_concurrency = get_max_concurrency()
+
+# Idempotency on slack event, see ddb_event_dedup.tf
+ddb = boto3.client('dynamodb')
+ddb_event_dedup_table = os.environ.get('ddb_event_dedup', '')
+event_dedup_ttl = int(os.environ.get('event_dedup_ttl', '86400'))
+event_in_progress_ttl = int(os.environ.get('event_in_progress_ttl', '600'))
+
+
+def handle_event(body):
+    # Skip duplicate delivery of same slack event
+    dedup_key = get_dedup_key(body)
+    if dedup_key:
+        dedup_key = f'handle#{dedup_key}'
+        if not claim_event(ddb, ddb_event_dedup_table, dedup_key, event_in_progress_ttl):
+            logger.info(f"Skip duplicate slack event: {dedup_key}")
+            return
+
+    try:
+        handler(body, slack_client=slack)
+    except Exception:
+        if dedup_key:
+            release_event(ddb, ddb_event_dedup_table, dedup_key)
+        raise
+
+    if dedup_key:
+        complete_event(ddb, ddb_event_dedup_table, dedup_key, event_dedup_ttl)
+    return
+
 
 def lambda_handler(event, context):
+    failed_msg_ids = []
+    receipt_handles = {}
+    slack_events = []
+
     for sqs_msg in event['Records']:
         msg_id = sqs_msg['messageId']
-        sqs_receipt_handle = sqs_msg['receiptHandle']
+        receipt_handles[msg_id] = sqs_msg['receiptHandle']
 
         # Get sqs message body (i.e. slack event)
-        json_body = sqs_msg["body"]
-        body = json.loads(json_body)
-        logger.debug(json.dumps(body, indent=2))
-
-        # Message handling
         try:
-            handler(body, slack_client=slack)
+            logger.debug(sqs_msg["body"])
+            body = load_slack_event(decode_body(sqs_msg), s3)
+            slack_events.append((msg_id, body))
         except Exception as error:
-            logger.error(f"Error at event handling: {str(error)}")
-            # TBD another queue to capture failed message
+            logger.error(f"Error at event parsing {msg_id}: {str(error)}")
+            failed_msg_ids.append(msg_id)
+
+    # Message handling, in order within each slack thread
+    try:
+        failed_msg_ids += process_concurrently(
+            slack_events, handle_event, get_thread_key, max_concurrency)
+    finally:
+        # write-behind of handlers (e.g. replies saved to thread history), before the container freezes
+        write_behind.flush()
+
+    if sqs_report_batch_item_failures:
+        # Event source mapping deletes the successes,
+        # only the failures are redelivered (and moved to DLQ after max receive count)
+        logger.info(f"Failed sqs messages: {failed_msg_ids}")
+        return {
+            'batchItemFailures': [
+                {'itemIdentifier': msg_id} for msg_id in failed_msg_ids
+            ]
+        }
 
-        # Delete message from SQS
-        logger.info("Delete from sqs")
-        sqs.delete_message(QueueUrl=sqs_url, ReceiptHandle=sqs_receipt_handle)
+    # Without partial batch response, a failed invocation redelivers the whole batch
+    # Hence delete the successes explicitly before failing the invocation
+    if failed_msg_ids:
+        delete_messages(sqs, sqs_url, [
+            h for msg_id, h in receipt_handles.items() if msg_id not in failed_msg_ids
+        ])
+        raise RuntimeError(f"Failed sqs messages: {failed_msg_ids}")
 
     return {
         'statusCode': 200,
@@ -0,0 +1,305 @@
+import json
+import time
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import botocore
+
+from msg_handlers.openai_related.context_budget import (
+    count_message_tokens, count_tokens, fill_budget, truncate_tokens)
+from msg_handlers.ddb_related.utils import BatchWriter
+
+logger = logging.getLogger()
+
+# Items read per DDB query page, pages are read until the token budget is used up
+QUERY_PAGE_SIZE = 25
+
+# Tool turns of a message are stored under <slack_event_ts>#t<nn>, right after the message
+TOOL_TURN_SEP = '#t'
+
+# Items written together in one transaction (DDB limit)
+TRANSACT_MAX_ITEMS = 100
+
+# Writes overlapped with the history query, threads kept across warm invocations
+_write_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='ddb-write')
+
+
+def iter_thread_items(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        after_ts: str = '0', newest_first: bool = True) -> Iterator[dict]:
+    '''
+    Messages in the thread stored in DDB ddb_chat_completion, with slack_event_ts after after_ts,
+    read page by page as iterated. Non-message items (sort key '#...', e.g. summary) are excluded.
+    Token count is stored per message at save time, counted here only for older items without it
+
+    Yield:
+        dict of slack_event_ts, role, content, tokens
+        (+ tool_calls json / tool_call_id, name for tool turns)
+    '''
+    query = dict(
+        TableName=ddb_table,
+        Limit=QUERY_PAGE_SIZE,
+        ScanIndexForward=not newest_first,
+        KeyConditionExpression='slack_channel_id_thread_ts = :slack_channel_id_thread_ts AND slack_event_ts > :after_ts',
+        ExpressionAttributeValues={
+            ':slack_channel_id_thread_ts': {
+                'S': f'{slack_channel_id};{slack_thread_ts}',
+            },
+            ':after_ts': {'S': after_ts},
+        },
+    )
+    while True:
+        resp = ddb_client.query(**query)
+        for i in resp.get('Items', []):
+            m = {
+                'slack_event_ts': i['slack_event_ts']['S'],
+                'role': i['role']['S'],
+                'content': i['content']['S'],
+            }
+            for k in ('tool_calls', 'tool_call_id', 'name'):
+                if k in i:
+                    m[k] = i[k]['S']
+            m['tokens'] = int(i['tokens']['N']) if 'tokens' in i else count_message_tokens(m)
+            yield m
+        if 'LastEvaluatedKey' not in resp:
+            break
+        query['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+
+def is_tool_turn(slack_event_ts: str) -> bool:
+    return TOOL_TURN_SEP in slack_event_ts
+
+
+def to_chat_message(m: dict) -> dict:
+    '''
+    Stored item back to chat completion message, incl. tool calls / tool results
+    '''
+    if 'tool_calls' in m:
+        return {'role': m['role'], 'content': m['content'] or None,
+                'tool_calls': json.loads(m['tool_calls'])}
+    if 'tool_call_id' in m:
+        return {'role': m['role'], 'tool_call_id': m['tool_call_id'],
+                'name': m.get('name', ''), 'content': m['content']}
+    return {'role': m['role'], 'content': m['content']}
+
+
+def drop_partial_tool_turns(messages: List[dict]) -> List[dict]:
+    '''
+    Tool results must follow the assistant message with their tool calls, and all calls need
+    a result. Drop tool messages cut apart by token budget / summary / retention
+    '''
+    kept, i = [], 0
+    while i < len(messages):
+        m = messages[i]
+        if m.get('tool_calls'):
+            call_ids = {tc['id'] for tc in m['tool_calls']}
+            results = []
+            while i + 1 < len(messages) and messages[i + 1]['role'] == 'tool':
+                i += 1
+                results.append(messages[i])
+            if {r['tool_call_id'] for r in results} == call_ids:
+                kept += [m] + results
+        elif m['role'] != 'tool':
+            kept.append(m)
+        i += 1
+    return kept
+
+
+def select_messages(
+        records_newest_first: Iterable[dict], token_budget: int, tool_turn_retention: int = 0,
+        exclude_ts: Optional[str] = None) -> List[dict]:
+    '''
+    Stored messages (newest first) to send as history, up to token budget
+    tool_turn_retention: tool turns are replayed for the latest n user messages only
+    exclude_ts: message left out, e.g. the current one being saved concurrently
+
+    Return:
+        chat completion messages in chronological order
+    '''
+    candidates, used, user_msgs = [], 0, 0
+    for m in records_newest_first:
+        if m['slack_event_ts'] == exclude_ts:
+            continue
+        if is_tool_turn(m['slack_event_ts']):
+            # newest first: tool turns come before the user message they answer
+            if user_msgs >= tool_turn_retention:
+                continue
+        elif m['role'] == 'user':
+            user_msgs += 1
+        candidates.append(m)
+        used += m['tokens']
+        if used > token_budget:
+            break
+    logger.info(f'History candidates: {len(candidates)}')
+
+    return drop_partial_tool_turns([
+        to_chat_message(m) for m in fill_budget(candidates, token_budget)
+    ])
+
+
+def fetch_thread_messages(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        token_budget: int, after_ts: str = '0', tool_turn_retention: int = 0,
+        exclude_ts: Optional[str] = None) -> List[dict]:
+    '''
+    Fetch messages in the thread stored in DDB, newest first, up to token budget
+    after_ts: only messages after it, e.g. the ones not yet compacted into thread summary
+    (see select_messages for tool_turn_retention, exclude_ts)
+
+    Return:
+        messages in chronological order
+    '''
+    try:
+        return select_messages(
+            iter_thread_items(ddb_client, ddb_table, slack_channel_id, slack_thread_ts, after_ts),
+            token_budget, tool_turn_retention, exclude_ts)
+    except (botocore.exceptions.ClientError, KeyError) as exNotFound:
+        logger.info(f'No existing threads: {exNotFound}')
+        return []
+
+
+def to_message_record(slack_event_ts: str, role: str, content: str) -> dict:
+    '''
+    Stored form of a message, as yielded by iter_thread_items
+    '''
+    return {
+        'slack_event_ts': slack_event_ts,
+        'role': role,
+        'content': content,
+        'tokens': count_message_tokens({'role': role, 'content': content}),
+    }
+
+
+def to_tool_turn_records(slack_event_ts: str, turns: List[dict], max_output_tokens: int) -> List[dict]:
+    '''
+    Stored form of tool calls / tool results of the answer to slack_event_ts,
+    under <slack_event_ts>#t<nn>, outputs truncated to max_output_tokens
+    '''
+    records = []
+    for n, turn in enumerate(turns):
+        record = {
+            'slack_event_ts': f'{slack_event_ts}{TOOL_TURN_SEP}{n:02d}',
+            'role': turn['role'],
+        }
+        if turn.get('tool_calls'):
+            tool_calls = json.dumps([
+                tc.model_dump() if hasattr(tc, 'model_dump') else tc for tc in turn['tool_calls']
+            ])
+            content = turn.get('content') or ''
+            tokens = count_tokens(tool_calls) + count_tokens(content)
+            record['tool_calls'] = tool_calls
+        else:
+            content = truncate_tokens(str(turn.get('content') or ''), max_output_tokens)
+            tokens = count_tokens(content)
+            record['tool_call_id'] = turn['tool_call_id']
+            record['name'] = turn.get('name', '')
+        record['content'] = content
+        record['tokens'] = tokens + count_message_tokens({})
+        records.append(record)
+    return records
+
+
+def to_ddb_item(slack_channel_id: str, slack_thread_ts: str, record: dict) -> dict:
+    item = {
+        'slack_channel_id_thread_ts': {'S': f'{slack_channel_id};{slack_thread_ts}'},
+        'slack_event_ts': {'S': record['slack_event_ts']},
+        'tokens': {'N': str(record['tokens'])},
+    }
+    for k in ('role', 'content', 'tool_calls', 'tool_call_id', 'name'):
+        if k in record:
+            item[k] = {'S': record[k]}
+    return item
+
+
+def save_tool_turns(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        slack_event_ts: str, turns: List[dict], max_output_tokens: int, ttl_sec: int = 0):
+    '''
+    Persist tool calls (assistant messages with tool_calls) and tool results of the answer
+    to slack_event_ts, under <slack_event_ts>#t<nn>. Outputs are truncated to max_output_tokens.
+    Written in one transaction, a replay never sees half of the tool turns.
+    ttl_sec: tool turns expire (DDB TTL on expire_at) after it, 0 to keep
+    '''
+    if not turns:
+        return
+    if len(turns) > TRANSACT_MAX_ITEMS:
+        logger.warning(f'Tool turns not saved, {len(turns)} over {TRANSACT_MAX_ITEMS} items')
+        return
+    items = []
+    for record in to_tool_turn_records(slack_event_ts, turns, max_output_tokens):
+        item = to_ddb_item(slack_channel_id, slack_thread_ts, record)
+        if ttl_sec:
+            item['expire_at'] = {'N': str(int(time.time()) + ttl_sec)}
+        items.append({'Put': {'TableName': ddb_table, 'Item': item}})
+    try:
+        ddb_client.transact_write_items(TransactItems=items)
+        logger.info(
+            f'DDB {len(items)} tool turns saved: {slack_channel_id};{slack_thread_ts}')
+    except botocore.exceptions.ClientError as ex:
+        logger.error(f'DDB tool turns fail to save: {ex}')
+    return
+
+
+def save_thread_message(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        slack_event_ts: str, role: str, content: str):
+    ddb_search_key = {
+        'slack_channel_id_thread_ts': {'S': f'{slack_channel_id};{slack_thread_ts}'},
+        'slack_event_ts': {'S': slack_event_ts},
+    }
+    tokens = count_message_tokens({'role': role, 'content': content})
+    try:
+        ddb_client.update_item(
+            TableName=ddb_table,
+            Key=ddb_search_key,
+            UpdateExpression='SET #r=:role, content=:content, tokens=:tokens',
+            ExpressionAttributeValues={
+                ':role': {'S': role},
+                ':content': {'S': content},
+                ':tokens': {'N': str(tokens)},
+            },
+            ExpressionAttributeNames={
+                "#r": "role"
+            }
+        )
+        logger.info(
+            f'DDB record created for {role}: {slack_channel_id};{slack_thread_ts}')
+    except botocore.exceptions.ClientError as ex:
+        logger.error(f'DDB record fail to create: {ex}')
+        pass
+    return
+
+
+def save_thread_message_async(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        slack_event_ts: str, role: str, content: str) -> Future:
+    '''
+    save_thread_message in background, e.g. while the thread history is queried
+    '''
+    return _write_executor.submit(
+        save_thread_message, ddb_client, ddb_table, slack_channel_id, slack_thread_ts,
+        slack_event_ts, role, content)
+
+
+def queue_thread_message(
+        writer: BatchWriter, ddb_client, ddb_table: str, slack_channel_id: str,
+        slack_thread_ts: str, slack_event_ts: str, role: str, content: str):
+    '''
+    Same item as save_thread_message, written behind via the batch writer
+    '''
+    writer.put(ddb_client, ddb_table, to_ddb_item(
+        slack_channel_id, slack_thread_ts, to_message_record(slack_event_ts, role, content)))
+    return
+
+
+def flush_thread_messages(
+        writer: BatchWriter, ddb_table: str, slack_channel_id: str, slack_thread_ts: str):
+    '''
+    Flush the batch writer if it holds messages of the thread, before its history is read
+    (e.g. reply to an earlier message of the thread in the same invocation)
+    '''
+    if writer.has_pending(ddb_table, 'slack_channel_id_thread_ts',
+                          {'S': f'{slack_channel_id};{slack_thread_ts}'}):
+        writer.flush()
+    return
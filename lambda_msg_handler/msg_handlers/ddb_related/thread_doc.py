@@ -0,0 +1,306 @@
+import json
+import zlib
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+import botocore
+
+from msg_handlers.ddb_related.utils import LRUCache, BatchWriter
+from msg_handlers.ddb_related.chat_history import select_messages
+
+logger = logging.getLogger()
+
+# Packed layout: one item per slack thread in ddb_chat_completion (sort key '#doc'),
+# holding zlib-compressed json {messages, refs} and a version for optimistic concurrency
+DOC_SORT_KEY = '#doc'
+
+# Compressed bytes kept in one item, the rest spills to overflow items '#doc#<version>#<nn>'
+# (DDB item limit 400KB incl. attribute names, headroom kept)
+DOC_CHUNK_BYTES = 350 * 1024
+
+# Overflow items written in the same transaction (4MB per transaction)
+DOC_MAX_CHUNKS = 10
+
+# Read-modify-write attempts when another worker updated the document meanwhile
+DOC_SAVE_ATTEMPTS = 5
+
+# Reads when overflow items of the version read are replaced meanwhile
+DOC_LOAD_ATTEMPTS = 3
+
+# Background writes (e.g. user message while the history is read), threads kept across warm invocations
+_write_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='doc-write')
+
+# Last document record seen per thread, starting point of the next update (version checked on save)
+_doc_records = LRUCache(maxsize=128)
+
+
+def empty_doc() -> dict:
+    '''
+    messages: stored form of chat_history (slack_event_ts, role, content, tokens, ...), in order
+    refs: mapping ids of the thread, e.g. last_response_id (the assistants thread mapping
+    stays in ddb_asst_thread, next to the thread lease)
+    pending_inputs: messages to send with the next response (see add_doc_input)
+    '''
+    return {'messages': [], 'refs': {}, 'pending_inputs': []}
+
+
+def encode_doc(doc: dict) -> bytes:
+    return zlib.compress(json.dumps(doc, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_doc(data: bytes) -> dict:
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+def _doc_key(slack_channel_id: str, slack_thread_ts: str, sort_key: str = DOC_SORT_KEY) -> dict:
+    return {
+        'slack_channel_id_thread_ts': {'S': f'{slack_channel_id};{slack_thread_ts}'},
+        'slack_event_ts': {'S': sort_key},
+    }
+
+
+def _chunk_sort_key(version: int, n: int) -> str:
+    return f'{DOC_SORT_KEY}#{version}#{n:02d}'
+
+
+def load_thread_doc(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        consistent: bool = False) -> dict:
+    '''
+    Read the thread document, one GetItem (+ one BatchGetItem if it has overflow items)
+
+    Return:
+        record of version (0 for a new thread), chunks (overflow items), doc
+    '''
+    cache_key = f'{slack_channel_id};{slack_thread_ts}'
+    for _ in range(DOC_LOAD_ATTEMPTS):
+        try:
+            item = ddb_client.get_item(
+                TableName=ddb_table,
+                Key=_doc_key(slack_channel_id, slack_thread_ts),
+                ConsistentRead=consistent,
+            ).get('Item')
+        except botocore.exceptions.ClientError as ex:
+            logger.warning(f'DDB thread doc fail to load: {ex}')
+            item = None
+        if not item:
+            return {'version': 0, 'chunks': 0, 'doc': empty_doc()}
+
+        version, chunks = int(item['version']['N']), int(item['chunks']['N'])
+        data = [item['doc']['B']]
+        if chunks:
+            keys = [
+                _doc_key(slack_channel_id, slack_thread_ts, _chunk_sort_key(version, n))
+                for n in range(1, chunks + 1)
+            ]
+            resp = ddb_client.batch_get_item(RequestItems={
+                ddb_table: {'Keys': keys, 'ConsistentRead': consistent}})
+            found = {
+                i['slack_event_ts']['S']: i['doc']['B'] for i in resp['Responses'].get(ddb_table, [])
+            }
+            if len(found) < chunks:
+                # superseded by a newer version meanwhile
+                consistent = True
+                continue
+            data += [found[k['slack_event_ts']['S']] for k in keys]
+
+        record = {'version': version, 'chunks': chunks, 'doc': decode_doc(b''.join(data))}
+        _doc_records.set(cache_key, record)
+        logger.info(
+            f'DDB thread doc v{version}: {len(record["doc"]["messages"])} messages, {chunks} overflow')
+        return record
+    raise RuntimeError(f'Thread doc changing while read: {cache_key}')
+
+
+def save_thread_doc(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        record: dict, doc: dict) -> Optional[dict]:
+    '''
+    Write doc as the next version of record, only if the stored version is still record's
+    Small documents take one conditional PutItem. Larger ones are written in one transaction
+    with their overflow items, and the overflow items of the previous version are deleted
+
+    Return:
+        new record, None if the document was updated by another worker meanwhile
+    '''
+    data = encode_doc(doc)
+    chunks = [data[n:n + DOC_CHUNK_BYTES] for n in range(0, len(data), DOC_CHUNK_BYTES)]
+    if len(chunks) > DOC_MAX_CHUNKS:
+        raise ValueError(f'Thread doc of {len(data)} bytes over {DOC_MAX_CHUNKS} items')
+    version = record['version'] + 1
+    main = {
+        **_doc_key(slack_channel_id, slack_thread_ts),
+        'version': {'N': str(version)},
+        'chunks': {'N': str(len(chunks) - 1)},
+        'doc': {'B': chunks[0]},
+    }
+    condition = dict(
+        ConditionExpression='version = :expected',
+        ExpressionAttributeValues={':expected': {'N': str(record['version'])}},
+    ) if record['version'] else dict(ConditionExpression='attribute_not_exists(version)')
+
+    try:
+        if len(chunks) == 1 and not record['chunks']:
+            ddb_client.put_item(TableName=ddb_table, Item=main, **condition)
+        else:
+            ddb_client.transact_write_items(TransactItems=[
+                {'Put': {'TableName': ddb_table, 'Item': main, **condition}},
+            ] + [
+                {'Put': {'TableName': ddb_table, 'Item': {
+                    **_doc_key(slack_channel_id, slack_thread_ts, _chunk_sort_key(version, n)),
+                    'doc': {'B': chunk},
+                }}}
+                for n, chunk in enumerate(chunks[1:], start=1)
+            ] + [
+                {'Delete': {'TableName': ddb_table, 'Key': _doc_key(
+                    slack_channel_id, slack_thread_ts, _chunk_sort_key(record['version'], n))}}
+                for n in range(1, record['chunks'] + 1)
+            ])
+    except botocore.exceptions.ClientError as ex:
+        if ex.response['Error']['Code'] in ('ConditionalCheckFailedException', 'TransactionCanceledException'):
+            logger.info(f'DDB thread doc v{record["version"]} outdated: {ex}')
+            return None
+        raise
+
+    new_record = {'version': version, 'chunks': len(chunks) - 1, 'doc': doc}
+    _doc_records.set(f'{slack_channel_id};{slack_thread_ts}', new_record)
+    logger.info(f'DDB thread doc v{version} saved: {len(data)} bytes, {len(chunks) - 1} overflow')
+    return new_record
+
+
+def trim_doc(doc: dict, max_tokens: int):
+    '''
+    Rolling history: drop the oldest messages past max_tokens (0 to keep all)
+    '''
+    if not max_tokens:
+        return
+    total = sum(m['tokens'] for m in doc['messages'])
+    start = 0
+    while total > max_tokens and start < len(doc['messages']):
+        total -= doc['messages'][start]['tokens']
+        start += 1
+    doc['messages'] = doc['messages'][start:]
+    return
+
+
+def update_thread_doc(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        mutate: Callable[[dict], Optional[bool]], max_tokens: int = 0) -> Optional[dict]:
+    '''
+    Optimistic read-modify-write: mutate a copy of the last document seen,
+    save it if nobody else did meanwhile, otherwise re-read and re-apply
+    mutate returns False for no change, nothing is written then
+
+    Return:
+        doc saved, None if not saved after DOC_SAVE_ATTEMPTS
+    '''
+    record = _doc_records.get(f'{slack_channel_id};{slack_thread_ts}') or load_thread_doc(
+        ddb_client, ddb_table, slack_channel_id, slack_thread_ts, consistent=True)
+    for _ in range(DOC_SAVE_ATTEMPTS):
+        doc = json.loads(json.dumps(record['doc']))
+        if mutate(doc) is False:
+            return doc
+        trim_doc(doc, max_tokens)
+        saved = save_thread_doc(
+            ddb_client, ddb_table, slack_channel_id, slack_thread_ts, record, doc)
+        if saved:
+            return saved['doc']
+        record = load_thread_doc(
+            ddb_client, ddb_table, slack_channel_id, slack_thread_ts, consistent=True)
+    logger.error(f'DDB thread doc not saved after {DOC_SAVE_ATTEMPTS} attempts')
+    return None
+
+
+def append_doc_messages(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        records: List[dict], max_tokens: int = 0) -> Optional[dict]:
+    '''
+    Add messages (stored form, see chat_history.to_message_record) to the thread document,
+    in slack_event_ts order as in the items layout. Redelivered messages replace their copy
+    '''
+    def mutate(doc):
+        new = {r['slack_event_ts']: r for r in records}
+        doc['messages'] = sorted(
+            [m for m in doc['messages'] if m['slack_event_ts'] not in new] + list(new.values()),
+            key=lambda m: m['slack_event_ts'])
+    return update_thread_doc(
+        ddb_client, ddb_table, slack_channel_id, slack_thread_ts, mutate, max_tokens)
+
+
+def append_doc_messages_async(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        records: List[dict], max_tokens: int = 0) -> Future:
+    '''
+    append_doc_messages in background, e.g. while the thread history is queried
+    '''
+    return _write_executor.submit(
+        append_doc_messages, ddb_client, ddb_table, slack_channel_id, slack_thread_ts,
+        records, max_tokens)
+
+
+def queue_doc_messages(
+        writer: BatchWriter, ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        records: List[dict], max_tokens: int = 0):
+    '''
+    Same as append_doc_messages, written behind via the batch writer (in background)
+    '''
+    writer.submit(
+        f'{ddb_table};{slack_channel_id};{slack_thread_ts}', append_doc_messages,
+        ddb_client, ddb_table, slack_channel_id, slack_thread_ts, records, max_tokens)
+    return
+
+
+def flush_doc_messages(writer: BatchWriter, ddb_table: str, slack_channel_id: str, slack_thread_ts: str):
+    '''
+    Wait for queued messages of the thread, before its document is read
+    '''
+    writer.wait(f'{ddb_table};{slack_channel_id};{slack_thread_ts}')
+    return
+
+
+def fetch_doc_messages(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        token_budget: int, tool_turn_retention: int = 0,
+        exclude_ts: Optional[str] = None) -> List[dict]:
+    '''
+    Same as chat_history.fetch_thread_messages, from the thread document (one GetItem)
+    '''
+    record = load_thread_doc(ddb_client, ddb_table, slack_channel_id, slack_thread_ts)
+    return select_messages(
+        reversed(record['doc']['messages']), token_budget, tool_turn_retention, exclude_ts)
+
+
+def set_doc_ref(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        name: str, value: str, expected: Optional[str] = None, sent_inputs: int = 0) -> bool:
+    '''
+    Set a mapping id of the thread (e.g. last_response_id), only from its expected value
+    sent_inputs: queued inputs (see add_doc_input) sent along, removed from the queue
+
+    Return:
+        False if the ref moved on concurrently
+    '''
+    moved = []
+
+    def mutate(doc):
+        moved.clear()
+        if doc['refs'].get(name) != expected:
+            moved.append(doc['refs'].get(name))
+            return False
+        doc['refs'][name] = value
+        doc['pending_inputs'] = doc.get('pending_inputs', [])[sent_inputs:]
+    saved = update_thread_doc(ddb_client, ddb_table, slack_channel_id, slack_thread_ts, mutate)
+    if moved:
+        logger.warning(f'Thread doc {name} moved on concurrently, {value} not kept')
+    return saved is not None and not moved
+
+
+def add_doc_input(ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str, text: str):
+    '''
+    Keep a message not answered (e.g. skipped acknowledgement) for the next response of the thread
+    '''
+    def mutate(doc):
+        doc.setdefault('pending_inputs', []).append(text)
+    update_thread_doc(ddb_client, ddb_table, slack_channel_id, slack_thread_ts, mutate)
+    return
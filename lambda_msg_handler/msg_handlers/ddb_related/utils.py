@@ -0,0 +1,403 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import botocore
+
+logger = logging.getLogger()
+
+
+class LRUCache:
+    '''
+    Small thread-safe LRU (optionally with TTL in sec), kept across warm invocations
+    '''
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None) -> Any:
+        with self._lock:
+            if key not in self._data:
+                return default
+            value, expire_at = self._data[key]
+            if expire_at is not None and expire_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expire_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expire_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return
+
+    def pop(self, key, default=None) -> Any:
+        with self._lock:
+            value = self._data.pop(key, (default, None))[0]
+        return value
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, self) is not self
+
+
+def get_dedup_key(slack_event: dict) -> Optional[str]:
+    '''
+    Same slack message can arrive as different events (e.g. message + app_mention),
+    which share client_msg_id but not event_id. Hence prefer client_msg_id.
+    '''
+    msg = slack_event.get('event', {})
+    return msg.get('client_msg_id') or slack_event.get('event_id')
+
+
+# Event keys already handled by this container
+_handled_events = LRUCache(maxsize=4096)
+
+
+def claim_event(ddb_client, ddb_table: str, event_key: str, in_progress_ttl: int) -> bool:
+    '''
+    Claim an event for handling, via DDB conditional put on event_key (see ddb_event_dedup.tf)
+    A claim still in progress past in_progress_ttl (e.g. crashed handler) can be taken over
+
+    Return:
+        False if the event is already handled / being handled, i.e. a duplicate
+    '''
+    if event_key in _handled_events:
+        logger.info(f'Duplicate event (in-process): {event_key}')
+        return False
+    if not ddb_table:
+        return True
+
+    now = int(time.time())
+    try:
+        ddb_client.put_item(
+            TableName=ddb_table,
+            Item={
+                'event_key': {'S': event_key},
+                'event_status': {'S': 'in_progress'},
+                'expire_at': {'N': str(now + in_progress_ttl)},
+            },
+            ConditionExpression='attribute_not_exists(event_key) OR (event_status = :in_progress AND expire_at < :now)',
+            ExpressionAttributeValues={
+                ':in_progress': {'S': 'in_progress'},
+                ':now': {'N': str(now)},
+            }
+        )
+    except botocore.exceptions.ClientError as ex:
+        if ex.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.info(f'Duplicate event (DDB): {event_key}')
+            return False
+        # fail open, a duplicate reply is better than a lost one
+        logger.warning(f'DDB event claim fail: {ex}')
+    return True
+
+
+def complete_event(ddb_client, ddb_table: str, event_key: str, done_ttl: int):
+    _handled_events.set(event_key, True)
+    if not ddb_table:
+        return
+    try:
+        ddb_client.update_item(
+            TableName=ddb_table,
+            Key={'event_key': {'S': event_key}},
+            UpdateExpression='SET event_status=:done, expire_at=:expire_at',
+            ExpressionAttributeValues={
+                ':done': {'S': 'done'},
+                ':expire_at': {'N': str(int(time.time()) + done_ttl)},
+            }
+        )
+    except botocore.exceptions.ClientError as ex:
+        logger.warning(f'DDB event complete fail: {ex}')
+    return
+
+
+def release_event(ddb_client, ddb_table: str, event_key: str):
+    '''
+    Release the claim of a failed event, so that its redelivery gets handled
+    '''
+    if not ddb_table:
+        return
+    try:
+        ddb_client.delete_item(
+            TableName=ddb_table,
+            Key={'event_key': {'S': event_key}},
+        )
+    except botocore.exceptions.ClientError as ex:
+        logger.warning(f'DDB event release fail: {ex}')
+    return
+
+
+def _thread_key(slack_channel_id: str, slack_thread_ts: str) -> dict:
+    return {
+        'slack_channel_id': {'S': slack_channel_id},
+        'slack_thread_ts': {'S': slack_thread_ts},
+    }
+
+
+def _to_pending(ddb_list: dict) -> List[dict]:
+    return [
+        {k: v['S'] for k, v in m['M'].items()} for m in ddb_list.get('L', [])
+    ]
+
+
+def acquire_thread_lease(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        owner: str, lease_sec: int) -> Tuple[bool, List[dict]]:
+    '''
+    Lease on slack thread in ddb_asst_thread (next to the asst_thread_id mapping),
+    so that only one assistant run is active on the thread at a time.
+    Messages left queued while no one holds the lease (e.g. holder crashed) are taken over,
+    they stay in the queue until answered (see release_thread_lease)
+
+    Return:
+        (acquired, pending messages taken over)
+    '''
+    now = int(time.time())
+    try:
+        resp = ddb_client.update_item(
+            TableName=ddb_table,
+            Key=_thread_key(slack_channel_id, slack_thread_ts),
+            UpdateExpression='SET lease_owner=:owner, lease_expire_at=:expire_at',
+            ConditionExpression='attribute_not_exists(lease_expire_at) OR lease_expire_at < :now',
+            ExpressionAttributeValues={
+                ':owner': {'S': owner},
+                ':expire_at': {'N': str(now + lease_sec)},
+                ':now': {'N': str(now)},
+            },
+            ReturnValues='ALL_NEW',
+        )
+    except botocore.exceptions.ClientError as ex:
+        if ex.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False, []
+        # fail open, run without lease
+        logger.warning(f'DDB thread lease fail: {ex}')
+        return True, []
+    pending = _to_pending(resp.get('Attributes', {}).get('pending_msgs', {}))
+    logger.info(f'Thread lease acquired: {slack_channel_id};{slack_thread_ts}, pending {len(pending)}')
+    return True, pending
+
+
+def queue_thread_message(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str, msg: dict) -> bool:
+    '''
+    Append message to the pending list of the active lease holder
+
+    Return:
+        False if the lease is no longer held, i.e. caller should try to acquire again
+    '''
+    try:
+        ddb_client.update_item(
+            TableName=ddb_table,
+            Key=_thread_key(slack_channel_id, slack_thread_ts),
+            UpdateExpression='SET pending_msgs=list_append(if_not_exists(pending_msgs, :empty), :msg)',
+            ConditionExpression='lease_expire_at >= :now',
+            ExpressionAttributeValues={
+                ':msg': {'L': [{'M': {k: {'S': v} for k, v in msg.items()}}]},
+                ':empty': {'L': []},
+                ':now': {'N': str(int(time.time()))},
+            },
+        )
+    except botocore.exceptions.ClientError as ex:
+        if ex.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    logger.info(f'Message queued to active run: {slack_channel_id};{slack_thread_ts}')
+    return True
+
+
+def acquire_or_queue_thread_message(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        owner: str, msg: dict, lease_sec: int, attempts: int = 3) -> Optional[List[dict]]:
+    '''
+    Either acquire the thread lease, or queue msg for the active lease holder
+
+    Return:
+        messages to process by caller (pending taken over + msg) if lease acquired,
+        all but the last one still queued until answered
+        None if msg is queued for the lease holder
+    '''
+    if not lease_sec:
+        return [msg]
+    for _ in range(attempts):
+        acquired, pending = acquire_thread_lease(
+            ddb_client, ddb_table, slack_channel_id, slack_thread_ts, owner, lease_sec)
+        if acquired:
+            return pending + [msg]
+        if queue_thread_message(ddb_client, ddb_table, slack_channel_id, slack_thread_ts, msg):
+            return None
+    raise RuntimeError(f'Fail to acquire or queue on thread lease: {slack_channel_id};{slack_thread_ts}')
+
+
+def release_thread_lease(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        owner: str, lease_sec: int, answered: int = 0, force: bool = False) -> List[dict]:
+    '''
+    Drop the first `answered` pending messages (answered by the run just finished),
+    then release the lease if no message is left pending,
+    otherwise renew it and take the pending messages for the next run.
+    Pending messages are only dropped here, a failed run or a crashed holder leaves them
+    queued for the next lease holder.
+    force: release regardless (e.g. run failed), pending messages stay for the next lease holder
+
+    Return:
+        pending messages taken (still queued until answered), empty if lease released
+    '''
+    if not lease_sec:
+        return []
+    key = _thread_key(slack_channel_id, slack_thread_ts)
+    values = {':owner': {'S': owner}}
+    if force:
+        try:
+            ddb_client.update_item(
+                TableName=ddb_table,
+                Key=key,
+                UpdateExpression='REMOVE lease_owner, lease_expire_at',
+                ConditionExpression='lease_owner = :owner',
+                ExpressionAttributeValues=values,
+            )
+            logger.info(f'Thread lease released: {slack_channel_id};{slack_thread_ts}')
+        except botocore.exceptions.ClientError as ex:
+            logger.warning(f'DDB thread lease release fail: {ex}')
+        return []
+
+    try:
+        ddb_client.update_item(
+            TableName=ddb_table,
+            Key=key,
+            UpdateExpression='REMOVE lease_owner, lease_expire_at, pending_msgs',
+            ConditionExpression='lease_owner = :owner AND (attribute_not_exists(pending_msgs) '
+                                'OR size(pending_msgs) = :answered)',
+            ExpressionAttributeValues={**values, ':answered': {'N': str(answered)}},
+        )
+        logger.info(f'Thread lease released: {slack_channel_id};{slack_thread_ts}')
+        return []
+    except botocore.exceptions.ClientError as ex:
+        if ex.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            logger.warning(f'DDB thread lease release fail: {ex}')
+            return []
+
+    # messages queued during the run, keep lease and take them
+    # (others only append to the list, so the answered ones are still its first items)
+    answered_msgs = ', '.join(f'pending_msgs[{n}]' for n in range(answered))
+    try:
+        resp = ddb_client.update_item(
+            TableName=ddb_table,
+            Key=key,
+            UpdateExpression='SET lease_expire_at=:expire_at' + (
+                f' REMOVE {answered_msgs}' if answered else ''),
+            ConditionExpression='lease_owner = :owner',
+            ExpressionAttributeValues={
+                **values, ':expire_at': {'N': str(int(time.time()) + lease_sec)},
+            },
+            ReturnValues='ALL_NEW',
+        )
+    except botocore.exceptions.ClientError as ex:
+        # lease expired and taken by another worker, which also takes the pending messages
+        logger.warning(f'Thread lease lost: {ex}')
+        return []
+    pending = _to_pending(resp.get('Attributes', {}).get('pending_msgs', {}))
+    logger.info(f'Thread lease renewed: {slack_channel_id};{slack_thread_ts}, pending {len(pending)}')
+    return pending
+
+
+# DDB BatchWriteItem takes at most 25 put / delete requests per call
+BATCH_WRITE_LIMIT = 25
+
+# Retries of unprocessed items (throttling) on flush, with exponential backoff
+BATCH_WRITE_ATTEMPTS = 4
+
+
+class BatchWriter:
+    '''
+    Write-behind puts, off the response path: buffered, sent with BatchWriteItem
+    when 25 are buffered or on flush. Flushed at the end of each invocation (lambda_function),
+    items not flushed are lost with the container
+    Other writes (e.g. updates) run in background with submit, flush waits for them
+    '''
+
+    def __init__(self):
+        self._items: List[Tuple[Any, str, dict]] = []
+        self._lock = threading.Lock()
+        self._submitted: Dict[str, List[Future]] = {}
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='write-behind')
+
+    def put(self, ddb_client, ddb_table: str, item: dict):
+        with self._lock:
+            self._items.append((ddb_client, ddb_table, item))
+            full = len(self._items) >= BATCH_WRITE_LIMIT
+        if full:
+            self.flush()
+        return
+
+    def has_pending(self, ddb_table: str, attr: str, value: dict) -> bool:
+        '''
+        Any buffered item of ddb_table with attr = value (e.g. partition key of a thread)
+        '''
+        with self._lock:
+            return any(t == ddb_table and i.get(attr) == value for _, t, i in self._items)
+
+    def submit(self, key: str, fn: Callable, *args, **kwargs):
+        '''
+        Run a write in background, key groups the writes waited for together (e.g. one thread)
+        '''
+        future = self._executor.submit(fn, *args, **kwargs)
+        with self._lock:
+            self._submitted.setdefault(key, []).append(future)
+        return
+
+    def wait(self, key: Optional[str] = None):
+        '''
+        Wait for the background writes of key (all if None), failures are logged
+        '''
+        with self._lock:
+            if key is None:
+                futures = [f for fs in self._submitted.values() for f in fs]
+                self._submitted = {}
+            else:
+                futures = self._submitted.pop(key, [])
+        for future in futures:
+            try:
+                future.result()
+            except Exception as ex:
+                logger.error(f'DDB background write fail: {ex}')
+        return
+
+    def flush(self):
+        self.wait()
+        with self._lock:
+            items, self._items = self._items, []
+        for n in range(0, len(items), BATCH_WRITE_LIMIT):
+            chunk = items[n:n + BATCH_WRITE_LIMIT]
+            requests = {}
+            for _, ddb_table, item in chunk:
+                requests.setdefault(ddb_table, []).append({'PutRequest': {'Item': item}})
+            self._write(chunk[0][0], requests)
+        return
+
+    @staticmethod
+    def _write(ddb_client, requests: dict):
+        for attempt in range(BATCH_WRITE_ATTEMPTS):
+            try:
+                resp = ddb_client.batch_write_item(RequestItems=requests)
+            except botocore.exceptions.ClientError as ex:
+                logger.error(f'DDB batch write fail: {ex}')
+                return
+            requests = resp.get('UnprocessedItems') or {}
+            if not requests:
+                return
+            time.sleep(0.05 * 2 ** attempt)
+        logger.error(f'DDB batch write, items left unprocessed: {sum(len(r) for r in requests.values())}')
+        return
+
+
+# Write-behind buffer shared by handlers, flushed by lambda_function before the invocation ends
+write_behind = BatchWriter()
@@ -2,6 +2,9 @@ import logging
 import os
 import json
 from datetime import datetime, timezone
+from typing import Annotated
+
+from msg_handlers.openai_related.tool_registry import ToolRegistry
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -10,53 +13,24 @@ llm_tools_vars = json.loads(
     os.environ.get('llm_tools_vars', '{}')
 )
 
+# Tool outputs longer than this are truncated before going back to the model
+registry = ToolRegistry(
+    max_output_tokens=int(os.environ.get('llm_tool_max_output_tokens', '2000'))
+)
+
 
-def find_birthday(**args) -> str:
-    name = args['name']
+@registry.tool(description="Get the birth date of a person.", timeout=5, cache_ttl=3600)
+def find_birthday(name: Annotated[str, "Name of the person."]) -> str:
     bd = "unknown"
     if "yangbo" in name.lower():
         bd = "1991.Aug"
     return bd
 
 
-def current_datetime(**args) -> str:
+@registry.tool(description="Find current date time in UTC.", timeout=1)
+def current_datetime() -> str:
+    # never cached, time dependent
     return datetime.now(timezone.utc).isoformat()
 
 
-tools = {
-    "definitions": [
-        {
-            "type": "function",
-            "function": {
-                "name": "find_birthday",
-                "description": "Get the birth date of a person.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "name": {
-                            "type": "string",
-                            "description": "Name of the person.",
-                        },
-                    },
-                    "required": ["name"],
-                },
-            },
-        }, {
-            "type": "function",
-            "function": {
-                "name": "current_datetime",
-                "description": "Find current date time in UTC.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {},
-                    "required": [],
-                },
-            },
-        },
-    ],
-
-    "tool_functions": {
-        "find_birthday": find_birthday,
-        "current_datetime": current_datetime,
-    },
-}
+tools = registry.export()
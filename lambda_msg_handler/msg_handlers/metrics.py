@@ -0,0 +1,26 @@
+import json
+import time
+from typing import Dict, Tuple
+
+# CloudWatch namespace of the metrics of this lambda
+METRIC_NAMESPACE = 'SlackMessageHandler'
+
+
+def emit_metrics(dimensions: Dict[str, str], metrics: Dict[str, Tuple[float, str]]):
+    '''
+    CloudWatch embedded metric format, turned into metric from lambda log
+    dimensions: name -> value, metrics: name -> (value, unit)
+    '''
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRIC_NAMESPACE,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()],
+            }],
+        },
+        **dimensions,
+        **{name: value for name, (value, _) in metrics.items()},
+    }))
+    return
@@ -1,27 +1,61 @@
 import os
+import time
+import uuid
 import logging
 import json
 
-from openai import OpenAI, AssistantEventHandler
+from openai import OpenAI, AzureOpenAI, AssistantEventHandler
 
 import boto3
 import botocore
 
 from slack_sdk.errors import SlackApiError
 from msg_handlers.llm_tools import tools
-from msg_handlers.openai_related.utils import get_asst, ask_asst, complete_chat
-from msg_handlers.slack_related.utils import extract_event_details, reply
+from msg_handlers.openai_related.utils import (
+    get_asst, ask_asst, complete_chat, get_or_create_asst_thread_id, add_asst_thread_turn,
+    find_asst_thread_id, save_asst_thread_id_async, settle_new_asst_thread,
+    add_asst_thread_messages, get_last_asst_reply)
+from msg_handlers.openai_related.response_cache import ResponseCache, make_embedder
+from msg_handlers.openai_related.tool_registry import track_tool_calls, is_cacheable
+from msg_handlers.openai_related.rate_control import TokenBucket, AIMDController, RateGate, GatedClient
+from msg_handlers.openai_related.provider_pool import Provider, ProviderPool, select_providers
+from msg_handlers.openai_related.router import Router, load_weights, ROUTE_SKIP, ROUTE_SMALL, ROUTE_LARGE
+from msg_handlers.slack_related.utils import extract_event_details, reply, StreamingReply
+from msg_handlers.ddb_related.utils import (
+    acquire_or_queue_thread_message, release_thread_lease, write_behind)
+from msg_handlers.ddb_related.chat_history import (
+    fetch_thread_messages, save_thread_message, save_tool_turns,
+    save_thread_message_async, queue_thread_message, flush_thread_messages,
+    to_message_record, to_tool_turn_records)
+from msg_handlers.ddb_related.thread_doc import (
+    append_doc_messages_async, queue_doc_messages, flush_doc_messages, fetch_doc_messages, load_thread_doc, set_doc_ref,
+    add_doc_input)
+from msg_handlers.openai_related.context_budget import get_truncation_strategy, count_tokens
+from msg_handlers.openai_related.thread_summary import load_summary, to_summary_message, update_summary
+from msg_handlers.openai_related.responses_api import (
+    respond, load_response_chain, queue_response_input, save_last_response_id, retrieve_response,
+    get_output_text)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # gpt model
 openai_gpt_model = os.environ.get("openai_gpt_model", "gpt-4o")
+openai_small_model = os.environ.get('openai_small_model', 'gpt-4o-mini')
 openai_api_key = os.environ.get("openai_api_key", "")
 openai_asst_instructions = os.environ.get("openai_asst_instructions", "")
+
+# cluster-wide RPM / TPM budget shared via ddb_llm_control, 0 for no limit
+# when set, SDK retries are off for gated calls and 429s are retried by the rate gate after retry-after
+llm_rpm_limit = int(os.environ.get('llm_rpm_limit', '0'))
+llm_tpm_limit = int(os.environ.get('llm_tpm_limit', '0'))
+llm_rate_limited = bool(llm_rpm_limit or llm_tpm_limit)
 openai_client = OpenAI(
-    api_key=openai_api_key
+    api_key=openai_api_key,
 )
+# client of calls wrapped by the rate gate (chat completion, responses)
+# assistants calls are not retried by the gate (not safe to repeat) and keep SDK retries
+gated_openai_client = openai_client.with_options(max_retries=0) if llm_rate_limited else openai_client
 
 # tools available for assistant to use
 tool_defs = tools['definitions']
@@ -33,6 +67,115 @@ tool_functions = tools['tool_functions']
 ddb_client = boto3.client('dynamodb')
 ddb_asst_thread_table = os.environ['ddb_asst_thread']
 ddb_chat_completion_table = os.environ['ddb_chat_completion']
+ddb_asst_config_table = os.environ.get('ddb_asst_config', '')
+ddb_llm_control_table = os.environ.get('ddb_llm_control', '')
+
+# rate gate around LLM calls: cluster-wide budget (if limited) + AIMD concurrency of this container
+# (latency target on the first token / tool call of streamed and assistant calls)
+rate_gate = RateGate(
+    TokenBucket(
+        ddb_client, ddb_llm_control_table, openai_gpt_model,
+        rpm=llm_rpm_limit, tpm=llm_tpm_limit,
+    ) if llm_rate_limited and ddb_llm_control_table else None,
+    AIMDController(
+        max_limit=int(os.environ.get('llm_max_concurrency', '8')),
+        latency_target=float(os.environ.get('llm_latency_target', '30')),
+    ),
+    max_attempts=3 if llm_rate_limited else 1,
+)
+
+# chat completion over providers in order of preference (comma separated, e.g. 'openai,azure'),
+# hedging slow requests and failing over on 429 / 5xx / connection errors, see provider_pool.py
+# azure stands in with the az_openai_* deployments. Only openai (default): no pool
+provider_pool_order = [
+    p.strip() for p in os.environ.get('provider_pool_order', 'openai').split(',') if p.strip()]
+if provider_pool_order == ['openai']:
+    chat_client = GatedClient(gated_openai_client, rate_gate)
+else:
+    # SDK retries are off, the pool fails over to the next provider instead
+    providers = {}
+    if openai_api_key:
+        providers['openai'] = Provider('openai', openai_client.with_options(max_retries=0))
+    if os.environ.get('az_openai_endpoint'):
+        az_openai_deployment_name = os.environ.get('az_openai_deployment_name', '')
+        az_data_source = json.loads(os.environ.get('az_data_source', '{}'))
+        providers['azure'] = Provider(
+            'azure',
+            AzureOpenAI(
+                api_key=os.environ.get('az_openai_api_key', ''),
+                api_version=os.environ.get('az_openai_api_version', ''),
+                azure_endpoint=os.environ['az_openai_endpoint'],
+                max_retries=0,
+            ),
+            {
+                openai_gpt_model: az_openai_deployment_name,
+                openai_small_model: os.environ.get(
+                    'az_openai_small_deployment_name', az_openai_deployment_name),
+            },
+            extra_body={'data_sources': [az_data_source]} if az_data_source else None,
+        )
+    chat_client = GatedClient(ProviderPool(
+        select_providers(provider_pool_order, providers),
+        hedge_delay=float(os.environ.get('provider_hedge_delay', '2.0')),
+        hedge_percentile=float(os.environ.get('provider_hedge_percentile', '0.95')),
+        cooldown_sec=float(os.environ.get('provider_cooldown_sec', '30')),
+    ), rate_gate)
+
+# one assistant run at a time per slack thread, 0 to disable
+asst_thread_lease_sec = int(os.environ.get('asst_thread_lease_sec', '300'))
+
+# context window: history sent is limited by token budget instead of message count
+chat_history_token_budget = int(os.environ.get('chat_history_token_budget', '8000'))
+asst_truncation_strategy = get_truncation_strategy(
+    chat_history_token_budget, int(os.environ.get('asst_tokens_per_message', '200')))
+asst_estimated_tokens = chat_history_token_budget + int(os.environ.get('llm_completion_tokens', '500'))
+
+# responses api: thread history is server-side, charged as a full context budget
+# 'auto' lets OpenAI drop the oldest turns of the chain once past the context window
+responses_client = GatedClient(gated_openai_client, rate_gate, completion_tokens=asst_estimated_tokens)
+responses_truncation = os.environ.get('responses_truncation', 'auto')
+
+# tool calls / results of answers are kept in thread history, so follow-ups don't re-run tools
+# replayed for the latest n user messages, outputs truncated, expire after ttl days (0 to keep)
+chat_tool_turn_retention = int(os.environ.get('chat_tool_turn_retention', '3'))
+chat_tool_output_tokens = int(os.environ.get('chat_tool_output_tokens', '500'))
+chat_tool_turn_ttl = int(os.environ.get('chat_tool_turn_ttl_days', '7')) * 86400
+
+# thread history layout: 'items' (one item per message) or 'packed' (one compressed document
+# per slack thread, read with one GetItem, see thread_doc.py). Packed history is rolling,
+# oldest messages dropped past doc max tokens, instead of the thread summary
+chat_history_packed = os.environ.get('chat_history_layout', 'items') == 'packed'
+chat_history_doc_max_tokens = int(os.environ.get(
+    'chat_history_doc_max_tokens', str(chat_history_token_budget * 4)))
+
+# rolling thread summary: once unsummarized history passes threshold tokens, older turns
+# are compacted into a summary item, keeping the most recent turns verbatim. 0 to disable
+chat_summary_threshold = 0 if chat_history_packed else int(os.environ.get(
+    'chat_summary_threshold', str(chat_history_token_budget * 3 // 4)))
+chat_summary_keep_recent = int(os.environ.get(
+    'chat_summary_keep_recent', str(chat_history_token_budget // 3)))
+chat_summary_model = os.environ.get('chat_summary_model', openai_gpt_model)
+
+# response cache for repeated questions, only on opted-in channels (comma separated, '*' for all)
+response_cache = ResponseCache(
+    channels=os.environ.get('response_cache_channels', ''),
+    ttl=float(os.environ.get('response_cache_ttl', '3600')),
+    maxsize=int(os.environ.get('response_cache_size', '512')),
+    similarity=float(os.environ.get('response_cache_similarity', '0.92')),
+    embed=make_embedder(openai_client, os.environ.get('openai_embedding_model', 'text-embedding-3-small')),
+)
+
+# routing ahead of LLM call: acknowledgements skipped, simple questions on a small model
+router = Router(
+    enabled=os.environ.get('llm_router', 'true').lower() == 'true',
+    small_model=openai_small_model,
+    threshold=float(os.environ.get('router_threshold', '0.5')),
+    weights=load_weights(os.environ),
+)
+
+# slack reply
+slack_stream_reply = os.environ.get('slack_stream_reply', 'true').lower() == 'true'
+slack_stream_flush_interval = float(os.environ.get('slack_stream_flush_interval', '1.0'))
 
 
 def get_asst_thread_id(slack_channel_id, slack_thread_ts):
@@ -40,107 +183,136 @@ def get_asst_thread_id(slack_channel_id, slack_thread_ts):
     DDB ddb_asst_thread keeps the mapping from slack channel id + thread ts ==> asst_thread_id
     This function will find the assistant thread id for existing slack thread
     If not found (i.e. a new slack thread), it will create a assistant thread and insert to DDB
+    Mapping is cached in memory across warm invocations
     '''
-    ddb_search_key = {
-        "slack_channel_id": {"S": slack_channel_id},
-        "slack_thread_ts": {"S": slack_thread_ts},
-    }
-    asst_thread_id = None
+    return get_or_create_asst_thread_id(
+        openai_client, ddb_client, ddb_asst_thread_table, slack_channel_id, slack_thread_ts)
 
-    # search thread in DDB
-    try:
-        resp = ddb_client.get_item(
-            TableName=ddb_asst_thread_table,
-            Key=ddb_search_key,
-        )
-        asst_thread_id = resp["Item"]["asst_thread_id"]['S']
-        logger.info(f'DDB record found for thread: {asst_thread_id}')
-    except (botocore.exceptions.ClientError, KeyError) as exNotFound:
-        # if thread not found in DDB
-        thread = openai_client.beta.threads.create()
-        asst_thread_id = thread.id
-        try:
-            ddb_client.update_item(
-                TableName=ddb_asst_thread_table,
-                Key=ddb_search_key,
-                UpdateExpression="SET asst_thread_id=:asst_thread_id",
-                ExpressionAttributeValues={
-                    ":asst_thread_id": {"S": asst_thread_id}
-                }
-            )
-            logger.info(f'DDB record created for thread: {asst_thread_id}')
-        except botocore.exceptions.ClientError as ex:
-            logger.warning(ex)
-            pass
-
-    return asst_thread_id
-
-
-def fetch_slack_thread(slack_channel_id, slack_thread_ts):
-    '''
-    Fetch all messages in the thread stored in DDB
+
+def fetch_slack_thread(slack_channel_id, slack_thread_ts, after_ts='0', exclude_ts=None):
     '''
-    try:
-        resp = ddb_client.query(
-            TableName=ddb_chat_completion_table,
-            Limit=25,
-            ScanIndexForward=False,  # descending order
-            KeyConditionExpression='slack_channel_id_thread_ts = :slack_channel_id_thread_ts',
-            ExpressionAttributeValues={
-                ':slack_channel_id_thread_ts': {
-                    'S': f'{slack_channel_id};{slack_thread_ts}',
-                }
-            }
-        )
-        logger.info(
-            f'DDB records {resp.get("count", "not")} found: {slack_channel_id};{slack_thread_ts}')
+    Fetch messages in the thread stored in DDB, newest first up to the token budget
+    Only messages after after_ts, older ones are covered by the thread summary
+    exclude_ts: the current message, saved concurrently
+    '''
+    if chat_history_packed:
+        flush_doc_messages(write_behind, ddb_chat_completion_table, slack_channel_id, slack_thread_ts)
+        return fetch_doc_messages(
+            ddb_client, ddb_chat_completion_table, slack_channel_id, slack_thread_ts,
+            chat_history_token_budget, chat_tool_turn_retention, exclude_ts)
+    flush_thread_messages(write_behind, ddb_chat_completion_table, slack_channel_id, slack_thread_ts)
+    return fetch_thread_messages(
+        ddb_client, ddb_chat_completion_table, slack_channel_id, slack_thread_ts,
+        chat_history_token_budget, after_ts, chat_tool_turn_retention, exclude_ts)
+
+
+def get_last_reply(slack_channel_id, slack_thread_ts):
+    '''
+    Last assistant message of the thread, for the router (does the user answer its question)
+    '''
+    return next((
+        m['content'] for m in reversed(fetch_slack_thread(slack_channel_id, slack_thread_ts))
+        if m['role'] == 'assistant' and isinstance(m.get('content'), str)
+    ), '')
 
-        # reverse descending order to chronological ascending order
-        messages = [
-            {'role': i['role']['S'], 'content': i['content']['S']}
-            for i in resp.get('Items')[::-1]
-        ]
-    except (botocore.exceptions.ClientError, KeyError) as exNotFound:
-        logger.info(f'No existing threads: {exNotFound}')
-        messages = []
-        pass
 
-    return messages
+def summarize_slack_thread(slack_channel_id, slack_thread_ts, summary_record):
+    '''
+    Write-behind, flushed before the invocation ends (see lambda_function)
+    '''
+    if chat_summary_threshold <= 0:
+        return
+    write_behind.submit(
+        f'summary;{slack_channel_id};{slack_thread_ts}', update_summary,
+        chat_client, chat_summary_model, ddb_client, ddb_chat_completion_table,
+        slack_channel_id, slack_thread_ts, summary_record,
+        chat_summary_threshold, chat_summary_keep_recent)
+    return
 
 
 def save_slack_event(slack_channel_id, slack_thread_ts, slack_event_ts, role, content):
-    ddb_search_key = {
-        'slack_channel_id_thread_ts': {'S': f'{slack_channel_id};{slack_thread_ts}'},
-        'slack_event_ts': {'S': slack_event_ts},
-    }
-    try:
-        ddb_client.update_item(
-            TableName=ddb_chat_completion_table,
-            Key=ddb_search_key,
-            UpdateExpression='SET #r=:role, content=:content',
-            ExpressionAttributeValues={
-                ':role': {'S': role},
-                ':content': {'S': content},
-            },
-            ExpressionAttributeNames={
-                "#r": "role"
-            }
-        )
-        logger.info(
-            f'DDB record created for {role}: {slack_channel_id};{slack_thread_ts}')
-    except botocore.exceptions.ClientError as ex:
-        logger.error(f'DDB record fail to create: {ex}')
-        pass
-    return
+    return save_thread_message(
+        ddb_client, ddb_chat_completion_table, slack_channel_id, slack_thread_ts,
+        slack_event_ts, role, content)
 
 
-def handler_via_assistant(slack_event, slack_client):
+def save_slack_event_async(slack_channel_id, slack_thread_ts, slack_event_ts, role, content):
+    return save_thread_message_async(
+        ddb_client, ddb_chat_completion_table, slack_channel_id, slack_thread_ts,
+        slack_event_ts, role, content)
+
+
+def queue_slack_event(slack_channel_id, slack_thread_ts, slack_event_ts, role, content):
     '''
-    Overall slack message processing function
-    Simple pass-on to Chatgpt
+    Write-behind, flushed before the invocation ends (see lambda_function)
     '''
-    # Get relevant info from Slack event
-    msg_details = extract_event_details(slack_event)
+    return queue_thread_message(
+        write_behind, ddb_client, ddb_chat_completion_table, slack_channel_id, slack_thread_ts,
+        slack_event_ts, role, content)
+
+
+def save_slack_tool_turns(slack_channel_id, slack_thread_ts, slack_event_ts, turns):
+    return save_tool_turns(
+        ddb_client, ddb_chat_completion_table, slack_channel_id, slack_thread_ts,
+        slack_event_ts, turns, chat_tool_output_tokens, chat_tool_turn_ttl)
+
+
+def save_slack_doc_async(slack_channel_id, slack_thread_ts, slack_event_ts, text):
+    '''
+    Packed layout: user message ahead of its answer, in background while the history is read
+    '''
+    return append_doc_messages_async(
+        ddb_client, ddb_chat_completion_table, slack_channel_id, slack_thread_ts,
+        [to_message_record(slack_event_ts, 'user', text)], chat_history_doc_max_tokens)
+
+
+def queue_slack_doc(slack_channel_id, slack_thread_ts, slack_event_ts, text,
+                    reply_ts=None, response=None, turns=()):
+    '''
+    Packed layout: user message + its answer (tool turns, response) in one document update
+    (the user message replaces its copy saved ahead)
+    Write-behind, flushed before the thread is read again or the invocation ends
+    '''
+    records = [to_message_record(slack_event_ts, 'user', text)] + to_tool_turn_records(
+        slack_event_ts, list(turns), chat_tool_output_tokens)
+    if reply_ts:
+        records.append(to_message_record(reply_ts, 'assistant', response))
+    return queue_doc_messages(
+        write_behind, ddb_client, ddb_chat_completion_table, slack_channel_id, slack_thread_ts,
+        records, chat_history_doc_max_tokens)
+
+
+def answer_via_assistant(msgs, slack_channel_id, slack_thread_ts, slack_client):
+    '''
+    Send messages of the slack thread to assistant, and respond to the last one
+    '''
+    # Acknowledgements only: no run and no reply, kept in the assistant thread for later runs
+    if all(m.get('route') == ROUTE_SKIP for m in msgs):
+        add_asst_thread_messages(
+            openai_client, get_asst_thread_id(slack_channel_id, slack_thread_ts),
+            [m['text'] for m in msgs])
+        return
+
+    reply_ts = msgs[-1]['event_ts']
+
+    # Placeholder on slack thread, updated as response streams in
+    slack_stream = StreamingReply(
+        slack_channel_id, reply_ts, slack_client,
+        enabled=slack_stream_reply, flush_interval=slack_stream_flush_interval)
+    slack_stream.start()
+
+    # Cached answer, only for the opening question of a slack thread (no history)
+    cache_entry = None
+    if response_cache.enabled_for(slack_channel_id) and len(msgs) == 1 \
+            and msgs[0]['event_ts'] == slack_thread_ts:
+        cache_entry = response_cache.lookup(
+            slack_channel_id, openai_asst_instructions, openai_gpt_model, [], msgs[0]['text'])
+        if cache_entry['answer'] is not None:
+            slack_stream.finalize(cache_entry['answer'])
+            add_asst_thread_turn(
+                openai_client, get_asst_thread_id(slack_channel_id, slack_thread_ts),
+                msgs[0]['text'], cache_entry['answer'])
+            return
 
     # Get Chatgpt assistant
     asst = get_asst(
@@ -149,22 +321,106 @@ def handler_via_assistant(slack_event, slack_client):
         description="Chatgpt on slack",
         instructions=openai_asst_instructions,
         model=openai_gpt_model,
-        tools=tool_defs
+        tools=tool_defs,
+        ddb_client=ddb_client,
+        ddb_table=ddb_asst_config_table,
     )
 
-    # Get exsiting / Create new thread
-    asst_thread_id = get_asst_thread_id(
-        msg_details['channel_id'], msg_details['thread_ts'])
+    # Get exsiting thread, a new slack thread has none yet: it is created by the run
+    if any(m['event_ts'] == slack_thread_ts for m in msgs):
+        asst_thread_id = None
+    else:
+        asst_thread_id = find_asst_thread_id(
+            ddb_client, ddb_asst_thread_table, slack_channel_id, slack_thread_ts)
+
+    # Mapping of the thread created by the run is written while the run streams
+    new_thread = {}
+
+    def on_thread_created(thread_id):
+        new_thread['id'] = thread_id
+        new_thread['saved'] = save_asst_thread_id_async(
+            openai_client, ddb_client, ddb_asst_thread_table, slack_channel_id, slack_thread_ts, thread_id)
+
+    # Large model unless all messages to answer were routed to the small one
+    routes = {m.get('route') for m in msgs} - {ROUTE_SKIP}
+    decision = ROUTE_SMALL if routes == {ROUTE_SMALL} else ROUTE_LARGE
+
+    # answers built with time dependent tools are not cached
+    tools_called = []
 
     # Call OpenAI Assistant
-    response = ask_asst(
-        openai_client, asst.id, asst_thread_id, msg_details['text'],
-        tool_functions)
+    llm_start = time.monotonic()
+    try:
+        response = rate_gate.once(
+            ask_asst, asst_estimated_tokens,
+            openai_client, asst.id, asst_thread_id, [m['text'] for m in msgs],
+            track_tool_calls(tool_functions, tools_called),
+            on_delta=slack_stream.on_delta,
+            truncation_strategy=asst_truncation_strategy,
+            model=router.get_model(decision, None),
+            on_thread_created=on_thread_created,
+            on_tool_outputs=lambda outputs: rate_gate.record(sum(count_tokens(o) for o in outputs)))
+    except Exception:
+        # no placeholder left behind, the message is redelivered
+        slack_stream.abort()
+        raise
+    router.record_llm_time(decision, time.monotonic() - llm_start)
 
     # respond on slack thread
     logger.info(f"Send response to slack thread")
-    reply(response, msg_details['channel_id'],
-          msg_details['event_ts'], slack_client)
+    slack_stream.finalize(response)
+    if cache_entry is not None and is_cacheable(tool_functions, tools_called):
+        response_cache.store(cache_entry, response)
+
+    if new_thread:
+        settle_new_asst_thread(
+            openai_client, new_thread['saved'], new_thread['id'],
+            '\n'.join(m['text'] for m in msgs), response)
+
+    return
+
+
+def handler_via_assistant(slack_event, slack_client):
+    '''
+    Overall slack message processing function
+    Simple pass-on to Chatgpt
+    Only one run at a time per slack thread (thread lease),
+    messages arriving during an active run are queued and answered by the lease holder
+    '''
+    # Get relevant info from Slack event
+    msg_details = extract_event_details(slack_event)
+    channel_id, thread_ts = msg_details['channel_id'], msg_details['thread_ts']
+
+    # Acknowledgements need no answer, the lease holder only adds them to the assistant thread
+    decision = router.route(
+        msg_details['text'], has_history=thread_ts != msg_details['event_ts'],
+        get_last_reply=lambda: get_last_asst_reply(
+            openai_client, find_asst_thread_id(ddb_client, ddb_asst_thread_table, channel_id, thread_ts)))
+
+    # Acquire thread lease, or queue message to the active run
+    lease_owner = str(uuid.uuid4())
+    msgs = acquire_or_queue_thread_message(
+        ddb_client, ddb_asst_thread_table, channel_id, thread_ts, lease_owner,
+        {'text': msg_details['text'], 'event_ts': msg_details['event_ts'], 'route': decision},
+        asst_thread_lease_sec)
+    if msgs is None:
+        return
+    # taken over from the queue, all but this message
+    queued = msgs[:-1]
+
+    try:
+        while msgs:
+            answer_via_assistant(msgs, channel_id, thread_ts, slack_client)
+            # queued messages leave the queue once answered,
+            # messages queued during the run are answered in the next run
+            msgs = queued = release_thread_lease(
+                ddb_client, ddb_asst_thread_table, channel_id, thread_ts, lease_owner,
+                asst_thread_lease_sec, answered=len(queued))
+    except Exception:
+        release_thread_lease(
+            ddb_client, ddb_asst_thread_table, channel_id, thread_ts, lease_owner,
+            asst_thread_lease_sec, force=True)
+        raise
 
     return
 
@@ -177,35 +433,207 @@ def handler_via_chat_completion(slack_event, slack_client):
     # Get relevant info from Slack event
     msg_details = extract_event_details(slack_event)
 
-    # Re-collect past message in the thread
+    # Acknowledgements need no answer, only kept in thread history
+    decision = router.route(
+        msg_details['text'], has_history=msg_details['thread_ts'] != msg_details['event_ts'],
+        get_last_reply=lambda: get_last_reply(msg_details['channel_id'], msg_details['thread_ts']))
+    if decision == ROUTE_SKIP:
+        if chat_history_packed:
+            queue_slack_doc(msg_details['channel_id'], msg_details['thread_ts'],
+                            msg_details['event_ts'], msg_details['text'])
+        else:
+            queue_slack_event(msg_details['channel_id'], msg_details['thread_ts'],
+                              msg_details['event_ts'], 'user', msg_details['text'])
+        return
+
+    # Placeholder on slack thread, updated as response streams in
+    slack_stream = StreamingReply(
+        msg_details['channel_id'], msg_details['thread_ts'], slack_client,
+        enabled=slack_stream_reply, flush_interval=slack_stream_flush_interval)
+    slack_stream.start()
+
+    # save latest thread msg, while past messages are queried
+    if chat_history_packed:
+        user_msg_saved = save_slack_doc_async(
+            msg_details['channel_id'], msg_details['thread_ts'],
+            msg_details['event_ts'], msg_details['text'])
+    else:
+        user_msg_saved = save_slack_event_async(
+            msg_details['channel_id'], msg_details['thread_ts'],
+            msg_details['event_ts'], 'user', msg_details['text'])
+
+    # Re-collect past message in the thread: summary of older turns + recent turns
+    # (packed layout: no summary, the document is trimmed to chat_history_doc_max_tokens instead)
+    summary_record = {'summary': '', 'summarized_until': '0'} if chat_history_packed \
+        or chat_summary_threshold <= 0 else load_summary(
+            ddb_client, ddb_chat_completion_table, msg_details['channel_id'], msg_details['thread_ts'])
     thread_messages = [
         {'role': 'system', 'content': openai_asst_instructions}
-    ] + fetch_slack_thread(
-        msg_details['channel_id'], msg_details['thread_ts']
+    ] + to_summary_message(summary_record) + fetch_slack_thread(
+        msg_details['channel_id'], msg_details['thread_ts'], summary_record['summarized_until'],
+        exclude_ts=msg_details['event_ts']
     ) + [
         {'role': 'user', 'content': msg_details['text']}
     ]
-
-    # save latest thread msg
-    save_slack_event(msg_details['channel_id'], msg_details['thread_ts'],
-                     msg_details['event_ts'], 'user', msg_details['text'])
+    user_msg_saved.result()
+
+    # Cached answer for same question with same history
+    cache_entry = None
+    if response_cache.enabled_for(msg_details['channel_id']):
+        cache_entry = response_cache.lookup(
+            msg_details['channel_id'], openai_asst_instructions, openai_gpt_model,
+            thread_messages[1:-1], msg_details['text'])
+        if cache_entry['answer'] is not None:
+            resp = slack_stream.finalize(cache_entry['answer'])
+            if chat_history_packed:
+                queue_slack_doc(msg_details['channel_id'], msg_details['thread_ts'],
+                                msg_details['event_ts'], msg_details['text'],
+                                resp['ts'], cache_entry['answer'])
+            else:
+                queue_slack_event(msg_details['channel_id'], msg_details['thread_ts'],
+                                  resp['ts'], 'assistant', cache_entry['answer'])
+            return
 
     # pass whole message history to chat completion
     logger.info(f'Call chat completion api')
     logger.info(f'{"\n".join([str(t)[:70] for t in thread_messages])}')
-    response = complete_chat(
-        openai_client,
-        model=openai_gpt_model,
-        messages=thread_messages,
-        tool_defs=tool_defs,
-        tool_functions=tool_functions)
+    # answers built with time dependent tools are not cached
+    tools_called = []
+    llm_start = time.monotonic()
+    history_len = len(thread_messages)
+    try:
+        response = complete_chat(
+            chat_client,
+            model=router.get_model(decision, openai_gpt_model),
+            messages=thread_messages,
+            tool_defs=tool_defs,
+            tool_functions=track_tool_calls(tool_functions, tools_called),
+            on_delta=slack_stream.on_delta)
+    except Exception:
+        # no placeholder left behind, the message is redelivered
+        slack_stream.abort()
+        raise
+    router.record_llm_time(decision, time.monotonic() - llm_start)
+
+    # respond on slack thread
+    logger.info(f'Send response to slack thread')
+    resp = slack_stream.finalize(response)
+    if cache_entry is not None and is_cacheable(tool_functions, tools_called):
+        response_cache.store(cache_entry, response)
+
+    # save tool turns (appended to thread_messages by complete_chat) + latest response (write-behind)
+    if chat_history_packed:
+        queue_slack_doc(msg_details['channel_id'], msg_details['thread_ts'],
+                        msg_details['event_ts'], msg_details['text'],
+                        resp['ts'], response, thread_messages[history_len:])
+    else:
+        save_slack_tool_turns(msg_details['channel_id'], msg_details['thread_ts'],
+                              msg_details['event_ts'], thread_messages[history_len:])
+        queue_slack_event(msg_details['channel_id'], msg_details['thread_ts'],
+                          resp['ts'], 'assistant', response)
+
+    # compact older turns after the reply is out, off the response path
+    summarize_slack_thread(msg_details['channel_id'], msg_details['thread_ts'], summary_record)
+    return
+
+
+def get_response_chain(slack_channel_id, slack_thread_ts):
+    '''
+    Response the next message of the thread chains to, and the messages to send along,
+    in ddb_asst_thread (packed layout: in the thread document)
+    '''
+    if chat_history_packed:
+        doc = load_thread_doc(
+            ddb_client, ddb_chat_completion_table, slack_channel_id, slack_thread_ts, consistent=True
+        )['doc']
+        return doc['refs'].get('last_response_id'), doc.get('pending_inputs', [])
+    return load_response_chain(ddb_client, ddb_asst_thread_table, slack_channel_id, slack_thread_ts)
+
+
+def set_last_response_id(slack_channel_id, slack_thread_ts, response_id, previous_response_id, sent_inputs):
+    if chat_history_packed:
+        set_doc_ref(
+            ddb_client, ddb_chat_completion_table, slack_channel_id, slack_thread_ts,
+            'last_response_id', response_id, previous_response_id, sent_inputs)
+        return
+    save_last_response_id(
+        ddb_client, ddb_asst_thread_table, slack_channel_id, slack_thread_ts,
+        response_id, previous_response_id, sent_inputs)
+    return
+
+
+def queue_response_msg(slack_channel_id, slack_thread_ts, text):
+    '''
+    Message not answered, sent with the next response of the thread
+    '''
+    if chat_history_packed:
+        add_doc_input(ddb_client, ddb_chat_completion_table, slack_channel_id, slack_thread_ts, text)
+        return
+    queue_response_input(ddb_client, ddb_asst_thread_table, slack_channel_id, slack_thread_ts, text)
+    return
+
+
+def get_last_response_text(slack_channel_id, slack_thread_ts):
+    '''
+    Text of the last response of the thread, for the router (does the user answer its question)
+    '''
+    response_id, _ = get_response_chain(slack_channel_id, slack_thread_ts)
+    if not response_id:
+        return ''
+    return get_output_text(retrieve_response(openai_client, response_id))
+
+
+def handler_via_responses(slack_event, slack_client):
+    '''
+    Overall slack message processing function
+    Only the new message is sent to responses api, chained to the last response of the thread
+    (last_response_id in ddb_asst_thread), history is kept on OpenAI side and not resent
+    '''
+    # Get relevant info from Slack event
+    msg_details = extract_event_details(slack_event)
+    channel_id, thread_ts = msg_details['channel_id'], msg_details['thread_ts']
+
+    # Acknowledgements need no answer, sent with the next message of the thread
+    decision = router.route(
+        msg_details['text'], has_history=thread_ts != msg_details['event_ts'],
+        get_last_reply=lambda: get_last_response_text(channel_id, thread_ts))
+    if decision == ROUTE_SKIP:
+        queue_response_msg(channel_id, thread_ts, msg_details['text'])
+        return
+
+    # Placeholder on slack thread, updated as response streams in
+    slack_stream = StreamingReply(
+        channel_id, thread_ts, slack_client,
+        enabled=slack_stream_reply, flush_interval=slack_stream_flush_interval)
+    slack_stream.start()
+
+    # Chain to the last response of the thread, none for a new thread
+    previous_response_id, earlier_msgs = get_response_chain(channel_id, thread_ts)
+
+    logger.info(f'Call responses api, previous response: {previous_response_id}')
+    llm_start = time.monotonic()
+    try:
+        response_id, response = respond(
+            responses_client,
+            model=router.get_model(decision, openai_gpt_model),
+            instructions=openai_asst_instructions,
+            msg=msg_details['text'],
+            previous_response_id=previous_response_id,
+            tool_defs=tool_defs,
+            tool_functions=tool_functions,
+            on_delta=slack_stream.on_delta,
+            truncation=responses_truncation,
+            earlier_msgs=earlier_msgs)
+    except Exception:
+        # no placeholder left behind, the message is redelivered
+        slack_stream.abort()
+        raise
+    router.record_llm_time(decision, time.monotonic() - llm_start)
 
     # respond on slack thread
     logger.info(f'Send response to slack thread')
-    resp = reply(response, msg_details['channel_id'],
-                 msg_details['thread_ts'], slack_client)
+    slack_stream.finalize(response)
 
-    # save latest response
-    save_slack_event(msg_details['channel_id'], msg_details['thread_ts'],
-                     resp['ts'], 'assistant', response)
+    # next message of the thread chains to this response
+    set_last_response_id(channel_id, thread_ts, response_id, previous_response_id, len(earlier_msgs))
     return
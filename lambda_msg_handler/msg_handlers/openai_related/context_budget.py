@@ -0,0 +1,94 @@
+import math
+import logging
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+try:
+    # optional, not in the openai sdk layer by default
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger()
+
+# Tokens added by chat format for each message (role, separators)
+MESSAGE_OVERHEAD = 4
+
+# Approximation when tiktoken is not available: ascii chars per token,
+# other chars (CJK, kana...) count as one token each, as they mostly do with o200k / cl100k
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=8)
+def _get_encoding(model: Optional[str]):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except (KeyError, TypeError):
+        return tiktoken.get_encoding('o200k_base')
+
+
+def _estimate_tokens(text: str) -> float:
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return ascii_chars / CHARS_PER_TOKEN + (len(text) - ascii_chars)
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    '''
+    Number of tokens of text, using tiktoken if available, otherwise approximated by script
+    '''
+    if not text:
+        return 0
+    if tiktoken:
+        return len(_get_encoding(model).encode(text))
+    return math.ceil(_estimate_tokens(text))
+
+
+def truncate_tokens(text: str, max_tokens: int, model: Optional[str] = None) -> str:
+    '''
+    Cut text to at most max_tokens (approximately without tiktoken), marking the cut
+    '''
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    if tiktoken:
+        encoding = _get_encoding(model)
+        head = encoding.decode(encoding.encode(text)[:max_tokens])
+    else:
+        used, end = 0.0, 0
+        for end, char in enumerate(text):
+            used += 1 / CHARS_PER_TOKEN if char.isascii() else 1
+            if used > max_tokens:
+                break
+        head = text[:end]
+    return f'{head}\n... [truncated, {count_tokens(text, model)} tokens in total]'
+
+
+def count_message_tokens(message: Dict[str, str], model: Optional[str] = None) -> int:
+    return count_tokens(message.get('content') or '', model) + MESSAGE_OVERHEAD
+
+
+def fill_budget(messages_newest_first: List[dict], token_budget: int) -> List[dict]:
+    '''
+    Take messages newest first until token budget is used up (each message carries 'tokens')
+
+    Return:
+        messages taken, in chronological order
+    '''
+    taken, used = [], 0
+    for m in messages_newest_first:
+        if used + m['tokens'] > token_budget:
+            break
+        used += m['tokens']
+        taken.append(m)
+    logger.info(f'Context budget: {len(taken)} messages, {used}/{token_budget} tokens')
+    return taken[::-1]
+
+
+def get_truncation_strategy(token_budget: int, tokens_per_message: int) -> dict:
+    '''
+    Assistants api equivalent of the token budget: keep last N messages of the thread,
+    N being the budget over the estimated tokens per message
+    '''
+    return {
+        'type': 'last_messages',
+        'last_messages': max(1, token_budget // max(1, tokens_per_message)),
+    }
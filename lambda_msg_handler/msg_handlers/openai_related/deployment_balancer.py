@@ -0,0 +1,264 @@
+import time
+import random
+import logging
+import threading
+from typing import Dict, List, Optional
+
+import botocore
+import openai
+from openai import AzureOpenAI
+
+logger = logging.getLogger()
+
+# Rate limit headers of azure openai responses
+HEADER_REMAINING_REQUESTS = 'x-ratelimit-remaining-requests'
+HEADER_REMAINING_TOKENS = 'x-ratelimit-remaining-tokens'
+
+# Remaining counts older than this are stale (azure limit window is 1 min for TPM, 10 sec for RPM)
+STATE_STALE_SEC = 60
+
+# Cooldown after 429 without retry-after header
+DEFAULT_COOLDOWN_SEC = 10
+
+
+class Deployment:
+    '''
+    One azure openai deployment behind one endpoint
+    model: model name used by the handler that this deployment serves, default the deployment name
+    '''
+
+    def __init__(self, endpoint: str, deployment: str, api_key: str, api_version: str,
+                 model: Optional[str] = None, max_retries: int = 0):
+        self.key = f'{endpoint.split("//")[-1].split(".")[0]}/{deployment}'
+        self.deployment = deployment
+        self.model = model or deployment
+        self.client = AzureOpenAI(
+            api_key=api_key,
+            api_version=api_version,
+            azure_endpoint=endpoint,
+            max_retries=max_retries,
+        )
+        self.state = {'remaining_requests': None, 'remaining_tokens': None,
+                      'observed_at': 0.0, 'cooldown_until': 0.0}
+
+    def is_available(self, now: float) -> bool:
+        return self.state['cooldown_until'] <= now
+
+    def get_weight(self, now: float) -> float:
+        '''
+        Share of traffic, by remaining tokens seen in recent responses.
+        Not yet seen, stale or just out of 429 cooldown counts as full capacity,
+        so every deployment gets tried
+        '''
+        if now - self.state['observed_at'] > STATE_STALE_SEC \
+                or self.state['remaining_tokens'] is None \
+                or self.state['cooldown_until'] > self.state['observed_at']:
+            return float('inf')
+        if self.state['remaining_requests'] == 0:
+            return 0.0
+        return float(self.state['remaining_tokens'])
+
+
+class DeploymentBalancer:
+    '''
+    Spread chat completion requests across azure openai deployments,
+    weighted by x-ratelimit-remaining-* headers of recent responses, skipping deployments
+    cooling down after 429. State is shared by concurrent workers via one DDB record
+    in ddb_llm_control (control_key balancer#<name>), refreshed every sync_interval sec.
+
+    Pass the balancer as openai_client to complete_chat, which calls create_chat_completion
+    '''
+
+    def __init__(self, deployments: List[Deployment], name: str = 'default',
+                 ddb_client=None, ddb_table: str = '', sync_interval: float = 5,
+                 extra_body: Optional[dict] = None, fallback_model: bool = False):
+        '''
+        extra_body: added to each request, e.g. azure data sources
+        fallback_model: if no deployment serves the requested model, send it to any deployment
+        (with that deployment's model). Off by default: the request fails
+        '''
+        self.deployments = deployments
+        self.extra_body = extra_body or {}
+        self.fallback_model = fallback_model
+        self.control_key = f'balancer#{name}'
+        self.ddb_client = ddb_client
+        self.ddb_table = ddb_table
+        self.sync_interval = sync_interval
+        self._synced_at = 0.0
+        self._lock = threading.Lock()
+
+    def serves(self, model: str) -> bool:
+        return self.fallback_model or any(d.model == model for d in self.deployments)
+
+    def pick(self, model: Optional[str], exclude=()) -> Optional[Deployment]:
+        self.load_state()
+        now = time.time()
+        serving = [d for d in self.deployments if model is None or d.model == model]
+        if not serving:
+            if not self.fallback_model:
+                logger.warning(f'No azure openai deployment serves model {model}')
+                return None
+            logger.warning(f'No azure openai deployment serves model {model}, falling back to any')
+            serving = self.deployments
+        candidates = [d for d in serving if d.key not in exclude]
+        available = [d for d in candidates if d.is_available(now)]
+        if not available:
+            # all cooling down, the one available soonest
+            return min(candidates, key=lambda d: d.state['cooldown_until'], default=None)
+
+        weights = [d.get_weight(now) for d in available]
+        unseen = [d for d, w in zip(available, weights) if w == float('inf')]
+        if unseen:
+            return random.choice(unseen)
+        if sum(weights) <= 0:
+            return random.choice(available)
+        # weighted random rather than max, so concurrent workers don't all pick the same one
+        return random.choices(available, weights=weights)[0]
+
+    def create_chat_completion(self, **kwargs):
+        '''
+        Same as chat.completions.create, on the picked deployment
+        On 429 the deployment cools down and the next one is tried
+        '''
+        tried = set()
+        last_error = None
+        while len(tried) < len(self.deployments):
+            deployment = self.pick(kwargs.get('model'), exclude=tried)
+            if deployment is None:
+                break
+            if not tried and deployment.model != kwargs.get('model', deployment.model):
+                # fallback_model: later attempts stay on deployments of the model picked first
+                kwargs = {**kwargs, 'model': deployment.model}
+            tried.add(deployment.key)
+            try:
+                raw = deployment.client.chat.completions.with_raw_response.create(**{
+                    **kwargs,
+                    'model': deployment.deployment,
+                    'extra_body': {**kwargs.get('extra_body', {}), **self.extra_body},
+                })
+            except openai.RateLimitError as ex:
+                self.cool_down(deployment, ex)
+                last_error = ex
+                continue
+            self.observe(deployment, raw.headers)
+            logger.info(
+                f'Deployment {deployment.key}: remaining requests '
+                f'{deployment.state["remaining_requests"]}, tokens {deployment.state["remaining_tokens"]}')
+            return raw.parse()
+        raise last_error or RuntimeError(
+            f'No azure openai deployment available for model {kwargs.get("model")}, '
+            f'configured: {sorted({d.model for d in self.deployments})}')
+
+    def observe(self, deployment: Deployment, headers):
+        def to_int(value):
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                return None
+        deployment.state.update(
+            remaining_requests=to_int(headers.get(HEADER_REMAINING_REQUESTS)),
+            remaining_tokens=to_int(headers.get(HEADER_REMAINING_TOKENS)),
+            observed_at=time.time(),
+        )
+        self.save_state(deployment, force=False)
+        return
+
+    def cool_down(self, deployment: Deployment, ex: openai.RateLimitError):
+        headers = ex.response.headers if ex.response is not None else {}
+        try:
+            if headers.get('retry-after-ms'):
+                delay = float(headers['retry-after-ms']) / 1000
+            else:
+                delay = float(headers.get('retry-after', DEFAULT_COOLDOWN_SEC))
+        except ValueError:
+            delay = DEFAULT_COOLDOWN_SEC
+        now = time.time()
+        deployment.state.update(
+            remaining_requests=0, remaining_tokens=0,
+            observed_at=now, cooldown_until=now + delay)
+        logger.warning(f'Deployment {deployment.key} rate limited, cooldown {delay}s')
+        self.save_state(deployment, force=True)
+        return
+
+    def load_state(self):
+        '''
+        Refresh state of all deployments from DDB, at most every sync_interval sec
+        Newer local observations are kept
+        '''
+        if not self.ddb_table or time.time() - self._synced_at < self.sync_interval:
+            return
+        with self._lock:
+            self._synced_at = time.time()
+        try:
+            resp = self.ddb_client.get_item(
+                TableName=self.ddb_table,
+                Key={'control_key': {'S': self.control_key}},
+            )
+        except botocore.exceptions.ClientError as ex:
+            logger.warning(f'DDB balancer state not loaded: {ex}')
+            return
+        item = resp.get('Item', {})
+        for d in self.deployments:
+            shared = item.get(d.key, {}).get('M')
+            if not shared or float(shared['observed_at']['N']) <= d.state['observed_at']:
+                continue
+            d.state = {k: _from_ddb(k, v) for k, v in shared.items()}
+        return
+
+    def save_state(self, deployment: Deployment, force: bool):
+        '''
+        Write the deployment's state to the shared record. Outside of 429 (force),
+        only as often as other workers read it. Older observations do not overwrite newer
+        '''
+        if not self.ddb_table:
+            return
+        if not force and time.time() - deployment.state.get('saved_at', 0.0) < self.sync_interval:
+            return
+        deployment.state['saved_at'] = time.time()
+        state = {
+            k: {'N': str(v)} if v is not None else {'NULL': True}
+            for k, v in deployment.state.items() if k != 'saved_at'
+        }
+        try:
+            self.ddb_client.update_item(
+                TableName=self.ddb_table,
+                Key={'control_key': {'S': self.control_key}},
+                UpdateExpression='SET #d = :state',
+                ConditionExpression='attribute_not_exists(#d) OR #d.observed_at <= :observed_at',
+                ExpressionAttributeNames={'#d': deployment.key},
+                ExpressionAttributeValues={
+                    ':state': {'M': state},
+                    ':observed_at': state['observed_at'],
+                },
+            )
+        except botocore.exceptions.ClientError as ex:
+            if ex.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                logger.warning(f'DDB balancer state not saved: {ex}')
+        return
+
+
+def _from_ddb(key: str, value: dict):
+    if 'N' not in value:
+        return None
+    if key in ('observed_at', 'cooldown_until'):
+        return float(value['N'])
+    return int(value['N'])
+
+
+def load_deployments(
+        deployments: List[Dict[str, str]], default_api_version: str,
+        default_model: Optional[str] = None) -> List[Deployment]:
+    '''
+    deployments: list of {endpoint, deployment, api_key, api_version (optional), model (optional)}
+    model defaults to default_model, i.e. all deployments serve the handler's main model
+    '''
+    return [
+        Deployment(
+            endpoint=d['endpoint'],
+            deployment=d['deployment'],
+            api_key=d['api_key'],
+            api_version=d.get('api_version') or default_api_version,
+            model=d.get('model') or default_model,
+        )
+        for d in deployments
+    ]
@@ -0,0 +1,244 @@
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, List, Optional
+
+import openai
+
+logger = logging.getLogger()
+
+# Errors on which the next provider is tried (and the failing one cooled down)
+# Others (400 / 401 / 404 ...) would fail the same on every provider, they are raised right away
+FAILOVER_ERRORS = (
+    openai.RateLimitError,
+    openai.InternalServerError,
+    openai.APIConnectionError,
+)
+
+# Latency samples kept per provider to derive the hedge delay
+LATENCY_WINDOW = 50
+MIN_LATENCY_SAMPLES = 10
+
+# Worker threads shared by all pools, across warm invocations
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='provider')
+
+
+class Provider:
+    '''
+    One chat completion endpoint: OpenAI or Azure OpenAI client + model / deployment
+    models maps the model names used by the handler to this provider's (e.g. azure deployments),
+    models not in it are sent as is
+    '''
+
+    def __init__(self, name: str, client, models: Optional[Dict[str, str]] = None,
+                 extra_body: Optional[dict] = None):
+        self.name = name
+        self.client = client
+        self.models = models or {}
+        self.extra_body = extra_body or {}
+        self.cooldown_until = 0.0
+        self._latency = {True: deque(maxlen=LATENCY_WINDOW), False: deque(maxlen=LATENCY_WINDOW)}
+
+    def create_chat_completion(self, **kwargs):
+        kwargs['model'] = self.models.get(kwargs.get('model'), kwargs.get('model'))
+        if self.extra_body:
+            kwargs['extra_body'] = {**kwargs.get('extra_body', {}), **self.extra_body}
+        return self.client.chat.completions.create(**kwargs)
+
+    def record_latency(self, stream: bool, elapsed: float):
+        self._latency[stream].append(elapsed)
+
+    def get_latency_percentile(self, stream: bool, percentile: float) -> Optional[float]:
+        samples = sorted(self._latency[stream])
+        if len(samples) < MIN_LATENCY_SAMPLES:
+            return None
+        return samples[min(int(len(samples) * percentile), len(samples) - 1)]
+
+    def is_healthy(self) -> bool:
+        return self.cooldown_until <= time.monotonic()
+
+
+class _Attempt:
+    '''
+    One call on one provider, run in a worker thread until the first token
+    (or the whole response if not streaming)
+    '''
+
+    def __init__(self, provider: Provider, kwargs: dict):
+        self.provider = provider
+        self.kwargs = kwargs
+        self.stream = None
+        self.chunks = None
+        self.cancelled = threading.Event()
+        self.started = time.monotonic()
+
+    def run(self):
+        if not self.kwargs.get('stream'):
+            return self.provider.create_chat_completion(**self.kwargs)
+        self.stream = self.provider.create_chat_completion(**self.kwargs)
+        if self.cancelled.is_set():
+            self.stream.close()
+            return None
+        # buffer until first chunk with choices (azure sends prompt filter results first)
+        buffered = []
+        self.chunks = iter(self.stream)
+        for chunk in self.chunks:
+            buffered.append(chunk)
+            if chunk.choices:
+                break
+        return buffered
+
+    def cancel(self):
+        '''
+        Close the stream of a lost race. A call not streamed cannot be interrupted,
+        it runs to completion in its worker thread and is billed as well
+        '''
+        self.cancelled.set()
+        if self.stream is not None:
+            self.stream.close()
+        return
+
+
+class ProviderPool:
+    '''
+    Chat completion over several providers, in order of preference
+    - hedging: if the first provider has no first token within the hedge delay
+      (p95 of its recent first token latency), the same request is sent to the next provider,
+      first one to produce a token wins and the other is cancelled
+    - failover: on 429 / 5xx / connection errors the next provider is tried right away,
+      and the failing provider is skipped for cooldown_sec. Other errors fail the request,
+      once no other attempt is in flight
+    Hedged requests not streamed are billed twice, the losing call is not interrupted
+
+    Pass the pool as openai_client to complete_chat (or wrapped by GatedClient),
+    which calls create_chat_completion
+    '''
+
+    def __init__(self, providers: List[Provider], hedge_delay: float = 2.0,
+                 hedge_percentile: float = 0.95, cooldown_sec: float = 30):
+        '''
+        hedge_delay: delay before hedging until enough latency samples, 0 to disable hedging
+        '''
+        if not providers:
+            raise ValueError('Provider pool without provider, see select_providers')
+        self.providers = providers
+        self.hedge_delay = hedge_delay
+        self.hedge_percentile = hedge_percentile
+        self.cooldown_sec = cooldown_sec
+
+    def get_candidates(self) -> List[Provider]:
+        '''
+        Healthy providers first, those cooling down as last resort
+        '''
+        return sorted(self.providers, key=lambda p: not p.is_healthy())
+
+    def get_hedge_delay(self, provider: Provider, stream: bool) -> Optional[float]:
+        if not self.hedge_delay:
+            return None
+        return provider.get_latency_percentile(stream, self.hedge_percentile) or self.hedge_delay
+
+    def cool_down(self, provider: Provider, ex: Exception):
+        delay = self.cooldown_sec
+        response = getattr(ex, 'response', None)
+        if response is not None:
+            try:
+                delay = float(response.headers.get('retry-after', delay))
+            except ValueError:
+                pass
+        provider.cooldown_until = time.monotonic() + delay
+        logger.warning(f'Provider {provider.name} failed, cooldown {delay}s: {ex}')
+        return
+
+    def create_chat_completion(self, **kwargs):
+        '''
+        Same as chat.completions.create, for stream=True return the chunks of the winner
+        '''
+        stream = bool(kwargs.get('stream'))
+        candidates = iter(self.get_candidates())
+        pending: Dict = {}
+        last_error = None
+        request_error = None
+        hedge_at = None
+
+        def launch() -> bool:
+            nonlocal hedge_at
+            provider = next(candidates, None)
+            if provider is None:
+                return False
+            attempt = _Attempt(provider, dict(kwargs))
+            pending[_executor.submit(attempt.run)] = attempt
+            delay = self.get_hedge_delay(provider, stream)
+            hedge_at = time.monotonic() + delay if delay is not None else None
+            if len(pending) > 1:
+                logger.info(f'Hedged request sent to {provider.name}')
+            return True
+
+        launch()
+        while pending:
+            timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # no first token within hedge delay, race the next provider
+                hedge_at = None
+                launch()
+                continue
+
+            for future in done:
+                attempt = pending.pop(future)
+                try:
+                    result = future.result()
+                except FAILOVER_ERRORS as ex:
+                    self.cool_down(attempt.provider, ex)
+                    last_error = ex
+                    continue
+                except Exception as ex:
+                    # not a provider outage (e.g. content filter of one provider): lost race
+                    # while another attempt is in flight, otherwise the request fails
+                    logger.warning(f'Provider {attempt.provider.name} error, no failover: {ex}')
+                    request_error = ex
+                    continue
+                if result is None:
+                    continue
+
+                # winner, cancel the others
+                now = time.monotonic()
+                elapsed = now - attempt.started
+                attempt.provider.record_latency(stream, elapsed)
+                logger.info(f'Provider {attempt.provider.name} answered, first token in {elapsed:.3f}s')
+                for other in pending.values():
+                    other.cancel()
+                    if other.started < attempt.started:
+                        # overtaken, its latency is at least this long (lower bound),
+                        # so a slow provider's hedge delay does not keep shrinking
+                        other.provider.record_latency(stream, now - other.started)
+                return self._iter_stream(attempt, result) if stream else result
+
+            if not pending:
+                if request_error:
+                    raise request_error
+                # all in flight failed, fail over to next provider
+                launch()
+
+        raise last_error or RuntimeError('No chat completion provider available')
+
+    @staticmethod
+    def _iter_stream(attempt: _Attempt, buffered: list):
+        yield from buffered
+        yield from attempt.chunks
+
+
+def select_providers(order: List[str], providers: Dict[str, Provider]) -> List[Provider]:
+    '''
+    Configured providers in order of preference
+
+    Raise:
+        ValueError if none of the providers in order is configured
+    '''
+    selected = [providers[name] for name in order if name in providers]
+    if not selected:
+        raise ValueError(
+            f'No chat completion provider configured for provider_pool_order {order}, '
+            f'configured: {list(providers)}')
+    return selected
@@ -0,0 +1,294 @@
+import time
+import random
+import inspect
+import logging
+import threading
+from typing import Callable, Optional
+
+import botocore
+import openai
+
+from msg_handlers.openai_related.context_budget import count_message_tokens
+from msg_handlers.openai_related.responses_api import get_create_response
+
+logger = logging.getLogger()
+
+# Fixed window of the shared RPM / TPM budget
+WINDOW_SEC = 60
+
+
+class RateLimitExceeded(Exception):
+    '''
+    Shared budget used up and not freed within max_wait, event is retried later via SQS
+    '''
+    pass
+
+
+class TokenBucket:
+    '''
+    Cluster-wide RPM / TPM budget, one DDB item per fixed window in ddb_llm_control
+    (control_key ratelimit#<name>#<window>). A call is charged with one conditional ADD,
+    refused when it would take the window over the limits
+    '''
+
+    def __init__(self, ddb_client, ddb_table: str, name: str,
+                 rpm: int = 0, tpm: int = 0, max_wait: float = 20):
+        '''
+        rpm / tpm: 0 for no limit
+        '''
+        self.ddb_client = ddb_client
+        self.ddb_table = ddb_table
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_wait = max_wait
+
+    def try_charge(self, tokens: int, now: float) -> bool:
+        window = int(now // WINDOW_SEC)
+        conditions, values = [], {
+            ':one': {'N': '1'},
+            ':tokens': {'N': str(tokens)},
+            ':expire_at': {'N': str((window + 2) * WINDOW_SEC)},
+        }
+        if self.rpm:
+            conditions.append('(attribute_not_exists(requests) OR requests < :rpm)')
+            values[':rpm'] = {'N': str(self.rpm)}
+        if self.tpm:
+            # a single call over tpm still goes through on an empty window
+            conditions.append('(attribute_not_exists(tokens) OR tokens <= :tpm_room)')
+            values[':tpm_room'] = {'N': str(self.tpm - tokens)}
+        try:
+            self.ddb_client.update_item(
+                TableName=self.ddb_table,
+                Key={'control_key': {'S': f'ratelimit#{self.name}#{window}'}},
+                UpdateExpression='SET expire_at = :expire_at ADD requests :one, tokens :tokens',
+                ConditionExpression=' AND '.join(conditions),
+                ExpressionAttributeValues=values,
+            )
+        except botocore.exceptions.ClientError as ex:
+            if ex.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            # fail open, rate control must not take the handler down
+            logger.warning(f'DDB rate limit not charged: {ex}')
+        return True
+
+    def record(self, tokens: int):
+        '''
+        Add tokens used within a call already charged (e.g. tool outputs of an assistant run)
+        to the current window, without waiting: later calls see them
+        '''
+        now = time.time()
+        window = int(now // WINDOW_SEC)
+        try:
+            self.ddb_client.update_item(
+                TableName=self.ddb_table,
+                Key={'control_key': {'S': f'ratelimit#{self.name}#{window}'}},
+                UpdateExpression='SET expire_at = :expire_at ADD tokens :tokens',
+                ExpressionAttributeValues={
+                    ':tokens': {'N': str(tokens)},
+                    ':expire_at': {'N': str((window + 2) * WINDOW_SEC)},
+                },
+            )
+        except botocore.exceptions.ClientError as ex:
+            logger.warning(f'DDB rate limit not recorded: {ex}')
+        return
+
+    def charge(self, tokens: int):
+        '''
+        Charge tokens against the current window, waiting for next windows if needed
+        '''
+        deadline = time.time() + self.max_wait
+        while True:
+            now = time.time()
+            if self.try_charge(tokens, now):
+                return
+            # wait for next window, jitter spreads the waiting workers
+            wait = (int(now // WINDOW_SEC) + 1) * WINDOW_SEC - now + random.uniform(0, 1)
+            if now + wait > deadline:
+                raise RateLimitExceeded(f'{self.name}: shared rate limit used up')
+            logger.info(f'Shared rate limit used up, wait {wait:.1f}s for next window')
+            time.sleep(wait)
+
+
+class AIMDController:
+    '''
+    Local concurrency limit of LLM calls in this container, additive increase on fast successes,
+    multiplicative decrease on 429 or latency over target. Per container, not shared:
+    the cluster-wide limit is the TokenBucket budget
+    latency is to the first output for streamed and assistant calls, not the whole call
+    '''
+
+    def __init__(self, max_limit: int = 8, min_limit: int = 1, latency_target: float = 30,
+                 increase: float = 1.0, decrease: float = 0.5, cooldown: float = 5):
+        self.limit = float(max_limit)
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.latency_target = latency_target
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._decreased_at = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+        return
+
+    def release(self, throttled: bool, latency: Optional[float]):
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled or (latency is not None and latency > self.latency_target):
+                # once per cooldown, concurrent 429s of the same burst count as one
+                if now - self._decreased_at > self.cooldown:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self._decreased_at = now
+                    logger.info(f'LLM concurrency limit down to {int(self.limit)}')
+            elif latency is not None:
+                # +increase per limit successes, i.e. per round of calls
+                self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+            self._cond.notify_all()
+        return
+
+
+class RateGate:
+    '''
+    Around each LLM call: local AIMD slot, then shared budget charge,
+    then on 429 a bounded retry after retry-after (SDK retries are off)
+    '''
+
+    def __init__(self, limiter: Optional[TokenBucket], controller: AIMDController,
+                 max_attempts: int = 3):
+        self.limiter = limiter
+        self.controller = controller
+        self.max_attempts = max_attempts
+
+    def call(self, fn: Callable, estimated_tokens: int, *args, **kwargs):
+        return self._call(fn, estimated_tokens, self.max_attempts, args, kwargs)
+
+    def once(self, fn: Callable, estimated_tokens: int, *args, **kwargs):
+        '''
+        Same as call without retry, for calls not safe to repeat (e.g. ask_asst adds messages)
+        A call taking on_first_output (e.g. ask_asst) has its latency taken to the first output,
+        as for stream, so long tool calling runs do not count as slow
+        '''
+        return self._call(fn, estimated_tokens, 1, args, kwargs)
+
+    def record(self, tokens: int):
+        '''
+        Tokens used within a call already charged, e.g. tool outputs sent back during a run
+        '''
+        if self.limiter:
+            self.limiter.record(tokens)
+        return
+
+    def _call(self, fn: Callable, estimated_tokens: int, max_attempts: int, args, kwargs):
+        for attempt in range(1, max_attempts + 1):
+            self.controller.acquire()
+            start = time.monotonic()
+            first_output = []
+            if 'on_first_output' in inspect.signature(fn).parameters:
+                kwargs['on_first_output'] = lambda: first_output.append(time.monotonic())
+            try:
+                if self.limiter:
+                    self.limiter.charge(estimated_tokens)
+                result = fn(*args, **kwargs)
+            except openai.RateLimitError as ex:
+                self.controller.release(throttled=True, latency=None)
+                if attempt == max_attempts:
+                    raise
+                time.sleep(get_retry_after(ex) + random.uniform(0, 1))
+                continue
+            except Exception:
+                self.controller.release(throttled=False, latency=None)
+                raise
+            end = first_output[0] if first_output else time.monotonic()
+            self.controller.release(throttled=False, latency=end - start)
+            return result
+
+    def stream(self, fn: Callable, estimated_tokens: int, *args, **kwargs):
+        '''
+        Same as call for a streaming call, slot is held until the stream is consumed,
+        latency is to the first chunk
+        '''
+        for attempt in range(1, self.max_attempts + 1):
+            self.controller.acquire()
+            start = time.monotonic()
+            try:
+                if self.limiter:
+                    self.limiter.charge(estimated_tokens)
+                chunks = iter(fn(*args, **kwargs))
+                first = next(chunks, None)
+            except openai.RateLimitError as ex:
+                self.controller.release(throttled=True, latency=None)
+                if attempt == self.max_attempts:
+                    raise
+                time.sleep(get_retry_after(ex) + random.uniform(0, 1))
+                continue
+            except Exception:
+                self.controller.release(throttled=False, latency=None)
+                raise
+            return self._hold(chunks, first, time.monotonic() - start)
+
+    def _hold(self, chunks, first, latency: float):
+        try:
+            if first is not None:
+                yield first
+            yield from chunks
+        finally:
+            self.controller.release(throttled=False, latency=latency)
+
+
+class GatedClient:
+    '''
+    Chat completion through the rate gate, wrapping a client, provider pool or balancer
+    Pass as openai_client to complete_chat, which calls create_chat_completion
+    (or to responses_api.respond, which calls create_response)
+    '''
+
+    def __init__(self, client, gate: RateGate, completion_tokens: int = 500):
+        '''
+        completion_tokens: expected output tokens, added to prompt tokens when charging
+        '''
+        self.client = client
+        self.gate = gate
+        self.completion_tokens = completion_tokens
+
+    def create_chat_completion(self, **kwargs):
+        if hasattr(self.client, 'create_chat_completion'):
+            create = self.client.create_chat_completion
+        else:
+            create = self.client.chat.completions.create
+        tokens = sum(
+            count_message_tokens(m) for m in kwargs.get('messages', []) if isinstance(m, dict)
+        ) + self.completion_tokens
+        if kwargs.get('stream'):
+            return self.gate.stream(create, tokens, **kwargs)
+        return self.gate.call(create, tokens, **kwargs)
+
+    def create_response(self, **kwargs):
+        '''
+        Same for responses api, history is server-side hence covered by completion_tokens
+        '''
+        create = get_create_response(self.client)
+        tokens = sum(
+            count_message_tokens({'content': str(i.get('content') or i.get('output') or '')})
+            for i in kwargs.get('input', []) if isinstance(i, dict)
+        ) + self.completion_tokens
+        if kwargs.get('stream'):
+            return self.gate.stream(create, tokens, **kwargs)
+        return self.gate.call(create, tokens, **kwargs)
+
+
+def get_retry_after(ex: openai.RateLimitError, default: float = 5) -> float:
+    headers = ex.response.headers if ex.response is not None else {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        return float(headers.get('retry-after', default))
+    except ValueError:
+        return default
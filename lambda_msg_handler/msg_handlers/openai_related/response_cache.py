@@ -0,0 +1,189 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import Counter
+from typing import Callable, Dict, List, Optional
+
+try:
+    # optional, semantic tier is disabled without it
+    import numpy as np
+except ImportError:
+    np = None
+
+from msg_handlers.metrics import emit_metrics
+from msg_handlers.ddb_related.utils import LRUCache
+
+logger = logging.getLogger()
+
+# Tiers reported in metrics
+TIER_EXACT = 'exact'
+TIER_SEMANTIC = 'semantic'
+TIER_MISS = 'miss'
+
+
+def normalize_text(text: str) -> str:
+    return ' '.join((text or '').lower().split())
+
+
+def get_scope(channel_id: str, instructions: str, model: str) -> str:
+    '''
+    Answers are only shared within a slack channel, between calls with same instructions and model
+    '''
+    return hashlib.sha256(
+        json.dumps([channel_id, normalize_text(instructions), model]).encode('utf-8')).hexdigest()
+
+
+def get_cache_key(scope: str, history: List[dict], question: str) -> str:
+    '''
+    Exact tier key: hash of scope and normalized (history, question)
+    history is the trimmed history actually sent to the model
+    '''
+    payload = json.dumps(dict(
+        scope=scope,
+        history=[
+            [m['role'], normalize_text(m['content'])]
+            for m in history if isinstance(m.get('content'), str)
+        ],
+        question=normalize_text(question),
+    ), sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def make_embedder(openai_client, model: str) -> Optional[Callable[[str], 'np.ndarray']]:
+    '''
+    Return:
+        function embedding a question into a unit vector, None if semantic tier not available
+    '''
+    if not model or np is None:
+        return None
+
+    def embed(text: str):
+        resp = openai_client.embeddings.create(model=model, input=normalize_text(text))
+        vector = np.asarray(resp.data[0].embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    return embed
+
+
+class SemanticIndex:
+    '''
+    Question embeddings in a NumPy matrix, looked up by cosine similarity within the same scope
+    Entries expire after ttl sec, least recently hit entry is evicted when full
+    '''
+
+    def __init__(self, maxsize: int, ttl: float, threshold: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self._vectors = None
+        self._scopes: List[Optional[str]] = [None] * maxsize
+        self._answers: List[Optional[str]] = [None] * maxsize
+        self._expire_at = np.zeros(maxsize)
+        self._last_hit = np.zeros(maxsize)
+        self._lock = threading.Lock()
+
+    def search(self, scope: str, vector) -> Optional[str]:
+        with self._lock:
+            if self._vectors is None:
+                return None
+            now = time.monotonic()
+            candidates = np.array([s == scope for s in self._scopes]) & (self._expire_at > now)
+            if not candidates.any():
+                return None
+            scores = np.where(candidates, self._vectors @ vector, -1.0)
+            i = int(np.argmax(scores))
+            if scores[i] < self.threshold:
+                return None
+            self._last_hit[i] = now
+            logger.info(f'Semantic cache match, similarity {scores[i]:.3f}')
+            return self._answers[i]
+
+    def add(self, scope: str, vector, answer: str):
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.maxsize, vector.shape[0]), dtype=np.float32)
+            now = time.monotonic()
+            # expired / empty slots have expire_at in the past, take those first
+            expired = np.flatnonzero(self._expire_at <= now)
+            i = int(expired[0]) if expired.size else int(np.argmin(self._last_hit))
+            self._vectors[i] = vector
+            self._scopes[i] = scope
+            self._answers[i] = answer
+            self._expire_at[i] = now + self.ttl
+            self._last_hit[i] = now
+        return
+
+
+class ResponseCache:
+    '''
+    Two tier cache of LLM answers, kept across warm invocations
+    - exact: same instructions, model, history and question (normalized)
+    - semantic: similar standalone question (no history), by embedding similarity
+    Only used for opted-in channels ('*' for all), answers are not shared across channels
+    Answers built with tools that are never cached (see tool_registry.is_cacheable) are not stored
+    '''
+
+    def __init__(
+            self, channels: str, ttl: float = 3600, maxsize: int = 512,
+            similarity: float = 0.92, embed: Optional[Callable] = None):
+        self.channels = {c.strip() for c in channels.split(',') if c.strip()}
+        self.exact = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.embed = embed
+        self.semantic = SemanticIndex(maxsize, ttl, similarity) if embed else None
+        self.counters = Counter()
+
+    def enabled_for(self, channel_id: str) -> bool:
+        return '*' in self.channels or channel_id in self.channels
+
+    def lookup(self, channel_id: str, instructions: str, model: str,
+               history: List[dict], question: str) -> Dict:
+        '''
+        Return:
+            dict of answer (None on miss) and the keys to store the answer with on miss
+        '''
+        start = time.monotonic()
+        scope = get_scope(channel_id, instructions, model)
+        entry = dict(
+            key=get_cache_key(scope, history, question),
+            scope=scope,
+            vector=None,
+            answer=None,
+        )
+        tier = TIER_MISS
+        entry['answer'] = self.exact.get(entry['key'])
+        if entry['answer'] is not None:
+            tier = TIER_EXACT
+        elif self.semantic is not None and not history:
+            try:
+                entry['vector'] = self.embed(question)
+                entry['answer'] = self.semantic.search(entry['scope'], entry['vector'])
+            except Exception as ex:
+                logger.warning(f'Semantic cache lookup failed: {ex}')
+            if entry['answer'] is not None:
+                tier = TIER_SEMANTIC
+                self.exact.set(entry['key'], entry['answer'])
+        self.record(tier, time.monotonic() - start)
+        return entry
+
+    def store(self, entry: Dict, answer: str):
+        if not answer:
+            return
+        self.exact.set(entry['key'], answer)
+        if self.semantic is not None and entry['vector'] is not None:
+            self.semantic.add(entry['scope'], entry['vector'], answer)
+        return
+
+    def record(self, tier: str, elapsed: float):
+        self.counters[tier] += 1
+        total = sum(self.counters.values())
+        hits = self.counters[TIER_EXACT] + self.counters[TIER_SEMANTIC]
+        logger.info(
+            f'Response cache {tier} in {elapsed * 1000:.1f}ms, hit rate {hits}/{total}')
+        emit_metrics({'Tier': tier}, {
+            'ResponseCacheLookups': (1, 'Count'),
+            'ResponseCacheLookupTime': (elapsed * 1000, 'Milliseconds'),
+        })
+        return
+
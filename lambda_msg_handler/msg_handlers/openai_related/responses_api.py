@@ -0,0 +1,245 @@
+import logging
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import botocore
+import openai
+from openai import Stream
+from openai.types.chat import ChatCompletionMessageToolCall
+
+from msg_handlers.openai_related.utils import run_tool_calls
+
+logger = logging.getLogger()
+
+# Sent as is, the openai sdk layer (1.37) predates client.responses
+RESPONSES_PATH = '/responses'
+
+
+def to_response_tools(tool_defs: List[dict]) -> List[dict]:
+    '''
+    Chat completion tool definitions ({'type', 'function': {...}}) in responses api form (flat)
+    '''
+    return [
+        {'type': 'function', **t['function']} if t.get('type') == 'function' else t
+        for t in tool_defs
+    ]
+
+
+def create_response(openai_client, **body):
+    '''
+    POST /responses, for stream=True the server-sent events as dicts
+    '''
+    stream = bool(body.get('stream'))
+    return openai_client.post(
+        RESPONSES_PATH,
+        cast_to=object,
+        body=body,
+        stream=stream,
+        stream_cls=Stream[object] if stream else None,
+    )
+
+
+def get_create_response(openai_client) -> Callable:
+    '''
+    create_response of a wrapper (e.g. rate gate), or POST /responses on the client
+    '''
+    if hasattr(openai_client, 'create_response'):
+        return openai_client.create_response
+    return lambda **body: create_response(openai_client, **body)
+
+
+def stream_response(openai_client, on_delta: Optional[Callable[[str], None]], **body) -> dict:
+    '''
+    Call responses api in streaming mode, pass each text delta to on_delta
+
+    Return:
+        the completed response (id, output items incl. function calls)
+    '''
+    response = None
+    for event in get_create_response(openai_client)(stream=True, **body):
+        # named events come wrapped as {'event', 'data'}
+        event = event.get('data', event)
+        if event.get('type') == 'response.output_text.delta':
+            if on_delta:
+                on_delta(event['delta'])
+        elif event.get('type') in ('response.completed', 'response.incomplete'):
+            response = event['response']
+        elif event.get('type') == 'response.failed':
+            raise RuntimeError(f'Response failed: {event["response"].get("error")}')
+    if response is None:
+        raise RuntimeError('Responses api stream ended without a response')
+    return response
+
+
+def retrieve_response(openai_client, response_id: str) -> dict:
+    return openai_client.get(f'{RESPONSES_PATH}/{response_id}', cast_to=object)
+
+
+def get_output_text(response: dict) -> str:
+    return ''.join(
+        c.get('text', '')
+        for item in response.get('output', []) if item.get('type') == 'message'
+        for c in item.get('content', []) if c.get('type') == 'output_text'
+    )
+
+
+def to_tool_call(item: dict) -> ChatCompletionMessageToolCall:
+    '''
+    function_call output item as chat completion tool call, as taken by run_tool_calls
+    '''
+    return ChatCompletionMessageToolCall.model_validate({
+        'id': item['call_id'],
+        'type': 'function',
+        'function': {'name': item['name'], 'arguments': item['arguments']},
+    })
+
+
+def respond(
+        openai_client,
+        model: str,
+        instructions: str,
+        msg: str,
+        previous_response_id: Optional[str],
+        tool_defs: List[dict],
+        tool_functions: Dict[str, Callable],
+        on_delta: Optional[Callable[[str], None]] = None,
+        truncation: str = 'auto',
+        earlier_msgs: Sequence[str] = ()) -> Tuple[str, str]:
+    '''
+    Send the new user message to responses api, chained to the previous response of the thread,
+    so history stays server-side and is not resent. Handles tool function calling,
+    tool outputs are chained the same way
+    truncation: 'auto' lets the server drop the oldest turns when the context window is full
+    earlier_msgs: user messages of the thread not sent yet (e.g. skipped acknowledgements),
+    sent before msg
+
+    Return:
+        (response id to chain the next message to, response text)
+    '''
+    body = dict(
+        model=model,
+        instructions=instructions,
+        tools=to_response_tools(tool_defs),
+        truncation=truncation,
+        store=True,
+    )
+    inputs = [{'role': 'user', 'content': m} for m in [*earlier_msgs, msg]]
+    try:
+        response = stream_response(
+            openai_client, on_delta,
+            input=inputs,
+            previous_response_id=previous_response_id,
+            **body)
+    except (openai.NotFoundError, openai.BadRequestError) as ex:
+        if not previous_response_id:
+            raise
+        # stored responses expire, the thread starts a new chain
+        logger.warning(f'Previous response {previous_response_id} not usable, new chain: {ex}')
+        response = stream_response(
+            openai_client, on_delta,
+            input=inputs,
+            **body)
+
+    tool_calls = [to_tool_call(i) for i in response['output'] if i.get('type') == 'function_call']
+    while tool_calls:
+        # independent tool calls of the turn run in parallel, outputs kept in call order
+        outputs = run_tool_calls(tool_functions, tool_calls)
+        response = stream_response(
+            openai_client, on_delta,
+            input=[
+                {'type': 'function_call_output', 'call_id': tc.id, 'output': str(output)}
+                for tc, output in zip(tool_calls, outputs)
+            ],
+            previous_response_id=response['id'],
+            **body)
+        tool_calls = [to_tool_call(i) for i in response['output'] if i.get('type') == 'function_call']
+
+    text = get_output_text(response)
+    if not text:
+        logger.warning(f'Empty text content from OpenAI response: {response.get("id")}')
+        text = f'Empty text content from OpenAI response: {response.get("status")}'
+    return response['id'], text
+
+
+def load_response_chain(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str
+) -> Tuple[Optional[str], List[str]]:
+    '''
+    Last response id of the slack thread (None for a new thread) and the messages
+    waiting to be sent with the next one (see queue_response_input), from ddb_asst_thread
+    Consistent read, the previous message may have been answered by another worker
+    '''
+    try:
+        resp = ddb_client.get_item(
+            TableName=ddb_table,
+            Key={
+                'slack_channel_id': {'S': slack_channel_id},
+                'slack_thread_ts': {'S': slack_thread_ts},
+            },
+            ProjectionExpression='last_response_id, pending_inputs',
+            ConsistentRead=True,
+        )
+    except botocore.exceptions.ClientError as ex:
+        logger.warning(f'DDB response chain not loaded: {ex}')
+        return None, []
+    item = resp.get('Item', {})
+    if 'last_response_id' not in item:
+        logger.info(f'No response chain for thread: {slack_channel_id};{slack_thread_ts}')
+    return (
+        item.get('last_response_id', {}).get('S'),
+        [i['S'] for i in item.get('pending_inputs', {}).get('L', [])],
+    )
+
+
+def queue_response_input(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str, text: str):
+    '''
+    Keep a message not answered (e.g. skipped acknowledgement) for the next response of the thread
+    '''
+    try:
+        ddb_client.update_item(
+            TableName=ddb_table,
+            Key={
+                'slack_channel_id': {'S': slack_channel_id},
+                'slack_thread_ts': {'S': slack_thread_ts},
+            },
+            UpdateExpression='SET pending_inputs = list_append(if_not_exists(pending_inputs, :empty), :text)',
+            ExpressionAttributeValues={':empty': {'L': []}, ':text': {'L': [{'S': text}]}},
+        )
+    except botocore.exceptions.ClientError as ex:
+        logger.warning(f'DDB response input not queued: {ex}')
+    return
+
+
+def save_last_response_id(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        response_id: str, previous_response_id: Optional[str], sent_inputs: int = 0):
+    '''
+    Move the thread's chain forward, only from the response it was built on,
+    so a concurrent answer chained to the same response does not drop the other's turn
+    sent_inputs: queued inputs sent with the response, removed from the queue
+    '''
+    if previous_response_id:
+        condition = 'last_response_id = :previous'
+        values = {':previous': {'S': previous_response_id}}
+    else:
+        condition = 'attribute_not_exists(last_response_id)'
+        values = {}
+    try:
+        ddb_client.update_item(
+            TableName=ddb_table,
+            Key={
+                'slack_channel_id': {'S': slack_channel_id},
+                'slack_thread_ts': {'S': slack_thread_ts},
+            },
+            UpdateExpression='SET last_response_id = :response_id' + (
+                ' REMOVE ' + ', '.join(f'pending_inputs[{n}]' for n in range(sent_inputs))
+                if sent_inputs else ''),
+            ConditionExpression=condition,
+            ExpressionAttributeValues={':response_id': {'S': response_id}, **values},
+        )
+    except botocore.exceptions.ClientError as ex:
+        if ex.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.warning(f'Response chain moved on concurrently, {response_id} not kept')
+        else:
+            logger.warning(f'DDB response chain not saved: {ex}')
+    return
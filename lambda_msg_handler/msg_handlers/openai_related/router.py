@@ -0,0 +1,168 @@
+'''
+Cheap local routing ahead of the LLM call
+- skip: thank-you messages ("thanks", "thx" ...), no LLM call,
+  unless they answer a question of the last reply
+- small: simple questions, answered by a small fast model
+- large: complex questions, the configured model
+Rules decide the clear cases, a tiny logistic model scores the rest
+'''
+import re
+import json
+import math
+import time
+import logging
+from typing import Callable, Dict, Optional, Tuple
+
+from msg_handlers.metrics import emit_metrics
+
+logger = logging.getLogger()
+
+ROUTE_SKIP = 'skip'
+ROUTE_SMALL = 'small'
+ROUTE_LARGE = 'large'
+
+# Whole message is a thank-you (after stripping emoji and punctuation)
+# Short answers (yes / no / ok / done ...) are not, they usually answer a question of the assistant
+ACK_PATTERN = re.compile(
+    r'^((many )?thanks?( you)?( very much| a lot| so much| again)?|thank u|thx|ty|tks|tysm|cheers|'
+    r'much appreciated|appreciate it|ありがとう(ございます)?|谢谢|多谢)$'
+)
+EMOJI_PATTERN = re.compile(r':[a-z0-9_+\-]+:|[\U0001F300-\U0001FAFF☀-➿]')
+PUNCT_PATTERN = re.compile(r'[\s!.,?~]+')
+# Mentions like <@U123> are not part of the question
+MENTION_PATTERN = re.compile(r'<[@#!][^>]*>')
+
+COMPLEX_KEYWORDS = (
+    'explain', 'why', 'compare', 'analy', 'design', 'debug', 'error', 'traceback',
+    'write', 'implement', 'refactor', 'step by step', 'plan', 'summar', 'review',
+    'difference', 'pros and cons', 'optimi', 'architecture',
+)
+
+# Tiny logistic model, P(large model needed), over the features in get_features
+DEFAULT_WEIGHTS = {
+    'bias': -2.5,
+    'log_chars': 0.55,
+    'questions': 0.4,
+    'keywords': 1.1,
+    'code': 2.5,
+    'lines': 0.3,
+    'url': 0.5,
+    'followup': 0.6,
+}
+
+
+def strip_message(text: str) -> str:
+    return MENTION_PATTERN.sub('', text or '').strip()
+
+
+def is_ack(text: str) -> bool:
+    '''
+    Emoji only / file only messages (nothing left once stripped) are not acknowledgements
+    '''
+    plain = EMOJI_PATTERN.sub('', text)
+    plain = PUNCT_PATTERN.sub(' ', plain).strip().lower()
+    return bool(ACK_PATTERN.match(plain))
+
+
+def asks_question(text: str) -> bool:
+    return EMOJI_PATTERN.sub('', text or '').rstrip().endswith(('?', '？'))
+
+
+def get_features(text: str, has_history: bool) -> Dict[str, float]:
+    lowered = text.lower()
+    return {
+        'bias': 1.0,
+        'log_chars': math.log1p(len(text)),
+        'questions': min(text.count('?'), 3),
+        'keywords': min(sum(k in lowered for k in COMPLEX_KEYWORDS), 3),
+        'code': float('```' in text or '`' in text),
+        'lines': min(text.count('\n'), 10),
+        'url': float('http://' in lowered or 'https://' in lowered),
+        'followup': float(has_history),
+    }
+
+
+class Router:
+    def __init__(self, enabled: bool = True, small_model: str = '',
+                 threshold: float = 0.5, weights: Optional[Dict[str, float]] = None):
+        '''
+        small_model: model (or azure deployment) for simple questions, empty to keep them on large
+        '''
+        self.enabled = enabled
+        self.small_model = small_model
+        self.threshold = threshold
+        self.weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+
+    def score(self, text: str, has_history: bool) -> float:
+        features = get_features(text, has_history)
+        z = sum(self.weights.get(k, 0.0) * v for k, v in features.items())
+        return 1.0 / (1.0 + math.exp(-z))
+
+    def classify(self, text: str, has_history: bool = False,
+                 get_last_reply: Optional[Callable[[], str]] = None) -> Tuple[str, str]:
+        '''
+        get_last_reply: last assistant message of the thread, only called for acknowledgements
+
+        Return:
+            (route, reason)
+        '''
+        text = strip_message(text)
+        if is_ack(text):
+            if not (has_history and get_last_reply):
+                return ROUTE_SKIP, 'ack'
+            try:
+                last_reply = get_last_reply()
+            except Exception as ex:
+                # rather answer than stay silent on a possible answer to a question
+                logger.warning(f'Last reply not available for routing: {ex}')
+                last_reply = '?'
+            if not asks_question(last_reply):
+                return ROUTE_SKIP, 'ack'
+        p = self.score(text, has_history)
+        if p >= self.threshold:
+            return ROUTE_LARGE, f'score {p:.2f}'
+        if not self.small_model:
+            return ROUTE_LARGE, f'score {p:.2f}, no small model'
+        return ROUTE_SMALL, f'score {p:.2f}'
+
+    def route(self, text: str, has_history: bool = False,
+              get_last_reply: Optional[Callable[[], str]] = None) -> str:
+        '''
+        Classify and record the decision (log + metric)
+        '''
+        if not self.enabled:
+            return ROUTE_LARGE
+        start = time.monotonic()
+        decision, reason = self.classify(text, has_history, get_last_reply)
+        elapsed = time.monotonic() - start
+        logger.info(f'Route {decision} ({reason}) in {elapsed * 1000:.2f}ms')
+        emit_metrics({'Route': decision}, {
+            'RouteTime': (elapsed * 1000, 'Milliseconds'),
+            'RoutedMessages': (1, 'Count'),
+        })
+        return decision
+
+    def get_model(self, decision: str, large_model: str) -> str:
+        return self.small_model if decision == ROUTE_SMALL else large_model
+
+    def record_llm_time(self, decision: str, elapsed: float):
+        '''
+        Time of the LLM call per route, to compare small and large model latency
+        '''
+        logger.info(f'LLM call on route {decision} in {elapsed:.3f}s')
+        emit_metrics({'Route': decision}, {'LLMTime': (elapsed * 1000, 'Milliseconds')})
+        return
+
+
+def load_weights(env: Dict[str, str]) -> Optional[Dict[str, float]]:
+    '''
+    Weights overriding DEFAULT_WEIGHTS, json in env router_weights
+    '''
+    if not env.get('router_weights'):
+        return None
+    try:
+        return json.loads(env['router_weights'])
+    except json.JSONDecodeError:
+        logger.warning('Invalid router_weights, using defaults')
+        return None
+
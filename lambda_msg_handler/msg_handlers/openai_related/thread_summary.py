@@ -0,0 +1,126 @@
+import time
+import logging
+from typing import Dict, List
+
+import botocore
+
+from msg_handlers.ddb_related.chat_history import iter_thread_items
+from msg_handlers.openai_related.context_budget import count_tokens
+from msg_handlers.openai_related.utils import get_create_chat_completion
+
+logger = logging.getLogger()
+
+# Sort key of the summary item in ddb_chat_completion, sorts before any slack ts
+SUMMARY_SORT_KEY = '#summary'
+
+SUMMARY_INSTRUCTIONS = (
+    'You maintain a running summary of a Slack thread between users and an assistant. '
+    'Update the existing summary with the new turns. Keep facts, decisions, open questions, '
+    'names and numbers. Be concise, no preamble.'
+)
+
+
+def load_summary(ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str) -> Dict[str, str]:
+    '''
+    Return:
+        dict of summary, summarized_until (slack_event_ts of the last turn compacted)
+        empty summary and summarized_until '0' if thread has no summary yet
+    '''
+    record = {'summary': '', 'summarized_until': '0'}
+    try:
+        resp = ddb_client.get_item(
+            TableName=ddb_table,
+            Key={
+                'slack_channel_id_thread_ts': {'S': f'{slack_channel_id};{slack_thread_ts}'},
+                'slack_event_ts': {'S': SUMMARY_SORT_KEY},
+            },
+        )
+        item = resp['Item']
+        record = {
+            'summary': item['summary']['S'],
+            'summarized_until': item['summarized_until']['S'],
+        }
+    except (botocore.exceptions.ClientError, KeyError):
+        pass
+    return record
+
+
+def to_summary_message(record: Dict[str, str]) -> List[Dict[str, str]]:
+    if not record['summary']:
+        return []
+    return [{
+        'role': 'system',
+        'content': f'Summary of the earlier conversation in this thread:\n{record["summary"]}',
+    }]
+
+
+def summarize(openai_client, model: str, summary: str, turns: List[dict]) -> str:
+    '''
+    openai_client: client, or GatedClient / provider pool (create_chat_completion)
+    '''
+    transcript = '\n'.join(
+        f"{t['role']}{' ' + t['name'] if t.get('name') else ''}: {t['content']}"
+        for t in turns if t['content'])
+    response = get_create_chat_completion(openai_client)(
+        model=model,
+        messages=[
+            {'role': 'system', 'content': SUMMARY_INSTRUCTIONS},
+            {'role': 'user', 'content': f'Existing summary:\n{summary or "(none)"}\n\nNew turns:\n{transcript}'},
+        ],
+    )
+    return response.choices[0].message.content or summary
+
+
+def update_summary(
+        openai_client, model: str, ddb_client, ddb_table: str,
+        slack_channel_id: str, slack_thread_ts: str, record: Dict[str, str],
+        threshold_tokens: int, keep_recent_tokens: int):
+    '''
+    Once the turns not yet summarized exceed threshold_tokens, compact the older ones
+    (all but the most recent keep_recent_tokens) into the summary item, incrementally.
+    Written conditionally on summarized_until, a concurrent update wins and this one is dropped.
+    '''
+    try:
+        turns = list(iter_thread_items(
+            ddb_client, ddb_table, slack_channel_id, slack_thread_ts,
+            after_ts=record['summarized_until'], newest_first=False))
+    except (botocore.exceptions.ClientError, KeyError) as ex:
+        logger.warning(f'Fail to read thread for summary: {ex}')
+        return
+    total = sum(t['tokens'] for t in turns)
+    if total <= threshold_tokens:
+        return
+
+    # compact oldest turns until the remaining fit in keep_recent_tokens
+    older = []
+    for t in turns:
+        if total <= keep_recent_tokens:
+            break
+        older.append(t)
+        total -= t['tokens']
+    if not older:
+        return
+
+    # runs after the reply is out, a failure only leaves the summary as is
+    start = time.monotonic()
+    try:
+        summary = summarize(openai_client, model, record['summary'], older)
+        logger.info(
+            f'Summarized {len(older)} turns in {time.monotonic() - start:.3f}s, {count_tokens(summary)} tokens')
+        ddb_client.put_item(
+            TableName=ddb_table,
+            Item={
+                'slack_channel_id_thread_ts': {'S': f'{slack_channel_id};{slack_thread_ts}'},
+                'slack_event_ts': {'S': SUMMARY_SORT_KEY},
+                'summary': {'S': summary},
+                'summarized_until': {'S': older[-1]['slack_event_ts']},
+            },
+            ConditionExpression='attribute_not_exists(summarized_until) OR summarized_until = :prev',
+            ExpressionAttributeValues={':prev': {'S': record['summarized_until']}},
+        )
+        logger.info(f'DDB summary updated: {slack_channel_id};{slack_thread_ts}')
+    except botocore.exceptions.ClientError as ex:
+        logger.warning(f'DDB summary not updated: {ex}')
+    except Exception as ex:
+        logger.warning(f'Summary not updated, fail to summarize: {ex}')
+    return
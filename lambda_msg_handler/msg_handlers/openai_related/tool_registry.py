@@ -0,0 +1,184 @@
+import json
+import asyncio
+import inspect
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Annotated, Any, Callable, Dict, List, Literal, Union, get_args, get_origin
+
+from msg_handlers.ddb_related.utils import LRUCache
+from msg_handlers.openai_related.context_budget import truncate_tokens
+
+logger = logging.getLogger()
+
+# JSON schema types of python annotations
+JSON_TYPES = {
+    str: 'string',
+    int: 'integer',
+    float: 'number',
+    bool: 'boolean',
+    list: 'array',
+    dict: 'object',
+}
+
+
+def get_param_schema(annotation) -> dict:
+    '''
+    JSON schema of one parameter, from its annotation
+    Annotated[<type>, '<description>'] adds a description, Literal[...] an enum
+    '''
+    schema = {}
+    if get_origin(annotation) is Annotated:
+        annotation, *meta = get_args(annotation)
+        descriptions = [m for m in meta if isinstance(m, str)]
+        if descriptions:
+            schema['description'] = descriptions[0]
+    if get_origin(annotation) is Union:
+        # Optional[x]
+        annotation = next(a for a in get_args(annotation) if a is not type(None))
+    if get_origin(annotation) is Literal:
+        values = get_args(annotation)
+        schema['enum'] = list(values)
+        annotation = type(values[0])
+    schema['type'] = JSON_TYPES.get(get_origin(annotation) or annotation, 'string')
+    if schema['type'] == 'array' and get_args(annotation):
+        schema['items'] = {'type': JSON_TYPES.get(get_args(annotation)[0], 'string')}
+    return schema
+
+
+def get_function_schema(function: Callable, description: str) -> dict:
+    properties, required = {}, []
+    for name, param in inspect.signature(function).parameters.items():
+        if param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+            continue
+        properties[name] = get_param_schema(param.annotation)
+        if param.default is param.empty:
+            required.append(name)
+    return {
+        'type': 'function',
+        'function': {
+            'name': function.__name__,
+            'description': description or inspect.getdoc(function) or '',
+            'parameters': {
+                'type': 'object',
+                'properties': properties,
+                'required': required,
+            },
+        },
+    }
+
+
+class Tool:
+    '''
+    Tool function with its limits
+    - timeout (sec): model gets a timeout message instead of waiting further
+    - max_concurrency: calls of this tool running at once, across threads
+    - cache_ttl (sec): memoized on arguments, 0 for never (e.g. time dependent tools)
+    '''
+
+    def __init__(self, function: Callable, description: str, timeout: float,
+                 max_concurrency: int, cache_ttl: float, executor: ThreadPoolExecutor,
+                 max_output_tokens: int):
+        self.name = function.__name__
+        self.function = function
+        self.definition = get_function_schema(function, description)
+        self.timeout = timeout
+        self.cache = LRUCache(maxsize=256, ttl=cache_ttl) if cache_ttl else None
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor = executor
+        self.max_output_tokens = max_output_tokens
+
+    def invoke(self, **kwargs) -> str:
+        if inspect.iscoroutinefunction(self.function):
+            return asyncio.run(self.function(**kwargs))
+        return self.function(**kwargs)
+
+    def __call__(self, **kwargs) -> str:
+        cache_key = json.dumps(kwargs, sort_keys=True, default=str)
+        if self.cache is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                logger.info(f'Tool {self.name} served from cache')
+                return cached
+
+        if not self._slots.acquire(timeout=self.timeout):
+            return f'Tool {self.name} is busy, try again later.'
+        try:
+            future = self._executor.submit(self.invoke, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        # slot held until the call ends, even past the timeout while the worker still runs
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            output = future.result(timeout=self.timeout)
+        except TimeoutError:
+            logger.warning(f'Tool {self.name} timed out after {self.timeout}s')
+            return f'Tool {self.name} timed out after {self.timeout}s.'
+        except Exception as ex:
+            logger.exception(f'Tool {self.name} failed')
+            return f'Tool {self.name} failed: {ex}'
+
+        output = truncate_tokens(str(output), self.max_output_tokens)
+        if self.cache is not None:
+            self.cache.set(cache_key, output)
+        return output
+
+
+class ToolRegistry:
+    '''
+    Tools declared by decorating typed functions, e.g.
+
+        @registry.tool(description='...', timeout=5, cache_ttl=3600)
+        def find_birthday(name: Annotated[str, 'Name of the person.']) -> str:
+
+    export() gives the {'definitions', 'tool_functions'} dict used by handlers
+    '''
+
+    def __init__(self, max_output_tokens: int = 2000, max_workers: int = 16):
+        '''
+        max_output_tokens: tool outputs are truncated to it before going back to the model
+        '''
+        self.max_output_tokens = max_output_tokens
+        self._tools: Dict[str, Tool] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tool-call')
+
+    def tool(self, description: str = '', timeout: float = 10, max_concurrency: int = 4,
+             cache_ttl: float = 0):
+        def register(function: Callable) -> Callable:
+            self._tools[function.__name__] = Tool(
+                function, description, timeout, max_concurrency, cache_ttl,
+                self._executor, self.max_output_tokens)
+            return function
+        return register
+
+    def export(self) -> Dict[str, Any]:
+        return {
+            'definitions': [t.definition for t in self._tools.values()],
+            'tool_functions': {name: t for name, t in self._tools.items()},
+        }
+
+
+def track_tool_calls(tool_functions: Dict[str, Callable], called: List[str]) -> Dict[str, Callable]:
+    '''
+    tool_functions recording the name of each tool called into called
+    '''
+    def track(name: str, function: Callable) -> Callable:
+        if inspect.iscoroutinefunction(function):
+            async def tracked(**kwargs):
+                called.append(name)
+                return await function(**kwargs)
+        else:
+            def tracked(**kwargs):
+                called.append(name)
+                return function(**kwargs)
+        return tracked
+    return {name: track(name, function) for name, function in tool_functions.items()}
+
+
+def is_cacheable(tool_functions: Dict[str, Callable], called: List[str]) -> bool:
+    '''
+    Whether an answer built with the tools called may be cached:
+    only registry tools with a cache_ttl, e.g. not time dependent ones
+    '''
+    return all(getattr(tool_functions.get(name), 'cache', None) is not None for name in called)
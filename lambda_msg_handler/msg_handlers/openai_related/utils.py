@@ -1,15 +1,78 @@
 import json
+import time
+import asyncio
+import inspect
 import logging
+import hashlib
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Optional, Union, Any, Dict, List, Callable
 from typing_extensions import override
 
+import botocore
+
 from openai import OpenAI, AzureOpenAI, AssistantEventHandler
+from openai.types.beta import Assistant
 from openai.types.beta.threads.runs import ToolCall, ToolCallDelta, RunStep
+from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
+
+from msg_handlers.ddb_related.utils import LRUCache
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+# Resolved assistants kept across warm invocations, keyed by assistant name
+_asst_cache: Dict[str, dict] = {}
+
+
+def get_asst_config_hash(instructions, model, tools) -> str:
+    '''
+    Hash of the assistant settings that require an update on OpenAI side when changed
+    '''
+    config = json.dumps(
+        dict(instructions=instructions, model=model, tools=tools),
+        sort_keys=True, default=str)
+    return hashlib.sha256(config.encode('utf-8')).hexdigest()
+
+
+def load_asst_record(ddb_client, ddb_table: str, name: str) -> Optional[dict]:
+    '''
+    Read the cached assistant record (asst json + config hash) from DDB by assistant name
+    '''
+    try:
+        resp = ddb_client.get_item(
+            TableName=ddb_table,
+            Key={'asst_name': {'S': name}},
+        )
+        item = resp['Item']
+        record = dict(
+            asst=Assistant.model_validate_json(item['asst_json']['S']),
+            config_hash=item['config_hash']['S'],
+        )
+        logger.info(f'DDB record found for assistant: {name}')
+    except (botocore.exceptions.ClientError, KeyError, ValueError) as exNotFound:
+        logger.info(f'No DDB record for assistant {name}: {exNotFound}')
+        record = None
+    return record
+
+
+def save_asst_record(ddb_client, ddb_table: str, name: str, asst, config_hash: str):
+    try:
+        ddb_client.put_item(
+            TableName=ddb_table,
+            Item={
+                'asst_name': {'S': name},
+                'asst_id': {'S': asst.id},
+                'asst_json': {'S': asst.to_json(indent=None)},
+                'config_hash': {'S': config_hash},
+            }
+        )
+        logger.info(f'DDB record saved for assistant: {name}')
+    except botocore.exceptions.ClientError as ex:
+        logger.warning(f'DDB record fail to save for assistant: {ex}')
+    return
+
+
 def get_asst(
         openai_client,
         asst_id: Optional[str] = None,
@@ -17,12 +80,18 @@ def get_asst(
         description: Optional[str] = None,
         instructions: Optional[str] = None,
         model: Optional[str] = None,
-        tools=None):
+        tools=None,
+        ddb_client=None,
+        ddb_table: Optional[str] = None):
     '''
     Check if there is an asistant with the specified name exist.
     If yes, retreive the object, if not create new.
     Tools to be loaded
 
+    The resolved assistant is cached in memory and (if ddb_table given) in DDB by name,
+    together with a hash of (instructions, model, tools).
+    The list / update calls to OpenAI only happen when that hash changes.
+
     Return
         Assistant object
     '''
@@ -32,8 +101,23 @@ def get_asst(
         model=model,
         tools=tools,
     )
-    asst = None
-    if asst_id:
+    config_hash = get_asst_config_hash(instructions, model, tools)
+    cache_key = asst_id or name
+
+    # in-memory cache, valid across warm invocations
+    record = _asst_cache.get(cache_key)
+    if not record and ddb_client and ddb_table and not asst_id:
+        record = load_asst_record(ddb_client, ddb_table, name)
+        if record:
+            _asst_cache[cache_key] = record
+    if record and record['config_hash'] == config_hash:
+        logger.info(f"Cached: {record['asst'].id}")
+        return record['asst']
+
+    asst = record['asst'] if record else None
+    if asst:
+        logger.info(f"Config changed for: {asst.id}")
+    elif asst_id:
         logger.info(f"Retrieving: {asst_id}")
         asst = openai_client.beta.assistants.retrieve(asst_id)
     else:
@@ -49,18 +133,233 @@ def get_asst(
         logger.info(f"Creating: {name}")
         asst = openai_client.beta.assistants.create(name=name, **asst_config)
     else:
-        openai_client.beta.assistants.update(asst.id, **asst_config)
+        asst = openai_client.beta.assistants.update(asst.id, **asst_config)
+
+    _asst_cache[cache_key] = dict(asst=asst, config_hash=config_hash)
+    if ddb_client and ddb_table and not asst_id:
+        save_asst_record(ddb_client, ddb_table, name, asst, config_hash)
     return asst
 
 
+# Slack thread (channel;thread_ts) => asst_thread_id, kept across warm invocations
+_asst_thread_ids = LRUCache(maxsize=2048)
+
+
+def find_asst_thread_id(
+        ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str) -> Optional[str]:
+    '''
+    Read-through cache of slack thread => asst_thread_id mapping, backed by DDB ddb_asst_thread
+    None for a slack thread without assistant thread yet
+    '''
+    cache_key = f'{slack_channel_id};{slack_thread_ts}'
+    asst_thread_id = _asst_thread_ids.get(cache_key)
+    if asst_thread_id:
+        logger.info(f'Cached thread: {asst_thread_id}')
+        return asst_thread_id
+
+    try:
+        resp = ddb_client.get_item(
+            TableName=ddb_table,
+            Key={
+                'slack_channel_id': {'S': slack_channel_id},
+                'slack_thread_ts': {'S': slack_thread_ts},
+            },
+            ProjectionExpression='asst_thread_id',
+        )
+        asst_thread_id = resp['Item']['asst_thread_id']['S']
+        logger.info(f'DDB record found for thread: {asst_thread_id}')
+    except (botocore.exceptions.ClientError, KeyError) as exNotFound:
+        logger.info(f'No DDB record for thread: {exNotFound}')
+        return None
+
+    _asst_thread_ids.set(cache_key, asst_thread_id)
+    return asst_thread_id
+
+
+def save_asst_thread_id(
+        openai_client, ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        asst_thread_id: str, delete_orphan: bool = True) -> str:
+    '''
+    Map the slack thread to a newly created assistant thread, written with attribute_not_exists
+    If another worker won the race, its thread is adopted and (if delete_orphan) ours is deleted
+
+    Return:
+        asst_thread_id the slack thread is mapped to
+    '''
+    try:
+        ddb_client.update_item(
+            TableName=ddb_table,
+            Key={
+                'slack_channel_id': {'S': slack_channel_id},
+                'slack_thread_ts': {'S': slack_thread_ts},
+            },
+            UpdateExpression='SET asst_thread_id=:asst_thread_id',
+            ConditionExpression='attribute_not_exists(asst_thread_id)',
+            ExpressionAttributeValues={
+                ':asst_thread_id': {'S': asst_thread_id}
+            },
+            ReturnValuesOnConditionCheckFailure='ALL_OLD',
+        )
+        logger.info(f'DDB record created for thread: {asst_thread_id}')
+    except botocore.exceptions.ClientError as ex:
+        if ex.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            logger.warning(ex)
+            return asst_thread_id
+        # lost the race, adopt the winner's thread and clean up ours
+        orphan_thread_id = asst_thread_id
+        asst_thread_id = ex.response['Item']['asst_thread_id']['S']
+        logger.info(f'Adopt thread: {asst_thread_id}, orphan: {orphan_thread_id}')
+        if delete_orphan:
+            delete_asst_thread(openai_client, orphan_thread_id)
+
+    _asst_thread_ids.set(f'{slack_channel_id};{slack_thread_ts}', asst_thread_id)
+    return asst_thread_id
+
+
+def delete_asst_thread(openai_client, asst_thread_id: str):
+    try:
+        openai_client.beta.threads.delete(asst_thread_id)
+    except Exception as ex_delete:
+        logger.warning(f'Fail to delete orphan thread: {ex_delete}')
+    return
+
+
+def get_or_create_asst_thread_id(
+        openai_client, ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str) -> str:
+    '''
+    Assistant thread of the slack thread, created (and mapped in DDB) for a new slack thread
+    '''
+    asst_thread_id = find_asst_thread_id(ddb_client, ddb_table, slack_channel_id, slack_thread_ts)
+    if asst_thread_id:
+        return asst_thread_id
+    thread = openai_client.beta.threads.create()
+    return save_asst_thread_id(
+        openai_client, ddb_client, ddb_table, slack_channel_id, slack_thread_ts, thread.id)
+
+
+# Writes taken off the response path, threads kept across warm invocations
+_background_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='background')
+
+
+def save_asst_thread_id_async(
+        openai_client, ddb_client, ddb_table: str, slack_channel_id: str, slack_thread_ts: str,
+        asst_thread_id: str) -> Future:
+    '''
+    save_asst_thread_id in background, while the run creating the thread streams
+    The orphan is not deleted here, its run may still be going (see settle_new_asst_thread)
+    '''
+    return _background_executor.submit(
+        save_asst_thread_id, openai_client, ddb_client, ddb_table,
+        slack_channel_id, slack_thread_ts, asst_thread_id, delete_orphan=False)
+
+
+def settle_new_asst_thread(
+        openai_client, saved: Future, asst_thread_id: str, question: str, answer: str):
+    '''
+    After a run that created its thread: wait for the mapping write, if another worker
+    mapped the slack thread first, copy the turn to its thread and delete ours
+    '''
+    mapped_thread_id = saved.result()
+    if mapped_thread_id == asst_thread_id:
+        return
+    add_asst_thread_turn(openai_client, mapped_thread_id, question, answer)
+    delete_asst_thread(openai_client, asst_thread_id)
+    return
+
+
+# Tool calls of one turn run in parallel, threads kept across warm invocations
+TOOL_MAX_WORKERS = 8
+_tool_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix='tool')
+
+
+def call_tool(tool_functions: Dict[str, Callable], tool_call) -> str:
+    '''
+    Call the tool function of one tool call, async tool functions are run to completion
+    '''
+    function_name = tool_call.function.name
+    function_to_call = tool_functions[function_name]
+    function_args = json.loads(tool_call.function.arguments)
+    start = time.monotonic()
+    if inspect.iscoroutinefunction(function_to_call):
+        function_response = asyncio.run(function_to_call(**function_args))
+    else:
+        function_response = function_to_call(**function_args)
+    logger.info(f'func name: {function_name}, {time.monotonic() - start:.3f}s')
+    logger.info(f'func arg: {tool_call.function.arguments}')
+    logger.info(f'func resp: {str(function_response)[:500]}')
+    return function_response
+
+
+def run_tool_calls(tool_functions: Dict[str, Callable], tool_calls) -> List[str]:
+    '''
+    Run the tool calls of one model turn in parallel
+
+    Return:
+        outputs in the same order as tool_calls
+    '''
+    if len(tool_calls) == 1:
+        return [call_tool(tool_functions, tool_calls[0])]
+    return list(_tool_executor.map(lambda tc: call_tool(tool_functions, tc), tool_calls))
+
+
+def add_asst_thread_messages(openai_client, asst_thread_id: str, texts: List[str]):
+    '''
+    Record user messages needing no answer (e.g. acknowledgements), so later runs in the thread see them
+    '''
+    for text in texts:
+        openai_client.beta.threads.messages.create(
+            thread_id=asst_thread_id, role='user', content=text)
+    return
+
+
+def get_last_asst_reply(openai_client, asst_thread_id: Optional[str]) -> str:
+    '''
+    Text of the last assistant message in the thread, empty if none
+    '''
+    if not asst_thread_id:
+        return ''
+    messages = openai_client.beta.threads.messages.list(
+        thread_id=asst_thread_id, order='desc', limit=5)
+    for message in messages.data:
+        if message.role == 'assistant':
+            return ''.join(c.text.value for c in message.content if c.type == 'text')
+    return ''
+
+
+def add_asst_thread_turn(openai_client, asst_thread_id: str, question: str, answer: str):
+    '''
+    Record a question answered without a run (e.g. from cache), so later runs in the thread see it
+    '''
+    openai_client.beta.threads.messages.create(
+        thread_id=asst_thread_id, role='user', content=question)
+    openai_client.beta.threads.messages.create(
+        thread_id=asst_thread_id, role='assistant', content=answer)
+    return
+
+
 def ask_asst(
         openai_client,
         asst_id: str,
-        asst_thread_id: str,
-        msg: str,
-        tool_functions: Dict[str, Callable]) -> str:
+        asst_thread_id: Optional[str],
+        msg: Union[str, List[str]],
+        tool_functions: Dict[str, Callable],
+        on_delta: Optional[Callable[[str], None]] = None,
+        truncation_strategy: Optional[dict] = None,
+        model: Optional[str] = None,
+        on_thread_created: Optional[Callable[[str], None]] = None,
+        on_first_output: Optional[Callable[[], None]] = None,
+        on_tool_outputs: Optional[Callable[[List[str]], None]] = None) -> str:
     '''
-    Send message to openai assistant api for response. Handles ordinary response and tool function calling
+    Send message (or several queued messages) to openai assistant api for response.
+    Handles ordinary response and tool function calling
+    Messages go with the run in one request: added to the run of an existing thread,
+    or without asst_thread_id, a new thread is created with them and run (create and run)
+    on_delta (optional) is called with each partial text as it is streamed
+    truncation_strategy (optional) limits thread messages sent to the model in the run
+    model (optional) overrides the assistant's model for this run
+    on_thread_created (optional) is called with the id of the new thread as soon as it exists
+    on_first_output (optional) is called once, at the first token or tool call of the run
+    on_tool_outputs (optional) is called with the tool outputs before they are submitted
 
     Return:
         response (str): string response from openai
@@ -68,17 +367,13 @@ def ask_asst(
     def handle_require_actions(
             openai_client, tool_functions, current_thread_id, current_run_id, tool_calls):
 
-        # requires tool calls
-        tool_outputs = []
-        for tool in tool_calls:
-            resp = tool_functions[tool.function.name](
-                **json.loads(tool.function.arguments)
-            )
-            logger.info(f'func name: {tool.function.name}')
-            logger.info(f'func arg: {tool.function.arguments}')
-            logger.info(f'func resp: {resp[:500]}')
-            tool_outputs.append({
-                "tool_call_id": tool.id, "output": resp})
+        # requires tool calls, run in parallel
+        tool_outputs = [
+            {"tool_call_id": tool.id, "output": resp}
+            for tool, resp in zip(tool_calls, run_tool_calls(tool_functions, tool_calls))
+        ]
+        if on_tool_outputs:
+            on_tool_outputs([o['output'] for o in tool_outputs])
 
         # submit tool call output
         response = ""
@@ -91,7 +386,10 @@ def ask_asst(
             for tool_event in tool_stream:
                 logger.info(f"Tool stream event: {tool_event.event}")
                 if tool_event.event == "thread.message.delta" and tool_event.data.delta.content:
-                    response += tool_event.data.delta.content[0].text.value
+                    delta = tool_event.data.delta.content[0].text.value
+                    response += delta
+                    if on_delta:
+                        on_delta(delta)
                 elif tool_event.event == 'thread.run.requires_action':
                     response = handle_require_actions(
                         openai_client,
@@ -103,26 +401,66 @@ def ask_asst(
 
         return response
 
-    openai_client.beta.threads.messages.create(
-        thread_id=asst_thread_id,
-        role="user",
-        content=msg
-    )
+    user_messages = [
+        {"role": "user", "content": m} for m in ([msg] if isinstance(msg, str) else msg)
+    ]
     response = ""
 
+    # time to first token, new thread (create and run) vs existing thread
+    run_start = time.monotonic()
+    thread_kind = 'existing' if asst_thread_id else 'new'
+    pass_delta = on_delta
+
+    def mark_first_output(kind):
+        nonlocal run_start
+        if run_start is None:
+            return
+        logger.info(f'First {kind} in {time.monotonic() - run_start:.3f}s, {thread_kind} thread')
+        run_start = None
+        if on_first_output:
+            on_first_output()
+
+    def on_delta(delta):
+        mark_first_output('token')
+        if pass_delta:
+            pass_delta(delta)
+
+    run_params = {}
+    if truncation_strategy:
+        run_params['truncation_strategy'] = truncation_strategy
+    if model:
+        run_params['model'] = model
+
     main_event_handler = AssistantEventHandler()
-    with openai_client.beta.threads.runs.stream(
-        thread_id=asst_thread_id,
-        assistant_id=asst_id,
-        event_handler=main_event_handler,
-    ) as stream:
+    if asst_thread_id:
+        run_stream = openai_client.beta.threads.runs.stream(
+            thread_id=asst_thread_id,
+            assistant_id=asst_id,
+            additional_messages=user_messages,
+            event_handler=main_event_handler,
+            **run_params,
+        )
+    else:
+        run_stream = openai_client.beta.threads.create_and_run_stream(
+            assistant_id=asst_id,
+            thread={"messages": user_messages},
+            event_handler=main_event_handler,
+            **run_params,
+        )
+    with run_stream as stream:
         for event in stream:
             logger.info(f"Stream event: {event.event}")
-            if event.event == "thread.message.delta" and event.data.delta.content:
+            if event.event == "thread.created" and on_thread_created:
+                on_thread_created(event.data.id)
+            elif event.event == "thread.message.delta" and event.data.delta.content:
                 # ordinary response from openai
-                response += event.data.delta.content[0].text.value
+                delta = event.data.delta.content[0].text.value
+                response += delta
+                if on_delta:
+                    on_delta(delta)
             elif event.event == 'thread.run.requires_action':
                 # requires tool calls
+                mark_first_output('tool call')
                 response = handle_require_actions(
                     openai_client,
                     tool_functions,
@@ -134,26 +472,85 @@ def ask_asst(
     return response
 
 
+def get_create_chat_completion(openai_client) -> Callable:
+    '''
+    chat.completions.create of the client, or create_chat_completion of a provider pool
+    '''
+    if hasattr(openai_client, 'create_chat_completion'):
+        return openai_client.create_chat_completion
+    return openai_client.chat.completions.create
+
+
+def stream_chat_completion(
+        openai_client,
+        on_delta: Callable[[str], None],
+        **kwargs) -> ChatCompletionMessage:
+    '''
+    Call chat completion api in streaming mode, pass each content delta to on_delta,
+    and assemble the chunks back into a complete message (incl. tool calls)
+    '''
+    content = ""
+    tool_calls = {}
+    stream = get_create_chat_completion(openai_client)(stream=True, **kwargs)
+    for chunk in stream:
+        if not chunk.choices:
+            # e.g. azure prompt filter results
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            content += delta.content
+            on_delta(delta.content)
+        for tc in delta.tool_calls or []:
+            call = tool_calls.setdefault(
+                tc.index, {"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+            if tc.id:
+                call["id"] = tc.id
+            if tc.function and tc.function.name:
+                call["function"]["name"] += tc.function.name
+            if tc.function and tc.function.arguments:
+                call["function"]["arguments"] += tc.function.arguments
+
+    return ChatCompletionMessage(
+        role="assistant",
+        content=content or None,
+        tool_calls=[
+            ChatCompletionMessageToolCall.model_validate(tool_calls[i])
+            for i in sorted(tool_calls)
+        ] or None,
+    )
+
+
 def complete_chat(
         openai_client,
         model: str,
         messages: List[Dict[str, str]],
         tool_defs: List[dict],
         tool_functions: Dict[str, Callable],
-        az_data_source: dict) -> str:
+        az_data_source: dict = {},
+        on_delta: Optional[Callable[[str], None]] = None) -> str:
+    '''
+    Send messages to chat completion api for response. Handles tool function calling
+    openai_client can also be a provider pool (see provider_pool.py)
+    If on_delta is given, the completion is streamed and on_delta is called with each partial text
+    '''
+    def create(**kwargs):
+        if on_delta:
+            return stream_chat_completion(openai_client, on_delta, **kwargs)
+        return get_create_chat_completion(openai_client)(**kwargs).choices[0].message
 
-    if (type(openai_client) is not AzureOpenAI) or az_data_source == {}:
+    # data sources are azure only, wrappers (pool, balancer, rate gate) may hold azure clients
+    if az_data_source == {} or (
+            isinstance(openai_client, OpenAI) and not isinstance(openai_client, AzureOpenAI)):
         extra_body = {}
     else:
         extra_body = {"data_sources": [az_data_source]}
 
-    response = openai_client.chat.completions.create(
+    response_message = create(
         model=model,
         messages=messages,
         tools=tool_defs,
         extra_body=extra_body,
     )
-    response_message = response.choices[0].message
 
     while response_message.tool_calls:
         messages.append({
@@ -161,30 +558,24 @@ def complete_chat(
             "tool_calls": response_message.tool_calls,
             "content": response_message.content})
 
-        for tool_call in response_message.tool_calls:
-            logger.info("==func name: " + tool_call.function.name)
-            function_name = tool_call.function.name
-            function_to_call = tool_functions[function_name]
-            function_args = json.loads(tool_call.function.arguments)
-            logger.info("==func args: \n" + str(function_args))
-            function_response = function_to_call(**function_args)
-            logger.info("==func resp: \n" + str(function_response[:200]))
+        # independent tool calls of the turn run in parallel, outputs kept in call order
+        function_responses = run_tool_calls(tool_functions, response_message.tool_calls)
+        for tool_call, function_response in zip(response_message.tool_calls, function_responses):
             messages.append(
                 {
                     "tool_call_id": tool_call.id,
                     "role": "tool",
-                    "name": function_name,
+                    "name": tool_call.function.name,
                     "content": function_response,
                 }
             )
-        response = openai_client.chat.completions.create(
+        response_message = create(
             model=model,
             messages=messages,
             tools=tool_defs,
         )
-        response_message = response.choices[0].message
 
     if not response_message.content:
-        logger.warning(f'Empty text content from OpenAI response: {response}')
-        return f'Empty text content from OpenAI response: {response}'
+        logger.warning(f'Empty text content from OpenAI response: {response_message}')
+        return f'Empty text content from OpenAI response: {response_message}'
     return response_message.content
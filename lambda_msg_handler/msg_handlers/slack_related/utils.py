@@ -1,5 +1,6 @@
 import logging
 import json
+import time
 
 from slack_sdk.errors import SlackApiError
 
@@ -11,6 +12,7 @@ def extract_event_details(slack_event):
     ref: slack event format follow doc below
     https://api.slack.com/events/message.channels
     https://api.slack.com/events/message.groups
+    Also accepts the slim envelope from receiver, which keeps the same shape
     '''
 
     text, channel_id, event_ts, thread_ts, user = "", "", "", "", ""
@@ -21,7 +23,9 @@ def extract_event_details(slack_event):
         event_ts = msg['event_ts']
         thread_ts = msg.get('thread_ts', event_ts)
         user = msg.get('user', 'unknown')
-        logger.info(json.dumps(msg, indent=2))
+        logger.info(f"Slack {msg.get('type')} in {channel_id};{thread_ts} from {user}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps(msg, default=dict))
     except KeyError as e:
         logger.warning("Malformed slack event format")
 
@@ -54,3 +58,108 @@ def reply(text, channel_id, thread_ts, slack_client):
         resp = None
 
     return resp
+
+
+class StreamingReply:
+    '''
+    Reply on slack thread progressively while the LLM output is being generated
+    - start(): post a placeholder message right away
+    - append(): buffer partial output, flushed via chat.update at most every flush_interval sec
+    - finalize(): update the message with the complete response
+    - abort(): remove the placeholder (or partial output) when the LLM call fails
+
+    chat.update is Tier 3 rate limited (~50/min), flush interval is doubled on rate limit error.
+    If not enabled, or placeholder fails to post, it falls back to a single reply() at finalize.
+    '''
+
+    def __init__(self, channel_id, thread_ts, slack_client, enabled=True,
+                 flush_interval=1.0, placeholder=':hourglass_flowing_sand:'):
+        self.channel_id = channel_id
+        self.thread_ts = thread_ts
+        self.slack_client = slack_client
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.placeholder = placeholder
+        self.msg_ts = None
+        self.text = ''
+        self.flushed_text = ''
+        self.last_flush = 0.0
+
+    def start(self):
+        if not self.enabled:
+            return
+        # Slack SDK Doc: https://api.slack.com/methods/chat.postMessage
+        try:
+            resp = self.slack_client.chat_postMessage(
+                channel=self.channel_id,
+                thread_ts=self.thread_ts,
+                text=self.placeholder
+            )
+            self.msg_ts = resp['ts']
+            self.last_flush = time.monotonic()
+        except SlackApiError as e:
+            logger.error(f"Error at placeholder: {e}")
+        return
+
+    @property
+    def on_delta(self):
+        return self.append if self.enabled else None
+
+    def append(self, delta):
+        self.text += delta
+        if self.msg_ts and time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+        return
+
+    def flush(self, text=None):
+        text = self.text if text is None else text
+        if not self.msg_ts or not text or text == self.flushed_text:
+            return None
+        # Slack SDK Doc: https://api.slack.com/methods/chat.update
+        try:
+            resp = self.slack_client.chat_update(
+                channel=self.channel_id,
+                ts=self.msg_ts,
+                text=text
+            )
+            self.flushed_text = text
+        except SlackApiError as e:
+            logger.warning(f"Error at streaming update: {e}")
+            if e.response.status_code == 429:
+                self.flush_interval *= 2
+            resp = None
+        self.last_flush = time.monotonic()
+        return resp
+
+    def finalize(self, text):
+        '''
+        Return:
+            slack api response of the final message (contains its ts), None if failed
+        '''
+        if not self.msg_ts:
+            return reply(text, self.channel_id, self.thread_ts, self.slack_client)
+        resp = self.flush(text)
+        if resp is None and text != self.flushed_text:
+            # retry once regardless of throttling, the final text must land
+            time.sleep(self.flush_interval)
+            resp = self.flush(text)
+        if resp is None:
+            resp = dict(ts=self.msg_ts)
+        logger.info(resp)
+        return resp
+
+    def abort(self, note=':warning: Failed to answer.'):
+        '''
+        Delete the placeholder, so a redelivered message does not leave one more behind
+        If it cannot be deleted, it is replaced by note
+        '''
+        if not self.msg_ts:
+            return
+        # Slack SDK Doc: https://api.slack.com/methods/chat.delete
+        try:
+            self.slack_client.chat_delete(channel=self.channel_id, ts=self.msg_ts)
+        except SlackApiError as e:
+            logger.warning(f"Error at placeholder delete: {e}")
+            self.flush(note)
+        self.msg_ts = None
+        return
@@ -0,0 +1,228 @@
+import os
+import gzip
+import json
+import zlib
+import base64
+import time
+import logging
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Tuple
+
+import botocore
+
+logger = logging.getLogger()
+
+# SQS DeleteMessageBatch takes at most 10 entries per call
+SQS_BATCH_LIMIT = 10
+
+# Lambda memory (MB) budgeted per concurrently processed record
+MEM_PER_WORKER = 32
+
+# content_encoding sqs message attribute for compressed body, see receiver envelope.py
+ENCODING_ZLIB_BASE64 = 'zlib+base64'
+
+# Fields an envelope carries whenever the slack event has them, see receiver envelope.py
+# Other fields are only in the raw event (envelope_keep_raw), fetched on demand
+ENVELOPE_FIELDS = {
+    'envelope_version': {},
+    'event_id': {},
+    'team_id': {},
+    'event': {k: {} for k in [
+        'type', 'subtype', 'text', 'channel', 'thread_ts', 'event_ts', 'user',
+        'client_msg_id', 'app_id', 'bot_id', 'files',
+    ]},
+}
+
+
+def delete_messages(sqs_client, sqs_url: str, receipt_handles: List[str]):
+    '''
+    Delete messages from SQS in batches of 10 (DeleteMessageBatch)
+
+    Return:
+        list of receipt handles failed to delete
+    '''
+    failed = []
+    for i in range(0, len(receipt_handles), SQS_BATCH_LIMIT):
+        chunk = receipt_handles[i:i + SQS_BATCH_LIMIT]
+        try:
+            resp = sqs_client.delete_message_batch(
+                QueueUrl=sqs_url,
+                Entries=[
+                    {'Id': str(n), 'ReceiptHandle': h} for n, h in enumerate(chunk)
+                ]
+            )
+            failed += [chunk[int(f['Id'])] for f in resp.get('Failed', [])]
+        except botocore.exceptions.ClientError as ex:
+            logger.error(f'Fail to delete from sqs: {ex}')
+            failed += chunk
+    logger.info(f'Deleted from sqs: {len(receipt_handles) - len(failed)}, failed: {len(failed)}')
+    return failed
+
+
+def get_max_concurrency() -> int:
+    '''
+    Concurrency limit for records within one invocation
+    From env handler_max_concurrency if set, otherwise derived from lambda memory size
+    '''
+    if os.environ.get('handler_max_concurrency'):
+        return max(1, int(os.environ['handler_max_concurrency']))
+    lambda_mem = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', '128'))
+    return max(1, min(SQS_BATCH_LIMIT, lambda_mem // MEM_PER_WORKER))
+
+
+def get_thread_key(slack_event: dict) -> str:
+    '''
+    channel;thread_ts of slack event, records with same key are processed in order
+    Return:
+        None if slack event is not in a channel / thread
+    '''
+    msg = slack_event.get('event', {})
+    channel = msg.get('channel')
+    thread_ts = msg.get('thread_ts', msg.get('event_ts'))
+    if not channel or not thread_ts:
+        return None
+    return f'{channel};{thread_ts}'
+
+
+def process_concurrently(
+        records: List[Tuple[str, Any]],
+        process: Callable[[Any], None],
+        get_key: Callable[[Any], str],
+        max_concurrency: int) -> List[str]:
+    '''
+    Process records of different keys (i.e. slack threads) in parallel on a thread pool,
+    and records of same key in order. If a record fails, the rest of records in the same key
+    are not processed and reported as failed too, so that redelivery keeps the order.
+
+    Arg:
+        records: list of (record id, payload), in arrival order
+        process: called with payload, raise to mark record as failed
+        get_key: ordering key of payload, None for no ordering constraint
+    Return:
+        list of failed record ids
+    '''
+    groups = OrderedDict()
+    for record_id, payload in records:
+        key = get_key(payload) or record_id
+        groups.setdefault(key, []).append((record_id, payload))
+
+    def process_group(group):
+        failed = []
+        for n, (record_id, payload) in enumerate(group):
+            start = time.monotonic()
+            try:
+                process(payload)
+                logger.info(
+                    f'Processed {record_id} in {time.monotonic() - start:.3f}s')
+            except Exception as error:
+                logger.error(
+                    f'Error at event handling {record_id} after {time.monotonic() - start:.3f}s: {str(error)}')
+                failed += [i for i, _ in group[n:]]
+                break
+        return failed
+
+    if not groups:
+        return []
+
+    failed = []
+    workers = min(max_concurrency, len(groups))
+    logger.info(f'Processing {len(records)} records in {len(groups)} threads, concurrency {workers}')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for group_failed in executor.map(process_group, groups.values()):
+            failed += group_failed
+    return failed
+
+
+class LazyEvent(Mapping):
+    '''
+    Slack event partly in S3: offloaded by the receiver (claim check), or raw event kept
+    behind an envelope. Keys in the preview are served without fetching,
+    any other key triggers a one-off fetch of the full event from S3
+    fields: keys the preview is complete for (nested as dict), missing ones are not fetched
+    '''
+
+    def __init__(self, preview: dict, load: Callable[[], dict], fields: Mapping = None):
+        self._preview = preview
+        self._load = load
+        self._fields = fields or {}
+        self._data = None
+
+    def _full(self) -> dict:
+        if self._data is None:
+            self._data = self._load()
+        return self._data
+
+    def __getitem__(self, key):
+        if self._data is None and (key in self._preview or key in self._fields):
+            # KeyError for a field missing from the preview, not in the full event either
+            value = self._preview[key]
+            if isinstance(value, dict):
+                return LazyEvent(value, lambda: self._full()[key], self._fields.get(key))
+            return value
+        return self._full()[key]
+
+    def __iter__(self):
+        return iter(self._full())
+
+    def __len__(self):
+        return len(self._full())
+
+
+def fetch_claim_check(s3_client, claim_check: dict) -> dict:
+    start = time.monotonic()
+    resp = s3_client.get_object(Bucket=claim_check['bucket'], Key=claim_check['key'])
+    data = resp['Body'].read()
+    if claim_check.get('encoding') == 'gzip':
+        data = gzip.decompress(data)
+    logger.info(
+        f"Fetched s3://{claim_check['bucket']}/{claim_check['key']} in {time.monotonic() - start:.3f}s")
+    return json.loads(data)
+
+
+def load_slack_event(body: dict, s3_client) -> Mapping:
+    '''
+    Slack event from sqs message body, which is either the event itself,
+    or a claim check pointer to the event in S3 (fetched lazily)
+    '''
+    claim_check = body.get('claim_check')
+    if not claim_check:
+        return with_raw_event(body, s3_client)
+    preview = {k: v for k, v in body.items() if k != 'claim_check'}
+    return LazyEvent(
+        preview, lambda: with_raw_event(fetch_claim_check(s3_client, claim_check), s3_client))
+
+
+def decode_body(sqs_msg: dict) -> dict:
+    '''
+    Sqs message body (slack event / envelope / claim check pointer) as dict,
+    decompressed according to content_encoding message attribute
+    '''
+    json_body = sqs_msg['body']
+    content_encoding = sqs_msg.get('messageAttributes', {}).get(
+        'content_encoding', {}).get('stringValue')
+    if content_encoding == ENCODING_ZLIB_BASE64:
+        json_body = zlib.decompress(base64.b64decode(json_body))
+    return json.loads(json_body)
+
+
+def with_raw_event(slack_event: Mapping, s3_client) -> Mapping:
+    '''
+    Envelope with a pointer to the raw event (receiver envelope_keep_raw):
+    envelope fields are served as is, others (blocks, authorizations, ...) from the raw event,
+    fetched on first access. Other events are returned as is
+    '''
+    raw = slack_event.get('raw') if slack_event.get('envelope_version') else None
+    if not raw:
+        return slack_event
+    envelope = {k: v for k, v in slack_event.items() if k != 'raw'}
+
+    def load():
+        raw_event = fetch_claim_check(s3_client, raw)
+        return {
+            **raw_event,
+            **envelope,
+            'event': {**raw_event.get('event', {}), **envelope.get('event', {})},
+        }
+    return LazyEvent(envelope, load, ENVELOPE_FIELDS)
@@ -32,6 +32,26 @@ data "aws_iam_policy_document" "lmbd_role_policy_msg_receiver" {
     ]
     resources = [aws_kms_key.msg_receiver.arn]
   }
+
+  statement {
+    sid    = "AllowReadWriteEventDedupDDB"
+    effect = "Allow"
+    actions = [
+      "dynamodb:PutItem",
+      "dynamodb:DeleteItem",
+    ]
+    resources = [aws_dynamodb_table.event_dedup.arn]
+  }
+
+  statement {
+    sid       = "AllowWriteClaimCheckS3"
+    effect    = "Allow"
+    actions   = ["s3:PutObject"]
+    resources = [
+      "${aws_s3_bucket.claim_check.arn}/events/*",
+      "${aws_s3_bucket.claim_check.arn}/raw/*",
+    ]
+  }
 }
 
 resource "aws_iam_role" "msg_receiver" {
@@ -66,9 +86,16 @@ resource "aws_lambda_function" "msg_receiver" {
 
   environment {
     variables = {
-      sqs_url          = aws_sqs_queue.msg_receiver.url
-      slack_app_tokens = join(",", local.slack_app_tokens)
-      slack_app_ids    = join(",", local.slack_app_ids)
+      sqs_url            = aws_sqs_queue.msg_receiver.url
+      slack_app_tokens   = join(",", local.slack_app_tokens)
+      slack_app_ids      = join(",", local.slack_app_ids)
+      ddb_event_dedup    = local.msg_receiver.ddb_event_dedup
+      claim_check_bucket = aws_s3_bucket.claim_check.id
+      sqs_event_format   = var.sqs_event_format.format
+      sqs_event_compress = tostring(var.sqs_event_format.compress)
+      envelope_keep_raw  = tostring(var.sqs_event_format.keep_raw)
+      event_filter_rules = jsonencode(var.event_filter_rules)
+      sqs_fifo           = tostring(var.sqs_fifo)
     }
   }
 }
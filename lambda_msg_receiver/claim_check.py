@@ -0,0 +1,64 @@
+import gzip
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def needs_claim_check(json_slack_event, max_size):
+    '''
+    Slack msg limit 40,000 char plus blocks / attachments, SQS limit 256KB (incl. attributes)
+    Offload events larger than max_size (bytes), files included or not (their metadata travels
+    in the event / envelope, contents are fetched by the handler)
+    '''
+    return len(json_slack_event.encode('utf-8')) > max_size
+
+
+def get_preview(slack_event):
+    '''
+    Small part of slack event travelling with the pointer, enough for the handler to
+    order / dedup the event without fetching the full payload
+    '''
+    msg = slack_event.get('event', {})
+    return {
+        'event_id': slack_event.get('event_id'),
+        'team_id': slack_event.get('team_id'),
+        'event': {
+            'channel': msg.get('channel'),
+            'event_ts': msg.get('event_ts'),
+            'thread_ts': msg.get('thread_ts', msg.get('event_ts')),
+            'client_msg_id': msg.get('client_msg_id'),
+        },
+    }
+
+
+def put_compressed(s3_client, bucket, key, json_str):
+    '''
+    Write gzip compressed json to S3, and return the pointer to it
+
+    Raise:
+        If fail to write, exception is raised by boto3
+    '''
+    data = gzip.compress(json_str.encode('utf-8'))
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=data,
+        ContentType='application/json',
+        ContentEncoding='gzip',
+    )
+    logger.info(f'Offloaded to s3://{bucket}/{key}: {len(json_str)} => {len(data)} bytes')
+    return {'bucket': bucket, 'key': key, 'encoding': 'gzip'}
+
+
+def offload_event(s3_client, bucket, json_slack_event, slack_event, key):
+    '''
+    Write the slack event to S3, and return the pointer to send via SQS instead
+
+    Raise:
+        If fail to write, exception is raised by boto3
+    '''
+    pointer = get_preview(slack_event)
+    pointer['claim_check'] = put_compressed(s3_client, bucket, key, json_slack_event)
+    return json.dumps(pointer)
@@ -0,0 +1,66 @@
+import json
+import zlib
+import base64
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+ENVELOPE_VERSION = 1
+
+# Fields of slack event kept in envelope, i.e. what msg handlers need
+ENVELOPE_EVENT_FIELDS = [
+    'type', 'subtype', 'text', 'channel', 'thread_ts', 'event_ts', 'user',
+    'client_msg_id', 'app_id', 'bot_id',
+]
+
+# Fields of each attached file kept in envelope, enough to download it (url_private)
+ENVELOPE_FILE_FIELDS = ['id', 'name', 'mimetype', 'filetype', 'size', 'url_private']
+
+# content_encoding sqs message attribute for compressed body
+ENCODING_ZLIB_BASE64 = 'zlib+base64'
+
+
+def to_envelope(slack_event, raw_pointer=None):
+    '''
+    Slim and normalized copy of slack event sent to SQS in place of the raw event
+    It keeps the shape of slack event (fields under 'event'), so handlers read it the same way
+    thread_ts is always set (event_ts for top level message), files are kept slim
+    Drops blocks, authorizations, event_context and etc. Raw event is in S3 if raw_pointer given
+    '''
+    msg = slack_event.get('event', {})
+    event = {k: msg[k] for k in ENVELOPE_EVENT_FIELDS if msg.get(k) is not None}
+    if 'event_ts' in event:
+        event.setdefault('thread_ts', event['event_ts'])
+    if msg.get('files'):
+        event['files'] = [
+            {k: f[k] for k in ENVELOPE_FILE_FIELDS if k in f} for f in msg['files']
+        ]
+
+    envelope = {
+        'envelope_version': ENVELOPE_VERSION,
+        'event_id': slack_event.get('event_id'),
+        'team_id': slack_event.get('team_id'),
+        'event': event,
+    }
+    if raw_pointer:
+        envelope['raw'] = raw_pointer
+    return envelope
+
+
+def encode_body(json_body, compress):
+    '''
+    Return:
+        (sqs message body, content_encoding) content_encoding is None if not compressed
+    '''
+    if not compress:
+        return json_body, None
+    data = base64.b64encode(zlib.compress(json_body.encode('utf-8'), 9)).decode('ascii')
+    if len(data) >= len(json_body):
+        # short events do not benefit from compression
+        return json_body, None
+    return data, ENCODING_ZLIB_BASE64
+
+
+def dumps(obj):
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
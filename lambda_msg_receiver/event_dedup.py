@@ -0,0 +1,78 @@
+import time
+import logging
+from collections import OrderedDict
+
+import botocore
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Event keys already pushed by this container (in-process LRU)
+_seen_events = OrderedDict()
+_seen_events_maxsize = 4096
+
+
+def get_dedup_key(slack_event):
+    '''
+    Same slack message can arrive as different events (e.g. message + app_mention),
+    which share client_msg_id but not event_id. Hence prefer client_msg_id.
+    '''
+    msg = slack_event.get('event', {})
+    return msg.get('client_msg_id') or slack_event.get('event_id')
+
+
+def remember_event(event_key):
+    _seen_events[event_key] = True
+    _seen_events.move_to_end(event_key)
+    while len(_seen_events) > _seen_events_maxsize:
+        _seen_events.popitem(last=False)
+    return
+
+
+def claim_event(ddb_client, ddb_table, event_key, ttl):
+    '''
+    Conditional put on event_key in DDB (see ddb_event_dedup.tf), expired by DDB TTL
+
+    Return:
+        False if the event has been received before, i.e. a duplicate
+    '''
+    if event_key in _seen_events:
+        logger.info(f'Duplicate event (in-process): {event_key}')
+        return False
+    remember_event(event_key)
+    if not ddb_table:
+        return True
+
+    try:
+        ddb_client.put_item(
+            TableName=ddb_table,
+            Item={
+                'event_key': {'S': event_key},
+                'expire_at': {'N': str(int(time.time()) + ttl)},
+            },
+            ConditionExpression='attribute_not_exists(event_key)',
+        )
+    except botocore.exceptions.ClientError as ex:
+        if ex.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.info(f'Duplicate event (DDB): {event_key}')
+            return False
+        # fail open, a duplicate reply is better than a lost one
+        logger.warning(f'DDB event claim fail: {ex}')
+    return True
+
+
+def release_event(ddb_client, ddb_table, event_key):
+    '''
+    Release the claim when the event fails to be pushed, so that slack retry gets through
+    '''
+    _seen_events.pop(event_key, None)
+    if not ddb_table:
+        return
+    try:
+        ddb_client.delete_item(
+            TableName=ddb_table,
+            Key={'event_key': {'S': event_key}},
+        )
+    except botocore.exceptions.ClientError as ex:
+        logger.warning(f'DDB event release fail: {ex}')
+    return
@@ -0,0 +1,104 @@
+'''
+Declarative filter rules evaluated on slack event before pushing to SQS
+Rules are evaluated in order, first matching rule decides the action (keep / drop), default keep
+A rule matches when all its conditions match, supported conditions:
+    event_types             list, event type in list
+    subtypes                list, event subtype in list ("" for no subtype)
+    channels                list, channel in list
+    exclude_channels        list, channel not in list (i.e. allow list when action is drop)
+    channel_types           list, channel type (channel / group / im / mpim) in list
+    exclude_channel_types   list, channel type not in list
+    bot_ids                 list, bot_id in list
+    is_bot                  bool, whether sent by a bot (bot_id or bot_message subtype)
+    mentioned               bool, whether the app is mentioned (app_mention or <@app user> in text)
+    text_regex              str, regex search on text
+Ex. [
+    {"name": "drop_edits", "action": "drop", "subtypes": ["message_changed", "message_deleted"]},
+    {"name": "mention_required", "action": "drop", "mentioned": false, "exclude_channel_types": ["im"]}
+]
+'''
+import re
+import json
+import logging
+from collections import Counter
+
+from metrics import emit_metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+LIST_CONDITIONS = {
+    'event_types': 'type',
+    'subtypes': 'subtype',
+    'channels': 'channel',
+    'channel_types': 'channel_type',
+    'bot_ids': 'bot_id',
+}
+EXCLUDE_CONDITIONS = {
+    'exclude_channels': 'channel',
+    'exclude_channel_types': 'channel_type',
+}
+
+# Matched count per rule, across warm invocations
+rule_counters = Counter()
+
+
+def load_rules(json_rules):
+    rules = json.loads(json_rules or '[]')
+    for n, rule in enumerate(rules):
+        rule.setdefault('name', f'rule_{n}')
+        rule.setdefault('action', 'drop')
+        if rule.get('text_regex'):
+            rule['_text_regex'] = re.compile(rule['text_regex'])
+    return rules
+
+
+def get_event_attrs(slack_event):
+    msg = slack_event.get('event', {})
+    text = msg.get('text', '')
+    app_users = [
+        a['user_id'] for a in slack_event.get('authorizations', []) if a.get('is_bot')
+    ]
+    return {
+        'type': msg.get('type', ''),
+        'subtype': msg.get('subtype', ''),
+        'channel': msg.get('channel', ''),
+        'channel_type': msg.get('channel_type', ''),
+        'bot_id': msg.get('bot_id', ''),
+        'is_bot': bool(msg.get('bot_id')) or msg.get('subtype') == 'bot_message',
+        'mentioned': msg.get('type') == 'app_mention' or any(f'<@{u}>' in text for u in app_users),
+        'text': text,
+    }
+
+
+def match_rule(rule, attrs):
+    for cond, attr in LIST_CONDITIONS.items():
+        if cond in rule and attrs[attr] not in rule[cond]:
+            return False
+    for cond, attr in EXCLUDE_CONDITIONS.items():
+        if cond in rule and attrs[attr] in rule[cond]:
+            return False
+    for cond in ('is_bot', 'mentioned'):
+        if cond in rule and attrs[cond] != rule[cond]:
+            return False
+    if '_text_regex' in rule and not rule['_text_regex'].search(attrs['text']):
+        return False
+    return True
+
+
+def filter_event(rules, slack_event):
+    '''
+    Return:
+        (keep: bool, name of the matched rule or None)
+    '''
+    if not rules:
+        return True, None
+    attrs = get_event_attrs(slack_event)
+    for rule in rules:
+        if match_rule(rule, attrs):
+            rule_counters[rule['name']] += 1
+            emit_metrics(
+                {'Rule': rule['name'], 'Action': rule['action']}, {'FilteredEvents': (1, 'Count')})
+            logger.info(f"Filter rule {rule['name']} => {rule['action']}, counters: {dict(rule_counters)}")
+            return rule['action'] != 'drop', rule['name']
+    return True, None
@@ -3,17 +3,44 @@ import logging
 import os
 import boto3
 
+from event_dedup import get_dedup_key, claim_event, release_event
+from claim_check import needs_claim_check, offload_event, put_compressed
+from envelope import to_envelope, encode_body, dumps
+from event_filter import load_rules, filter_event
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 slack_app_ids = os.environ['slack_app_ids'].split(",")
 slack_app_tokens = os.environ['slack_app_tokens'].split(",")
 
+# Idempotency on slack event, see ddb_event_dedup.tf
+ddb = boto3.client('dynamodb')
+ddb_event_dedup_table = os.environ.get('ddb_event_dedup', '')
+event_dedup_ttl = int(os.environ.get('event_dedup_ttl', '86400'))
+
+# Claim check, oversized slack events go to S3 and only a pointer goes to SQS
+s3 = boto3.client('s3')
+claim_check_bucket = os.environ.get('claim_check_bucket', '')
+claim_check_threshold = int(os.environ.get('claim_check_threshold', '240000'))
+
+# Filter rules, events nobody handles are not pushed to SQS, see event_filter.py
+event_filter_rules = load_rules(os.environ.get('event_filter_rules', '[]'))
+
+# Event format sent to SQS: 'envelope' (slim, see envelope.py) or 'raw' slack event
+sqs_event_format = os.environ.get('sqs_event_format', 'envelope')
+sqs_event_compress = os.environ.get('sqs_event_compress', 'false').lower() == 'true'
+envelope_keep_raw = os.environ.get('envelope_keep_raw', 'false').lower() == 'true'
+
+# FIFO queue, ordered per slack thread (message group channel;thread_ts)
+sqs_fifo = os.environ.get('sqs_fifo', 'false').lower() == 'true'
+
 
 def get_event_key_attrs(slack_event):
     '''
-    Get team_id, event_ts, channel, user(sender) from slack event
+    Get team_id, event_ts, channel, user(sender), thread_ts from slack event
     channel and user may not always exist in slack event
+    thread_ts is event_ts for top level message
     Arg:
         slack_event: python object loaded from json
     Raise:
@@ -24,43 +51,91 @@ def get_event_key_attrs(slack_event):
     event_ts = slack_event['event']['event_ts']
     channel = slack_event['event'].get('channel', 'NotFoundInEvent')
     user = slack_event['event'].get('user', 'NotFoundInEvent')
-    ret = (team_id, event_ts, channel, user)
+    thread_ts = slack_event['event'].get('thread_ts', event_ts)
+    ret = (team_id, event_ts, channel, user, thread_ts)
 
     logger.info(f'{ret}')
     return ret
 
 
-def push_to_sqs(json_slack_event, team_id, event_ts, channel="", user=""):
+def prepare_sqs_body(json_slack_event, slack_event, object_key):
+    '''
+    Turn slack event into sqs message body
+    - envelope format: slim envelope, raw event kept in S3 if envelope_keep_raw
+    - claim check: offload to S3 if still too large
+    - compression (optional)
+
+    Return:
+        (sqs message body, content_encoding or None)
+    '''
+    if sqs_event_format == 'envelope':
+        raw_pointer = None
+        if envelope_keep_raw and claim_check_bucket:
+            raw_pointer = put_compressed(
+                s3, claim_check_bucket, f'raw/{object_key}', json_slack_event)
+        slack_event = to_envelope(slack_event, raw_pointer)
+        json_slack_event = dumps(slack_event)
+
+    if claim_check_bucket and needs_claim_check(json_slack_event, claim_check_threshold):
+        json_slack_event = offload_event(
+            s3, claim_check_bucket, json_slack_event, slack_event, f'events/{object_key}')
+
+    return encode_body(json_slack_event, sqs_event_compress)
+
+
+def push_to_sqs(json_slack_event, team_id, event_ts, channel="", user="", content_encoding=None,
+                thread_ts="", event_id=""):
     '''
-    ToDo: Slack msg limit 40,000 char, SQS limit 256KB
-    Hence long slack msg may not fit in
+    Slack msg limit 40,000 char, SQS limit 256KB
+    Hence long slack msg may not fit in, those are offloaded to S3 by claim check beforehand
+
+    With FIFO queue, events of same slack thread are in one message group, i.e. handled in order,
+    while different threads are handled in parallel. Deduplicated on event_id by SQS.
 
     Raise:
         If fail to push, exception is raised by boto3
     '''
     logger.info('Push to SQS')
+    msg_attrs = {
+        'team_id': {
+            'StringValue': team_id,
+            'DataType': 'String'
+        },
+        'event_ts': {
+            'StringValue': event_ts,
+            'DataType': 'String'
+        },
+        'channel': {
+            'StringValue': channel,
+            'DataType': 'String'
+        },
+        'user': {
+            'StringValue': user,
+            'DataType': 'String'
+        },
+        'thread_ts': {
+            'StringValue': thread_ts or event_ts,
+            'DataType': 'String'
+        },
+    }
+    if content_encoding:
+        msg_attrs['content_encoding'] = {
+            'StringValue': content_encoding,
+            'DataType': 'String'
+        }
+    fifo_params = {}
+    if sqs_fifo:
+        fifo_params = {
+            'MessageGroupId': f'{channel};{thread_ts or event_ts}',
+            'MessageDeduplicationId': event_id or f'{team_id};{event_ts}',
+        }
+
     sqs = boto3.client('sqs')
     resp = sqs.send_message(
         QueueUrl=os.environ['sqs_url'],
         MessageBody=json_slack_event,
-        MessageAttributes={
-            'team_id': {
-                'StringValue': team_id,
-                'DataType': 'String'
-            },
-            'event_ts': {
-                'StringValue': event_ts,
-                'DataType': 'String'
-            },
-            'channel': {
-                'StringValue': channel,
-                'DataType': 'String'
-            },
-            'user': {
-                'StringValue': user,
-                'DataType': 'String'
-            },
-        },
+        MessageAttributes=msg_attrs,
+        **fifo_params,
     )
     logger.info(f'{resp}')
 
@@ -92,7 +167,7 @@ def lambda_handler(event, context):
         }
 
     # Get Slack event key attributes
-    team_id, event_ts, channel, user = get_event_key_attrs(body)
+    team_id, event_ts, channel, user, thread_ts = get_event_key_attrs(body)
 
     # Send message to SQS
     if body['event'].get('app_id') in slack_app_ids:
@@ -101,8 +176,23 @@ def lambda_handler(event, context):
     elif headers.get('x-slack-retry-reason', None) == "http_timeout":
         # Ignore retry from slack event api due to 3sec timeout
         logger.info('Ignore retry msg due to slack event api 3sec timeout')
+    elif not filter_event(event_filter_rules, body)[0]:
+        # Ignore event dropped by filter rules
+        logger.info('Ignore event dropped by filter rules')
+    elif (dedup_key := get_dedup_key(body)) and not claim_event(
+            ddb, ddb_event_dedup_table, f'recv#{dedup_key}', event_dedup_ttl):
+        # Ignore duplicate delivery of an event already pushed
+        logger.info('Ignore duplicate slack event')
     else:
-        push_to_sqs(json_body, team_id, event_ts, channel, user)
+        try:
+            sqs_body, content_encoding = prepare_sqs_body(
+                json_body, body, f'{team_id}/{dedup_key or event_ts}.json.gz')
+            push_to_sqs(sqs_body, team_id, event_ts, channel, user, content_encoding,
+                        thread_ts, body.get('event_id', ''))
+        except Exception:
+            if dedup_key:
+                release_event(ddb, ddb_event_dedup_table, f'recv#{dedup_key}')
+            raise
 
     return {
         'statusCode': 200,
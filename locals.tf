@@ -15,8 +15,12 @@ locals {
   msg_receiver = {
     iam_role = "iamr-${var.msg_receiver_name}-${random_string.x.id}"
     lambda   = "lmbd-${var.msg_receiver_name}-${random_string.x.id}"
-    sqs      = "sqs-${var.msg_receiver_name}-${random_string.x.id}"
+    sqs      = "sqs-${var.msg_receiver_name}-${random_string.x.id}${var.sqs_fifo ? ".fifo" : ""}"
+    sqs_dlq  = "sqs-dlq-${var.msg_receiver_name}-${random_string.x.id}${var.sqs_fifo ? ".fifo" : ""}"
     kms      = "kms-${var.msg_receiver_name}-${random_string.x.id}"
+
+    ddb_event_dedup = "ddb-event-dedup-${random_string.x.id}"
+    s3_claim_check  = "claim-check-${random_string.x.id}-${local.account_id}"
   }
 
   msg_handler = {
@@ -26,5 +30,7 @@ locals {
     lambda_timeout      = var.lambda_msg_handler_timeout
     ddb_asst_thread     = "ddb-asst-thread-${random_string.x.id}"
     ddb_chat_completion = "ddb-chat-completion-${random_string.x.id}"
+    ddb_asst_config     = "ddb-asst-config-${random_string.x.id}"
+    ddb_llm_control     = "ddb-llm-control-${random_string.x.id}"
   }
 }
@@ -0,0 +1,37 @@
+# S3 storing slack events too large for SQS (claim check), under events/
+# Receiver writes gzip compressed event, and sends only a pointer via SQS
+# Also raw slack events under raw/, if kept by receiver alongside the slim envelope
+resource "aws_s3_bucket" "claim_check" {
+  bucket        = local.msg_receiver.s3_claim_check
+  force_destroy = true
+}
+
+resource "aws_s3_bucket_public_access_block" "claim_check" {
+  bucket                  = aws_s3_bucket.claim_check.id
+  block_public_acls       = true
+  block_public_policy     = true
+  ignore_public_acls      = true
+  restrict_public_buckets = true
+}
+
+resource "aws_s3_bucket_server_side_encryption_configuration" "claim_check" {
+  bucket = aws_s3_bucket.claim_check.id
+  rule {
+    apply_server_side_encryption_by_default {
+      sse_algorithm = "AES256"
+    }
+  }
+}
+
+resource "aws_s3_bucket_lifecycle_configuration" "claim_check" {
+  bucket = aws_s3_bucket.claim_check.id
+  rule {
+    id     = "expire-events"
+    status = "Enabled"
+    filter {}
+    # Outlive sqs message retention, incl. time spent in DLQ
+    expiration {
+      days = 15
+    }
+  }
+}
@@ -57,10 +57,32 @@ resource "aws_sqs_queue" "msg_receiver" {
   message_retention_seconds  = 604800
   max_message_size           = 262144
 
+  # FIFO mode: receiver sets message group channel;thread_ts and dedup id event_id
+  fifo_queue                  = var.sqs_fifo ? true : null
+  content_based_deduplication = var.sqs_fifo ? false : null
+  deduplication_scope         = var.sqs_fifo ? "messageGroup" : null
+  fifo_throughput_limit       = var.sqs_fifo ? "perMessageGroupId" : null
+
   kms_master_key_id                 = aws_kms_key.msg_receiver.key_id
   kms_data_key_reuse_period_seconds = 600
 
   policy = data.aws_iam_policy_document.sqs_policy_msg_receiver.json
+
+  # Failed slack events are redelivered until max receive count, then moved to DLQ
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.msg_receiver_dlq.arn
+    maxReceiveCount     = var.msg_handler_sqs_batch.max_receive_count
+  })
+}
+
+# SQS capturing slack events failed to be handled
+resource "aws_sqs_queue" "msg_receiver_dlq" {
+  name                      = local.msg_receiver.sqs_dlq
+  message_retention_seconds = 1209600
+  fifo_queue                = var.sqs_fifo ? true : null
+
+  kms_master_key_id                 = aws_kms_key.msg_receiver.key_id
+  kms_data_key_reuse_period_seconds = 600
 }
 
 data "aws_iam_policy_document" "sqs_policy_msg_receiver" {
@@ -28,6 +28,65 @@ variable "lambda_msg_handler_mem" {
   default     = 128
 }
 
+variable "event_filter_rules" {
+  description = "Rules evaluated by receiver before pushing slack event to SQS, first match decides keep / drop. Conditions are documented in lambda_msg_receiver/event_filter.py"
+  type        = any
+  default = [
+    {
+      name     = "drop_edits_and_membership"
+      action   = "drop"
+      subtypes = ["message_changed", "message_deleted", "channel_join", "channel_leave", "group_join", "group_leave"]
+    },
+    {
+      name   = "drop_bots"
+      action = "drop"
+      is_bot = true
+    },
+  ]
+}
+
+variable "sqs_event_format" {
+  description = "Format of slack event sent from receiver to handler via SQS. format: envelope (slim, only fields handlers need) or raw (slack event as is). compress: zlib + base64 the body. keep_raw: with envelope, also keep raw event in S3 for handlers to fetch on demand."
+  type = object({
+    format   = string
+    compress = bool
+    keep_raw = bool
+  })
+  default = {
+    format   = "envelope"
+    compress = false
+    keep_raw = false
+  }
+}
+
+variable "sqs_fifo" {
+  description = "Use FIFO queue, so that events of the same slack thread are handled in order (message group channel;thread_ts) while different threads still run in parallel. Changing it replaces the queue."
+  type        = bool
+  default     = false
+}
+
+variable "msg_handler_sqs_batch" {
+  description = "SQS event source mapping for msg handler. Batching window adds up to that many seconds of reply latency. Maximum concurrency is min 2. Failed events move to DLQ after max receive count."
+  type = object({
+    batch_size              = number
+    batching_window_seconds = number
+    maximum_concurrency     = number
+    max_receive_count       = number
+  })
+  default = {
+    batch_size              = 10
+    batching_window_seconds = 0
+    maximum_concurrency     = 10
+    max_receive_count       = 3
+  }
+}
+
+variable "slack_stream_reply" {
+  description = "Whether msg handler posts a placeholder reply right away and updates it as LLM output streams in"
+  type        = bool
+  default     = true
+}
+
 variable "slack_app" {
   #   Ex: {
   #     "app_a_id" : "app_a_verification_token",
@@ -80,6 +139,67 @@ variable "az_openai_handler_vars" {
   }
 }
 
+variable "az_openai_deployments" {
+  description = "Optional Azure OpenAI deployments to spread chat completion over, picked per request by x-ratelimit-remaining-* headers. model is the deployment_name of az_openai_handler_vars (or az_openai_small_deployment_name) they stand in for (default that deployment_name); one must serve deployment_name (checked at start), simple questions stay on it if none serves az_openai_small_deployment_name."
+  type = list(object({
+    endpoint    = string
+    deployment  = string
+    api_key     = string
+    api_version = optional(string)
+    model       = optional(string)
+  }))
+  default   = []
+  sensitive = true
+}
+
+variable "chat_history_token_budget" {
+  description = "Max tokens of thread history sent to LLM. Chat completion fills history newest first up to it, assistant runs keep the last budget / 200 messages."
+  type        = number
+  default     = 8000
+}
+
+variable "chat_summary_threshold" {
+  description = "Tokens of unsummarized thread history before older turns are compacted into a rolling thread summary (chat completion only). 0 to disable."
+  type        = number
+  default     = 6000
+}
+
+variable "chat_history_layout" {
+  description = "Thread history in ddb_chat_completion (chat completion only): 'items' keeps one item per message, 'packed' one compressed document per thread read with a single GetItem (rolling history instead of the thread summary). Compare with `python benchmarks/bench_thread_layout.py`."
+  type        = string
+  default     = "items"
+}
+
+variable "response_cache_channels" {
+  description = "Slack channel ids (comma separated, '*' for all) where repeated questions are answered from the response cache. Empty to disable."
+  type        = string
+  default     = ""
+}
+
+variable "llm_router" {
+  description = "Route messages before the LLM call: thank-you messages get no answer (unless the last reply asked a question), simple questions go to the small model (openai_small_model / az_openai_small_deployment_name)."
+  type        = bool
+  default     = true
+}
+
+variable "provider_pool_order" {
+  description = "Providers (openai, azure) in order of preference for chat completion of openai_handler, e.g. \"openai,azure\": hedges slow requests and fails over on 429 / 5xx / connection errors. \"openai\" for no pool."
+  type        = string
+  default     = "openai"
+}
+
+variable "llm_rate_limits" {
+  description = "Cluster-wide requests / tokens per minute for LLM calls of the message handler, shared via DynamoDB (tool outputs of assistants runs included). 0 for no limit. The concurrency limit adapting to 429s / latency is per container. When set, SDK retries are off for chat completion / responses calls and their 429s are retried by the handler after retry-after (assistants calls keep SDK retries)."
+  type = object({
+    rpm = number
+    tpm = number
+  })
+  default = {
+    rpm = 0
+    tpm = 0
+  }
+}
+
 variable "llm_tools_vars" {
   description = "Variables required in llm_tools in message handler lambda. Each var passed in as string only."
   type        = map(string)